@@ -0,0 +1,879 @@
+"""Бенчмарки нарративной RPG
+
+Запуск из корня репозитория:
+    python bench.py logging [--requests 400]
+    python bench.py assets [--rtt-ms 100 --bandwidth-kbps 1600]
+    python bench.py archive [--size-mb 2048 --memory-cap-mb 768]
+    python bench.py startup [--runs 10 --max-import-ms 0 --max-first-request-ms 0]
+    python bench.py breaker [--rps 2 --outage-s 120 --timeout-s 30]
+    python bench.py hedge [--distribution stall --stall-rate 0.02 --budgets 0.05 0.1]
+    python bench.py load [--players 20 --turns 10 --median-s 1 --error-rate 0.01]
+
+Каждый бенчмарк работает во временной папке (users.db, user_data) и не
+трогает данные репозитория. Вызовы Mistral подменяются мгновенной заглушкой;
+load запускает приложение отдельным HTTP-сервером, а Mistral заменяет
+локальная заглушка mistral_stub.py с настраиваемыми задержками и ошибками.
+"""
+import argparse
+import gzip
+import heapq
+import http.cookiejar
+import json
+import random
+import re
+import logging
+import math
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import mistral_stub
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_app():
+    """Импортирует main во временной рабочей папке"""
+    workdir = tempfile.mkdtemp(prefix="rpg-bench-")
+    os.chdir(workdir)
+    # Правила ГМ читаются по относительному пути
+    os.symlink(os.path.join(REPO_DIR, "attached_assets"), "attached_assets")
+    os.environ.setdefault("MISTRAL_API_KEY", "bench")
+    sys.path.insert(0, REPO_DIR)
+    import main
+    main.create_app()
+    install_fake_llm(main)
+    return main
+
+
+def install_fake_llm(main, latency=0.0):
+    """Подменяет клиент Mistral заглушкой с фиксированной задержкой"""
+
+    class _Message:
+        def __init__(self, content):
+            self.content = content
+
+    class _Choice:
+        def __init__(self, content):
+            self.message = _Message(content)
+
+    class _Response:
+        def __init__(self, content):
+            self.choices = [_Choice(content)]
+            self.usage = None
+
+    class _Chat:
+        def complete(self, model, messages, **kwargs):
+            if latency:
+                time.sleep(latency)
+            return _Response("Таверна гудит, трактирщик кивает вам. " * 10)
+
+    class FakeMistral:
+        def __init__(self, api_key=None, **kwargs):
+            self.chat = _Chat()
+
+    main.Mistral = FakeMistral
+
+
+def start_session(main, username):
+    """Регистрирует пользователя, создает персонажа и чат с ним"""
+    client = main.app.test_client()
+    client.post('/register', json={"username": username, "password": "bench-password"})
+    client.post('/upload_character',
+                json={"file_content": '{"name": "Бор", "class": "Воин"}',
+                      "character_name": "Бор"})
+    return client
+
+
+def run_turns(client, chat_id, turns):
+    """Прогоняет turns запросов /send_message в новом чате, возвращает мкс на запрос"""
+    client.post('/create_chat', json={"chat_id": chat_id})
+    client.post('/load_character', json={"filename": "Бор", "chat_id": chat_id})
+    client.post('/start_game_with_character', json={"chat_id": chat_id})
+    durations = []
+    message = "Я захожу в таверну и осматриваюсь по сторонам. " * 5
+    for _ in range(turns):
+        started = time.perf_counter()
+        client.post('/send_message', json={"message": message, "chat_id": chat_id})
+        durations.append((time.perf_counter() - started) * 1e6)
+    return durations
+
+
+def bench_logging(args):
+    """Накладные расходы логирования на запрос /send_message"""
+    main = import_app()
+    sink = open(os.devnull, 'w', encoding='utf-8')
+
+    def legacy_setup():
+        # Прежняя конфигурация: синхронный вывод, DEBUG, без семплирования
+        main.shutdown_logging()
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        handler = logging.StreamHandler(sink)
+        handler.setFormatter(
+            logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        root.addHandler(handler)
+        root.setLevel(logging.DEBUG)
+
+    def disabled_setup():
+        main.shutdown_logging()
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.setLevel(logging.CRITICAL + 1)
+
+    configs = [
+        ("без логирования", disabled_setup),
+        ("синхронный DEBUG (как раньше)", legacy_setup),
+        ("очередь, JSON, INFO", lambda: main.setup_logging("INFO", "json", sink)),
+        ("очередь, JSON, DEBUG + семплирование",
+         lambda: main.setup_logging("DEBUG", "json", sink)),
+    ]
+
+    client = start_session(main, "bench")
+    disabled_setup()
+    run_turns(client, "warmup", 20)
+
+    # Конфигурации чередуются по раундам, чтобы дрейф (рост файлов, прогрев
+    # кэшей ОС) не попадал в разницу между ними
+    chat_size = 10
+    durations = {name: [] for name, _ in configs}
+    for round_index in range(max(1, args.requests // chat_size)):
+        for config_index, (name, setup) in enumerate(configs):
+            setup()
+            durations[name].extend(
+                run_turns(client, f"bench_{round_index}_{config_index}", chat_size))
+    main.shutdown_logging()
+
+    baseline = statistics.median(durations[configs[0][0]])
+    print(f"{'конфигурация':<40} {'медиана, мкс':>14} {'среднее, мкс':>14} {'оверхед, мкс':>14}")
+    for name, _ in configs:
+        median = statistics.median(durations[name])
+        mean = statistics.mean(durations[name])
+        print(f"{name:<40} {median:>14.1f} {mean:>14.1f} {median - baseline:>14.1f}")
+
+
+def response_text(response):
+    """Текст ответа с учетом gzip"""
+    data = response.data
+    if response.headers.get('Content-Encoding') == 'gzip':
+        data = gzip.decompress(data)
+    return data.decode('utf-8')
+
+
+def median_request_time(client, path, repeats=50, **kwargs):
+    """Медианное серверное время ответа, мс"""
+    durations = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        response = client.get(path, **kwargs)
+        durations.append((time.perf_counter() - started) * 1000)
+    return response, statistics.median(durations)
+
+
+def bench_assets(args):
+    """Объем и время первой и повторной загрузки страницы игры"""
+    main = import_app()
+    client = start_session(main, "assets")
+    headers = {"Accept-Encoding": "gzip"}
+
+    # После: HTML со ссылками на собранные ресурсы
+    page, page_ms = median_request_time(client, '/', headers=headers)
+    asset_sizes = []
+    asset_ms = 0.0
+    html = response_text(page)
+    for url in re.findall(r'/assets/[^"]+', html):
+        response, duration = median_request_time(client, url, headers=headers)
+        asset_sizes.append(len(response.data))
+        asset_ms = max(asset_ms, duration)
+    page_bytes = len(page.data)
+
+    # До: те же исходники встроены в HTML без минификации и кэширования
+    with open(os.path.join(REPO_DIR, "static", "css", "game.css"), encoding="utf-8") as f:
+        css = f.read()
+    with open(os.path.join(REPO_DIR, "static", "js", "game.js"), encoding="utf-8") as f:
+        js = f.read()
+    inline_html = re.sub(r'<link rel="stylesheet" href="/assets/[^"]+">',
+                         lambda _: f"<style>{css}</style>", html)
+    inline_html = re.sub(r'<script src="/assets/[^"]+"></script>',
+                         lambda _: f"<script>{js}</script>", inline_html)
+    inline_bytes = len(gzip.compress(inline_html.encode("utf-8"), compresslevel=6))
+
+    rtt = args.rtt_ms
+    bytes_per_ms = args.bandwidth_kbps * 1000 / 8 / 1000
+
+    def network_ms(round_trips, size):
+        return round_trips * rtt + size / bytes_per_ms
+
+    rows = [
+        ("до: первая загрузка", inline_bytes, network_ms(1, inline_bytes), page_ms),
+        ("до: повторная загрузка", inline_bytes, network_ms(1, inline_bytes), page_ms),
+        ("после: первая загрузка", page_bytes + sum(asset_sizes),
+         network_ms(2, page_bytes + sum(asset_sizes)), page_ms + asset_ms),
+        ("после: повторная загрузка", page_bytes, network_ms(1, page_bytes), page_ms),
+    ]
+    print(f"Сеть: RTT {rtt} мс, {args.bandwidth_kbps} кбит/с; размеры после gzip")
+    print(f"{'сценарий':<28} {'байт':>10} {'сеть, мс':>10} {'сервер, мс':>11}")
+    for name, size, net, server in rows:
+        print(f"{name:<28} {size:>10} {net:>10.0f} {server:>11.2f}")
+
+
+def peak_rss_mb():
+    """Пиковый RSS процесса, МБ"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def generate_chats(folder, size_mb, chat_kb):
+    """Пишет синтетические чаты общим объемом около size_mb"""
+    words = ("таверна трактирщик дракон меч стража город замок река мост король "
+             "ведьма гоблин сокровище карта лес тропа костер ночь дождь эльф гном "
+             "золото кинжал щит заклинание свиток факел пещера руины храм жрец").split()
+    rng = random.Random(1)
+    os.makedirs(folder, exist_ok=True)
+    written = 0
+    index = 0
+    while written < size_mb * 1024 * 1024:
+        messages = []
+        chat_bytes = 0
+        seq = 0
+        while chat_bytes < chat_kb * 1024:
+            seq += 1
+            content = " ".join(rng.choice(words) for _ in range(150))
+            messages.append({"role": "user" if seq % 2 else "assistant",
+                             "content": content, "seq": seq, "v": seq,
+                             "parent": seq - 1 or None})
+            chat_bytes += len(content.encode("utf-8")) + 80
+        chat = {"name": f"Кампания {index}", "turns": messages,
+                "branches": {"main": {"name": "Основная", "head": seq}},
+                "active_branch": "main", "next_seq": seq + 1, "version": seq}
+        path = os.path.join(folder, f"synthetic_{index}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(chat, f, ensure_ascii=False)
+        written += os.path.getsize(path)
+        index += 1
+    return index, written
+
+
+def bench_archive(args):
+    """Экспорт и импорт больших архивов при ограничении памяти"""
+    main = import_app()
+    if args.memory_cap_mb:
+        # Ограничиваем адресное пространство: потоковая обработка обязана уложиться
+        cap = args.memory_cap_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (cap, cap))
+
+    source = start_session(main, "archive_source")
+    with source.session_transaction() as sess:
+        folder = main.get_user_folder(sess['username'], sess['user_id'])
+    count, size = generate_chats(os.path.join(folder, "chats"), args.size_mb, args.chat_kb)
+    print(f"Данные: {count} чатов, {size / 2**20:.0f} МБ; лимит памяти "
+          f"{args.memory_cap_mb or 'нет'} МБ")
+    baseline = peak_rss_mb()
+
+    archive_path = os.path.join(os.getcwd(), "export.zip")
+    started = time.perf_counter()
+    response = source.get('/export', buffered=False)
+    with open(archive_path, "wb") as f:
+        for chunk in response.response:
+            f.write(chunk)
+    response.close()
+    export_s = time.perf_counter() - started
+    archive_size = os.path.getsize(archive_path)
+    export_rss = peak_rss_mb()
+
+    target = start_session(main, "archive_target")
+    started = time.perf_counter()
+    with open(archive_path, "rb") as f:
+        result = target.post('/import', input_stream=f, content_type='application/zip',
+                             content_length=archive_size).get_json()
+    import_s = time.perf_counter() - started
+    import_rss = peak_rss_mb()
+
+    print(f"{'этап':<10} {'время, с':>10} {'МБ/с':>8} {'пик RSS, МБ':>12}")
+    print(f"{'старт':<10} {'':>10} {'':>8} {baseline:>12.0f}")
+    print(f"{'экспорт':<10} {export_s:>10.1f} {size / 2**20 / export_s:>8.0f} {export_rss:>12.0f}")
+    print(f"{'импорт':<10} {import_s:>10.1f} {size / 2**20 / import_s:>8.0f} {import_rss:>12.0f}")
+    print(f"Архив {archive_size / 2**20:.0f} МБ; импортировано {result.get('imported')}, "
+          f"ошибок {result.get('error_count')}")
+
+
+# Выполняется в отдельном интерпретаторе: этапы холодного старта в мс
+STARTUP_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+main.create_app()
+initialized = time.perf_counter()
+response = main.app.test_client().get('/')
+first_request = time.perf_counter()
+llm_loaded = 'mistralai' in sys.modules
+main.get_llm_client()
+llm_ready = time.perf_counter()
+print(json.dumps({
+    "import": (imported - started) * 1000,
+    "create_app": (initialized - imported) * 1000,
+    "first_request": (first_request - initialized) * 1000,
+    "first_llm_client": (llm_ready - first_request) * 1000,
+    "status": response.status_code,
+    "llm_loaded_before_use": llm_loaded
+}))
+"""
+
+
+def bench_startup(args):
+    """Холодный старт: импорт main, create_app, первый запрос, первый клиент LLM"""
+    workdir = tempfile.mkdtemp(prefix="rpg-bench-")
+    os.symlink(os.path.join(REPO_DIR, "attached_assets"),
+               os.path.join(workdir, "attached_assets"))
+    env = dict(os.environ, MISTRAL_API_KEY="bench",
+               PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get("PYTHONPATH")])))
+
+    runs = []
+    for _ in range(args.runs):
+        started = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", STARTUP_PROBE], cwd=workdir, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        total = (time.perf_counter() - started) * 1000
+        result = json.loads(output.strip().splitlines()[-1])
+        result["process"] = total
+        runs.append(result)
+
+    stages = ["import", "create_app", "first_request", "first_llm_client", "process"]
+    print(f"{args.runs} запусков, медиана и максимум, мс")
+    print(f"{'этап':<18} {'медиана':>9} {'макс':>9}")
+    medians = {}
+    for stage in stages:
+        values = [run[stage] for run in runs]
+        medians[stage] = statistics.median(values)
+        print(f"{stage:<18} {medians[stage]:>9.1f} {max(values):>9.1f}")
+    if any(run["llm_loaded_before_use"] for run in runs):
+        print("mistralai загружен до первого обращения к LLM")
+        sys.exit(1)
+
+    # Порог для CI: ненулевой код возврата при регрессии
+    limits = [("import", args.max_import_ms), ("first_request", args.max_first_request_ms)]
+    failed = [(stage, limit) for stage, limit in limits if limit and medians[stage] > limit]
+    for stage, limit in failed:
+        print(f"Регрессия: {stage} {medians[stage]:.1f} мс > {limit} мс")
+    if failed:
+        sys.exit(1)
+
+
+class FakeClock:
+    """Часы, которые двигает сам бенчмарк"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def check_breaker_transitions(main):
+    """Сценарии переходов автомата защиты: [(название, пройдено)]"""
+    clock = FakeClock()
+    config = dict(main.BREAKER_CONFIG, window_s=60, min_calls=5, failure_rate=0.5,
+                  slow_call_s=10, slow_rate=0.8, open_s=30, close_after=2)
+    results = []
+
+    def new_breaker():
+        return main.CircuitBreaker(config, clock=clock)
+
+    def fail(breaker, times=1, latency=1.0):
+        for _ in range(times):
+            breaker.allow()
+            breaker.record(True, latency)
+
+    def succeed(breaker, times=1, latency=1.0):
+        for _ in range(times):
+            breaker.allow()
+            breaker.record(False, latency)
+
+    breaker = new_breaker()
+    fail(breaker, 4)
+    results.append(("меньше min_calls ошибок - closed", breaker.state == "closed"))
+    fail(breaker)
+    results.append(("доля ошибок >= порога - open", breaker.state == "open"))
+    results.append(("open отклоняет запросы", not breaker.allow()))
+    results.append(("retry_after = open_s", breaker.retry_after() == 30))
+    clock.advance(29)
+    results.append(("до истечения open_s - отказ", not breaker.allow()))
+    clock.advance(1)
+    results.append(("после open_s - пробный запрос", breaker.allow()))
+    results.append(("только один пробный запрос", not breaker.allow()))
+    breaker.record(True, 1.0)
+    results.append(("ошибка пробы - снова open", breaker.state == "open"))
+    clock.advance(30)
+    succeed(breaker)
+    results.append(("одна удачная проба - half_open", breaker.state == "half_open"))
+    succeed(breaker)
+    results.append(("close_after удачных проб - closed", breaker.state == "closed"))
+
+    breaker = new_breaker()
+    succeed(breaker, 3)
+    fail(breaker, 2)
+    results.append(("доля ошибок ниже порога - closed", breaker.state == "closed"))
+
+    breaker = new_breaker()
+    succeed(breaker, 5, latency=12)
+    results.append(("медленные ответы - open", breaker.state == "open"))
+    clock.advance(30)
+    breaker.allow()
+    breaker.record(False, 12)
+    results.append(("медленная проба - снова open", breaker.state == "open"))
+
+    breaker = new_breaker()
+    fail(breaker, 3)
+    clock.advance(61)
+    fail(breaker, 2)
+    results.append(("ошибки старше window_s не считаются", breaker.state == "closed"))
+    return results
+
+
+def simulate_outage(main, breaker, args):
+    """Поток запросов к провайдеру, недоступному в [outage_start, outage_start + outage_s)
+
+    Возвращает (секунды ожидания запросов, запросов к провайдеру, время ожидания
+    каждого запроса, момент возврата к closed после восстановления).
+    """
+    clock = breaker.clock if breaker else FakeClock()
+    outage_end = args.outage_start + args.outage_s
+    arrivals = [i / args.rps for i in range(int(args.duration_s * args.rps))]
+    completions = []
+    waits = []
+    provider_calls = 0
+    recovered_at = None
+
+    def drain(until):
+        while completions and completions[0][0] <= until:
+            finished, failed, latency = heapq.heappop(completions)
+            clock.now = finished
+            if breaker:
+                breaker.record(failed, latency)
+
+    for arrival in arrivals:
+        drain(arrival)
+        clock.now = arrival
+        if breaker and not breaker.allow():
+            waits.append(0.0)
+            continue
+        down = args.outage_start <= arrival < outage_end
+        latency = args.timeout_s if down else args.latency_s
+        provider_calls += 1
+        waits.append(latency)
+        heapq.heappush(completions, (arrival + latency, down, latency))
+        if breaker and recovered_at is None and arrival >= outage_end \
+                and breaker.state == "closed":
+            recovered_at = arrival
+    drain(float("inf"))
+    return sum(waits), provider_calls, waits, recovered_at
+
+
+def bench_breaker(args):
+    """Автомат защиты LLM: переходы на фиктивных часах и симуляция сбоя провайдера"""
+    main = import_app()
+    results = check_breaker_transitions(main)
+    for name, passed in results:
+        print(f"{'ok ' if passed else 'FAIL'} {name}")
+
+    config = dict(main.BREAKER_CONFIG, slow_call_s=args.timeout_s)
+    rows = [("без автомата", simulate_outage(main, None, args)),
+            ("с автоматом", simulate_outage(main, main.CircuitBreaker(config, clock=FakeClock()),
+                                            args))]
+    outage_end = args.outage_start + args.outage_s
+    print(f"\nСбой {args.outage_s:.0f} с из {args.duration_s:.0f} с, {args.rps} запр/с, "
+          f"таймаут {args.timeout_s:.0f} с")
+    print(f"{'':<14} {'ожидание, с':>12} {'к провайдеру':>13} {'p95 ожид., с':>13} "
+          f"{'закрыт через, с':>16}")
+    for name, (waited, calls, waits, recovered_at) in rows:
+        waits = sorted(waits)
+        recovery = f"{recovered_at - outage_end:.0f}" if recovered_at is not None else "-"
+        print(f"{name:<14} {waited:>12.0f} {calls:>13} "
+              f"{waits[int(0.95 * (len(waits) - 1))]:>13.1f} {recovery:>16}")
+
+    if not all(passed for _, passed in results):
+        sys.exit(1)
+
+
+class LatencyStub:
+    """Заглушка потокового API Mistral с задержкой первого токена из распределения
+
+    Считает отправленные запросы и потоки, закрытые до конца (отмененные дубли).
+    """
+
+    class _Event:
+        def __init__(self, text):
+            delta = type("Delta", (), {"content": text})()
+            choice = type("Choice", (), {"delta": delta})()
+            self.data = type("Data", (), {"choices": [choice], "usage": None})()
+
+    class _Stream:
+        def __init__(self, stub, first_token_s):
+            self.stub = stub
+            self.first_token_s = first_token_s
+            self.closed = False
+
+        def __iter__(self):
+            return self._events()
+
+        def _events(self):
+            time.sleep(self.first_token_s)
+            for _ in range(self.stub.tokens):
+                if self.closed:
+                    return
+                yield LatencyStub._Event("слово ")
+                time.sleep(self.stub.token_s)
+
+        def __exit__(self, *exc):
+            if not self.closed:
+                self.closed = True
+                with self.stub.lock:
+                    self.stub.closed += 1
+
+    def __init__(self, sample_first_token, tokens=20, token_s=0.0005):
+        self.sample_first_token = sample_first_token
+        self.tokens = tokens
+        self.token_s = token_s
+        self.calls = 0
+        self.closed = 0
+        self.lock = threading.Lock()
+        self.chat = self
+
+    def stream(self, model, messages, **kwargs):
+        with self.lock:
+            self.calls += 1
+        return LatencyStub._Stream(self, self.sample_first_token())
+
+
+def first_token_sampler(args, rng):
+    """Время до первого токена, с (в масштабе --scale)"""
+    def lognormal():
+        return rng.lognormvariate(math.log(args.median_s), 0.4) * args.scale
+
+    def stall():
+        # Обычный ответ, но изредка провайдер "залипает" на десятки секунд
+        if rng.random() < args.stall_rate:
+            return rng.uniform(args.stall_s / 2, args.stall_s) * args.scale
+        return lognormal()
+
+    return {"lognormal": lognormal, "stall": stall}[args.distribution]
+
+
+def simulate_hedging(main, args, config):
+    """Прогоняет запросы через open_llm_stream: (мс до ответа, стат. заглушки и политики)"""
+    rng = random.Random(args.seed)
+    stub = LatencyStub(first_token_sampler(args, rng))
+    policy = main.HedgePolicy(config)
+    lock = threading.Lock()
+    durations = []
+
+    def one_request(_):
+        started = time.perf_counter()
+        stream, events = main.open_llm_stream(stub, "bench-model", [], 60000, policy=policy)
+        try:
+            for _event in events:
+                pass
+        finally:
+            main.close_llm_stream(stream)
+        with lock:
+            durations.append((time.perf_counter() - started) * 1000 / args.scale / 1000)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one_request, range(args.requests)))
+    return durations, stub, policy.snapshot()
+
+
+def bench_hedge(args):
+    """Hedging запросов к LLM на заглушке с заданным распределением задержек"""
+    main = import_app()
+    main.shutdown_logging()
+    logging.getLogger().setLevel(logging.CRITICAL + 1)
+
+    base = dict(main.HEDGE_CONFIG, percentile=args.percentile,
+                min_delay_s=args.min_delay_s * args.scale, min_samples=20)
+    configs = [("без дублей", dict(base, enabled=False))]
+    for budget in args.budgets:
+        configs.append((f"дубли, бюджет {budget:.0%}", dict(base, enabled=True, budget=budget)))
+
+    print(f"{args.requests} запросов по {args.concurrency} параллельно, распределение "
+          f"{args.distribution}, задержки в секундах модели (масштаб {args.scale})")
+    print(f"{'':<20} {'p50, с':>8} {'p95, с':>8} {'p99, с':>8} {'макс, с':>8} "
+          f"{'доп. запросы':>13} {'дубль быстрее':>14} {'отказ бюджета':>14}")
+    failed = False
+    for name, config in configs:
+        durations, stub, snapshot = simulate_hedging(main, args, config)
+        durations.sort()
+
+        def percentile(p):
+            return durations[min(len(durations) - 1, int(len(durations) * p))]
+
+        extra = stub.calls / args.requests - 1
+        print(f"{name:<20} {percentile(0.5):>8.2f} {percentile(0.95):>8.2f} "
+              f"{percentile(0.99):>8.2f} {durations[-1]:>8.2f} {extra:>13.1%} "
+              f"{snapshot['hedge_wins']:>14} {snapshot['denied']:>14}")
+        if config["enabled"]:
+            # Долю дублей ограничивает бюджет (плюс начальный запас burst)
+            allowed = config["budget"] + config["burst"] / args.requests
+            if extra > allowed + 1e-9:
+                print(f"FAIL доля дублей {extra:.1%} > бюджета {allowed:.1%}")
+                failed = True
+    if failed:
+        sys.exit(1)
+
+
+# Выполняется в отдельном интерпретаторе: приложение на настоящем HTTP-сервере
+LOAD_SERVER = """
+import logging, sys
+import main
+main.create_app()
+logging.getLogger('werkzeug').setLevel(logging.ERROR)
+main.app.run(host='127.0.0.1', port=int(sys.argv[1]), threaded=True, use_reloader=False)
+"""
+
+PLAYER_MESSAGES = (
+    "Я захожу в таверну и осматриваюсь по сторонам.",
+    "Подхожу к трактирщику и спрашиваю о слухах.",
+    "Осматриваю странного путника в углу.",
+    "Выхожу на улицу и иду к воротам города.",
+    "Достаю карту и ищу путь к старой башне.",
+)
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+class LoadPlayer:
+    """Игрок нагрузочного теста: своя cookie-сессия и замеры по маршрутам"""
+
+    def __init__(self, base_url, results, lock, timeout_s):
+        self.base_url = base_url
+        self.results = results
+        self.lock = lock
+        self.timeout_s = timeout_s
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def call(self, path, payload):
+        """POST JSON; ответ с полем error (приложение отдает его со статусом 200) - ошибка"""
+        request = urllib.request.Request(
+            self.base_url + path, data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"}, method="POST")
+        started = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=self.timeout_s) as response:
+                data = json.loads(response.read() or b"{}")
+            ok = not data.get("error")
+        except (OSError, ValueError):
+            data, ok = {}, False
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            route = self.results.setdefault(path, {"durations": [], "errors": 0})
+            route["durations"].append(elapsed)
+            route["errors"] += not ok
+        return data if ok else None
+
+    def play(self, name, args, rng):
+        """Сессия игрока: вход, персонаж, начало игры и turns ходов с паузами"""
+        credentials = {"username": name, "password": "load-password"}
+        self.call("/register", credentials)
+        if self.call("/login", credentials) is None:
+            return
+        self.call("/upload_character", {"character_name": "Бор",
+                                        "file_content": '{"name": "Бор", "class": "Воин"}'})
+        chat_id = f"load_{name}"
+        self.call("/create_chat", {"chat_id": chat_id})
+        self.call("/load_character", {"filename": "Бор", "chat_id": chat_id})
+        if self.call("/start_game_with_character", {"chat_id": chat_id}) is None:
+            return
+        for _ in range(args.turns):
+            time.sleep(rng.uniform(args.think_s / 2, args.think_s * 1.5))
+            self.call("/send_message", {"chat_id": chat_id,
+                                        "message": rng.choice(PLAYER_MESSAGES)})
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_load_target(stub_url):
+    """Запускает приложение во временной папке с заглушкой вместо Mistral: (процесс, адрес)"""
+    workdir = tempfile.mkdtemp(prefix="rpg-bench-")
+    os.symlink(os.path.join(REPO_DIR, "attached_assets"),
+               os.path.join(workdir, "attached_assets"))
+    env = dict(os.environ, MISTRAL_API_KEY="stub", MISTRAL_SERVER_URL=stub_url,
+               PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get("PYTHONPATH")])))
+    port = free_port()
+    log = open(os.path.join(workdir, "server.log"), "w")
+    process = subprocess.Popen([sys.executable, "-c", LOAD_SERVER, str(port)], cwd=workdir,
+                               env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            urllib.request.urlopen(base_url + "/", timeout=1).close()
+            return process, base_url
+        except urllib.error.HTTPError:
+            # Сервер отвечает - значит, запущен
+            return process, base_url
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                print(f"Приложение не запустилось, журнал: {log.name}")
+                sys.exit(1)
+            time.sleep(0.2)
+
+
+def bench_load(args):
+    """Сквозная нагрузка: игроки по HTTP против приложения с заглушкой Mistral"""
+    stub_server = process = None
+    if args.url:
+        # Приложение уже запущено (с MISTRAL_SERVER_URL на заглушку или без)
+        base_url = args.url.rstrip("/")
+    else:
+        stub_server, stub_url = mistral_stub.start_stub(args)
+        process, base_url = start_load_target(stub_url)
+
+    results = {}
+    lock = threading.Lock()
+    rng = random.Random(args.seed)
+    run_id = int(time.time())
+
+    def one_player(index):
+        # Игроки подключаются постепенно, за ramp_s секунд
+        time.sleep(args.ramp_s * index / max(1, args.players))
+        player = LoadPlayer(base_url, results, lock, args.timeout_s)
+        player.play(f"load{run_id}_{index}", args, random.Random(rng.random()))
+
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.players) as pool:
+            list(pool.map(one_player, range(args.players)))
+    finally:
+        elapsed = time.perf_counter() - started
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+
+    total = sum(len(route["durations"]) for route in results.values())
+    errors = sum(route["errors"] for route in results.values())
+    print(f"{args.players} игроков по {args.turns} ходов, {elapsed:.1f} с, "
+          f"{total} запросов, {total / elapsed:.1f} запр/с, ошибок {errors}")
+    print(f"{'маршрут':<28} {'запросов':>9} {'ошибок':>7} {'запр/с':>7} "
+          f"{'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'макс, мс':>9}")
+    for path, route in results.items():
+        durations = sorted(route["durations"])
+        print(f"{path:<28} {len(durations):>9} {route['errors']:>7} "
+              f"{len(durations) / elapsed:>7.2f} {percentile(durations, 0.5) * 1000:>9.0f} "
+              f"{percentile(durations, 0.95) * 1000:>9.0f} "
+              f"{percentile(durations, 0.99) * 1000:>9.0f} {durations[-1] * 1000:>9.0f}")
+    if stub_server is not None:
+        print("заглушка Mistral:", json.dumps(stub_server.stub.snapshot(), ensure_ascii=False))
+        stub_server.shutdown()
+
+    # Порог для CI: ненулевой код возврата при регрессии
+    failed = False
+    if args.max_error_rate and total and errors / total > args.max_error_rate:
+        print(f"Регрессия: доля ошибок {errors / total:.1%} > {args.max_error_rate:.1%}")
+        failed = True
+    turns = sorted(results.get("/send_message", {}).get("durations", []))
+    if args.max_turn_p95_ms and turns and percentile(turns, 0.95) * 1000 > args.max_turn_p95_ms:
+        print(f"Регрессия: p95 /send_message {percentile(turns, 0.95) * 1000:.0f} мс > "
+              f"{args.max_turn_p95_ms} мс")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    logging_parser = subparsers.add_parser("logging", help=bench_logging.__doc__)
+    logging_parser.add_argument("--requests", type=int, default=400)
+    logging_parser.set_defaults(func=bench_logging)
+
+    assets_parser = subparsers.add_parser("assets", help=bench_assets.__doc__)
+    assets_parser.add_argument("--rtt-ms", type=float, default=100)
+    assets_parser.add_argument("--bandwidth-kbps", type=float, default=1600)
+    assets_parser.set_defaults(func=bench_assets)
+
+    archive_parser = subparsers.add_parser("archive", help=bench_archive.__doc__)
+    archive_parser.add_argument("--size-mb", type=int, default=2048)
+    archive_parser.add_argument("--chat-kb", type=int, default=1024)
+    archive_parser.add_argument("--memory-cap-mb", type=int, default=768,
+                                help="0 - без ограничения")
+    archive_parser.set_defaults(func=bench_archive)
+
+    startup_parser = subparsers.add_parser("startup", help=bench_startup.__doc__)
+    startup_parser.add_argument("--runs", type=int, default=10)
+    startup_parser.add_argument("--max-import-ms", type=float, default=0,
+                                help="0 - без проверки")
+    startup_parser.add_argument("--max-first-request-ms", type=float, default=0,
+                                help="0 - без проверки")
+    startup_parser.set_defaults(func=bench_startup)
+
+    breaker_parser = subparsers.add_parser("breaker", help=bench_breaker.__doc__)
+    breaker_parser.add_argument("--rps", type=float, default=2)
+    breaker_parser.add_argument("--duration-s", type=float, default=300)
+    breaker_parser.add_argument("--outage-start", type=float, default=60)
+    breaker_parser.add_argument("--outage-s", type=float, default=120)
+    breaker_parser.add_argument("--timeout-s", type=float, default=30)
+    breaker_parser.add_argument("--latency-s", type=float, default=3)
+    breaker_parser.set_defaults(func=bench_breaker)
+
+    hedge_parser = subparsers.add_parser("hedge", help=bench_hedge.__doc__)
+    hedge_parser.add_argument("--requests", type=int, default=2000)
+    hedge_parser.add_argument("--concurrency", type=int, default=16)
+    hedge_parser.add_argument("--distribution", choices=["lognormal", "stall"],
+                              default="stall")
+    hedge_parser.add_argument("--median-s", type=float, default=2)
+    hedge_parser.add_argument("--stall-rate", type=float, default=0.02)
+    hedge_parser.add_argument("--stall-s", type=float, default=40)
+    hedge_parser.add_argument("--percentile", type=float, default=95)
+    hedge_parser.add_argument("--min-delay-s", type=float, default=1)
+    hedge_parser.add_argument("--budgets", type=float, nargs="+", default=[0.05, 0.1])
+    hedge_parser.add_argument("--scale", type=float, default=0.01,
+                              help="секунд реального времени на секунду модели")
+    hedge_parser.add_argument("--seed", type=int, default=1)
+    hedge_parser.set_defaults(func=bench_hedge)
+
+    load_parser = subparsers.add_parser("load", help=bench_load.__doc__)
+    load_parser.add_argument("--url", help="уже запущенное приложение; по умолчанию "
+                                           "запускается свое с заглушкой Mistral")
+    load_parser.add_argument("--players", type=int, default=20)
+    load_parser.add_argument("--turns", type=int, default=10)
+    load_parser.add_argument("--think-s", type=float, default=2)
+    load_parser.add_argument("--ramp-s", type=float, default=10)
+    load_parser.add_argument("--timeout-s", type=float, default=120)
+    load_parser.add_argument("--max-error-rate", type=float, default=0,
+                             help="0 - без проверки")
+    load_parser.add_argument("--max-turn-p95-ms", type=float, default=0,
+                             help="0 - без проверки")
+    # Поведение заглушки - те же параметры, что у mistral_stub.py
+    mistral_stub.add_stub_arguments(load_parser)
+    load_parser.set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    run()
@@ -1,26 +1,265 @@
-import requests
 import json
 import os
 import sqlite3
 import hashlib
 import secrets
+import gzip
+import codecs
+import html
+import io
+import itertools
+import shutil
+import tempfile
+import zipfile
 import logging
-from datetime import datetime, timedelta
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+import re
+import queue
+import select
+import socket
+import atexit
+import sys
+import time
+import threading
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from logging.handlers import QueueHandler, QueueListener
+from flask import Flask, Response, render_template, request, jsonify, session, redirect, url_for, g, send_from_directory, abort, has_request_context
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.security import generate_password_hash, check_password_hash
-from mistralai import Mistral
+from werkzeug.test import EnvironBuilder
+
+# Клиент Mistral (mistralai вместе с httpx и pydantic) импортируется при первом
+# запросе к LLM - см. get_llm_client
+Mistral = None
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен - без него сжимаем только gzip
+    brotli = None
+
+try:
+    from flask_sock import Sock
+    from simple_websocket import ConnectionClosed
+except ImportError:  # flask-sock необязателен - без него работает только REST
+    Sock = None
 
 # Настройка логирования
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+# LOG_LEVEL - уровень (INFO по умолчанию), LOG_FORMAT - json или text,
+# LOG_DEBUG_SAMPLE_RATE - доля сохраняемых DEBUG-событий,
+# LOG_SAMPLE_RATES - доли для отдельных событий: "send_message=0.01,llm_request=0.1"
+DEFAULT_EVENT_SAMPLE_RATES = {
+    "send_message": 0.1,
+    "load_character": 0.1,
+    "llm_request": 0.1,
+    "context_ok": 0.05,
+}
+
+
+def parse_sample_rates(value):
+    """Разбирает строку вида event=rate,event=rate"""
+    rates = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        event, rate = item.split("=", 1)
+        try:
+            rates[event.strip()] = float(rate)
+        except ValueError:
+            continue
+    return rates
+
+
+LOG_CONFIG = {
+    "level": os.environ.get("LOG_LEVEL", "INFO").upper(),
+    "format": os.environ.get("LOG_FORMAT", "json"),
+    "debug_sample_rate": float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", "1.0")),
+    "event_sample_rates": {
+        **DEFAULT_EVENT_SAMPLE_RATES,
+        **parse_sample_rates(os.environ.get("LOG_SAMPLE_RATES", ""))
+    },
+}
+
+# Стандартные поля LogRecord - все остальное считаем структурными полями (extra=...)
+_LOG_RECORD_FIELDS = set(
+    logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {
+        "message", "asctime", "event", "sample_rate"
+    }
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Форматирует запись лога в одну JSON-строку"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "event": getattr(record, "event", None),
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_FIELDS:
+                entry[key] = value
+        if getattr(record, "sample_rate", 1.0) < 1.0:
+            entry["sample_rate"] = record.sample_rate
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class EventSamplingFilter(logging.Filter):
+    """Пропускает только долю DEBUG-событий
+
+    Событие определяется полем extra={"event": ...}, а если его нет - шаблоном
+    сообщения. Семплирование детерминированное: сохраняется каждое N-е событие.
+    """
+
+    def __init__(self, default_rate=1.0, event_rates=None):
+        super().__init__()
+        self.default_rate = default_rate
+        self.event_rates = event_rates or {}
+        self._counters = Counter()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        event = getattr(record, "event", None) or record.msg
+        rate = self.event_rates.get(event, self.default_rate)
+        if rate >= 1.0:
+            return True
+        if rate <= 0:
+            return False
+        # Counter не потокобезопасен, но для семплирования неточность не важна
+        self._counters[event] += 1
+        if (self._counters[event] - 1) % round(1 / rate):
+            return False
+        record.sample_rate = rate
+        return True
+
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler, который не форматирует сообщение в потоке запроса
+
+    Стандартный QueueHandler.prepare() вызывает format() - то есть все
+    форматирование происходит на горячем пути. Здесь в очередь уходит запись
+    с шаблоном и аргументами, а форматирует ее фоновый QueueListener.
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            # Трейсбек нужно отрисовать сейчас, пока живы кадры стека
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_log_listener = None
+
+
+def setup_logging(level=None, log_format=None, stream=None):
+    """Настраивает корневой логгер: очередь + фоновый писатель
+
+    Можно вызывать повторно - предыдущий фоновый писатель останавливается.
+    """
+    global _log_listener
+
+    level = level or LOG_CONFIG["level"]
+    log_format = log_format or LOG_CONFIG["format"]
+
+    if _log_listener:
+        _log_listener.stop()
+        _log_listener = None
+
+    output_handler = logging.StreamHandler(stream or sys.stderr)
+    if log_format == "json":
+        output_handler.setFormatter(JsonLogFormatter())
+    else:
+        output_handler.setFormatter(
+            logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    queue_handler = DeferredQueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(
+        EventSamplingFilter(LOG_CONFIG["debug_sample_rate"],
+                            LOG_CONFIG["event_sample_rates"]))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _log_listener = QueueListener(queue_handler.queue, output_handler)
+    _log_listener.start()
+    return _log_listener
+
+
+def shutdown_logging():
+    """Дописывает оставшиеся в очереди записи и останавливает писатель"""
+    global _log_listener
+    if _log_listener:
+        _log_listener.stop()
+        _log_listener = None
+
+
 logger = logging.getLogger(__name__)
 
 API_KEY = os.environ.get("MISTRAL_API_KEY")
+# Другой адрес API - например, локальная заглушка mistral_stub.py для нагрузочных тестов
+MISTRAL_SERVER_URL = os.environ.get("MISTRAL_SERVER_URL")
 MODEL = "mistral-large-latest"
 
+# Маршруты запросов к моделям по типу задачи: (основная модель, запасная,
+# таймаут в секундах). Запасная модель отвечает, пока основная ограничивает
+# скорость (429). Переопределяются переменными MODEL_<ЗАДАЧА>,
+# MODEL_<ЗАДАЧА>_FALLBACK (пустая строка - без запасной) и MODEL_<ЗАДАЧА>_TIMEOUT_S,
+# например MODEL_CHARACTER_CREATION=mistral-large-latest.
+DEFAULT_MODEL_ROUTES = {
+    "narration": (MODEL, "mistral-medium-latest", 90),
+    "character_creation": ("mistral-small-latest", MODEL, 45),
+    "summarization": ("mistral-small-latest", "ministral-8b-latest", 45),
+    "chat_naming": ("ministral-8b-latest", "mistral-small-latest", 15),
+    "extraction": ("mistral-small-latest", MODEL, 30),
+}
+# Сколько секунд после 429 маршрут не обращается к основной модели
+MODEL_RATE_LIMIT_COOLDOWN_S = float(os.environ.get("MODEL_RATE_LIMIT_COOLDOWN_S", "30"))
+
+
+def load_model_routes():
+    routes = {}
+    for route, (model, fallback, timeout) in DEFAULT_MODEL_ROUTES.items():
+        prefix = f"MODEL_{route.upper()}"
+        routes[route] = {
+            "model": os.environ.get(prefix, model),
+            "fallback": os.environ.get(f"{prefix}_FALLBACK", fallback) or None,
+            "timeout_s": float(os.environ.get(f"{prefix}_TIMEOUT_S", timeout))
+        }
+    return routes
+
+
+MODEL_ROUTES = load_model_routes()
+
 app = Flask(__name__)
 app.secret_key = secrets.token_hex(16)
 
+
+@app.before_request
+def ensure_app_initialized():
+    """Инициализация для серверов, импортирующих main:app без create_app()"""
+    if not app_initialized:
+        create_app()
+
+
+@app.before_request
+def drop_legacy_session_state():
+    """Копии истории и системного промпта из старых cookie сессии больше не нужны"""
+    for key in ('conversation_history', 'system_prompt'):
+        session.pop(key, None)
+
 # Глобальная конфигурация контекста (только в коде)
 CONTEXT_CONFIG = {
     "max_messages": 50,
@@ -39,6 +278,18 @@ def init_db():
                   username TEXT UNIQUE NOT NULL,
                   password_hash TEXT NOT NULL,
                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    # Расход LLM по дням (см. UsageAccountant)
+    c.execute('''CREATE TABLE IF NOT EXISTS llm_usage
+                 (day TEXT NOT NULL,
+                  user_id INTEGER NOT NULL,
+                  chat_id TEXT NOT NULL,
+                  route TEXT NOT NULL,
+                  model TEXT NOT NULL,
+                  requests INTEGER NOT NULL DEFAULT 0,
+                  prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                  completion_tokens INTEGER NOT NULL DEFAULT 0,
+                  llm_ms INTEGER NOT NULL DEFAULT 0,
+                  PRIMARY KEY (day, user_id, chat_id, route, model))''')
     conn.commit()
     conn.close()
 
@@ -59,6 +310,506 @@ def get_user_folder(username, user_id):
     return os.path.join("user_data", folder_name)
 
 
+# Версии хранилища: (папка пользователя, раздел) -> (версия, время изменения).
+# Раздел - "chats", "characters" или "saves". Версия увеличивается при каждой
+# записи в раздел, поэтому по ней можно ответить 304, не трогая файлы.
+# Версии живут в памяти процесса; эпоха отличает их от версий прошлого запуска.
+STORAGE_EPOCH = secrets.token_hex(4)
+STORAGE_STARTED_AT = datetime.now(timezone.utc).replace(microsecond=0)
+storage_versions = {}
+storage_versions_lock = threading.Lock()
+
+
+def bump_storage_version(kind, user_folder=None, refresh=None):
+    """Отмечает изменение раздела хранилища пользователя
+
+    refresh(index) -> новый индекс раздела: кэшированный индекс обновляется
+    на месте вместо полного перестроения (write-through).
+    """
+    if user_folder is None:
+        user_folder = get_user_folder(session['username'], session['user_id'])
+    with storage_versions_lock:
+        version, _ = storage_versions.get((user_folder, kind), (0, None))
+        storage_versions[(user_folder, kind)] = (version + 1,
+                                                 datetime.now(timezone.utc))
+    # Устаревшие записи кэша больше не нужны - освобождаем память сразу
+    user_cache.advance(user_folder, kind, version, version + 1, refresh)
+    # Папка пользователя называется username@user_id
+    publish_user_event(user_folder.rsplit('@', 1)[-1], "storage_changed", {"kind": kind})
+
+
+def get_storage_version(kind, user_folder=None):
+    """Возвращает (версия, время последнего изменения) раздела"""
+    if user_folder is None:
+        user_folder = get_user_folder(session['username'], session['user_id'])
+    version, modified_at = storage_versions.get((user_folder, kind), (0, None))
+    return version, modified_at or STORAGE_STARTED_AT
+
+
+# Индексы хранилища строятся за один проход по папке раздела и кэшируются
+# до следующего изменения версии раздела. Кэш общий на процесс и ограничен:
+# записи неактивных дольше idle_ttl_s вытесняются, а при превышении max_bytes
+# (размер оценивается по JSON записи) уходят давно не читавшиеся (LRU).
+# Изменение раздела (bump_storage_version) сразу удаляет его записи.
+USER_CACHE_CONFIG = {
+    "max_bytes": int(float(os.environ.get("USER_CACHE_MB", "64")) * 1024 * 1024),
+    "idle_ttl_s": float(os.environ.get("USER_CACHE_IDLE_S", "1800"))
+}
+
+
+class UserDataCache:
+    """LRU-кэш данных пользователей: (папка, имя) -> значение для версий разделов"""
+
+    def __init__(self, config=USER_CACHE_CONFIG, clock=time.monotonic):
+        self.config = config
+        self.clock = clock
+        # (папка, имя) -> [версии, значение, байт, последнее чтение]
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def _drop(self, key):
+        entry = self.entries.pop(key)
+        self.size -= entry[2]
+
+    def _evict(self, now):
+        evicted = 0
+        # Самые старые по чтению - в начале
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if (self.size <= self.config["max_bytes"]
+                    and now - entry[3] < self.config["idle_ttl_s"]):
+                break
+            self._drop(key)
+            evicted += 1
+        if evicted:
+            record_metric("user_cache_evictions", evicted)
+
+    def get(self, user_folder, name, versions, builder):
+        """Значение из кэша, если версии разделов не менялись, иначе builder()"""
+        key = (user_folder, name)
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == versions:
+                entry[3] = now
+                self.entries.move_to_end(key)
+                self._evict(now)
+                record_metric("user_cache_hits")
+                return entry[1]
+        record_metric("user_cache_misses")
+
+        value = builder()
+        size = len(json.dumps(value, ensure_ascii=False, default=str))
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            if size <= self.config["max_bytes"]:
+                self.entries[key] = [versions, value, size, now]
+                self.size += size
+            self._evict(now)
+        return value
+
+    def advance(self, user_folder, kind, old_version, new_version, refresh=None):
+        """Раздел kind сменил версию: индекс раздела обновляется refresh, остальное удаляется
+
+        Индекс обновляется, только если он построен ровно для old_version -
+        иначе параллельное изменение могло потеряться, и он тоже удаляется.
+        """
+        # Размер нового значения оценивается JSON вне блокировки: иначе каждое
+        # сохранение любого пользователя ждало бы сериализации чужого индекса
+        current = []
+        with self.lock:
+            for key in [key for key, entry in self.entries.items()
+                        if key[0] == user_folder and kind in dict(entry[0])]:
+                entry = self.entries[key]
+                if refresh is None or key[1] != kind or entry[0] != ((kind, old_version),):
+                    self._drop(key)
+                else:
+                    current.append((key, entry[1]))
+
+        refreshed = []
+        for key, old_value in current:
+            value = refresh(old_value)
+            refreshed.append((key, old_value, value, len(json.dumps(value, ensure_ascii=False, default=str))))
+
+        with self.lock:
+            for key, old_value, value, size in refreshed:
+                entry = self.entries.get(key)
+                # Запись успели пересобрать или удалить - она уже не старее нашей
+                if entry is None or entry[1] is not old_value or entry[0] != ((kind, old_version),):
+                    continue
+                self.size += size - entry[2]
+                entry[:3] = [((kind, new_version),), value, size]
+            self._evict(self.clock())
+
+    def snapshot(self):
+        with self.lock:
+            self._evict(self.clock())
+            return {
+                "entries": len(self.entries),
+                "users": len({user_folder for user_folder, _ in self.entries}),
+                "bytes": self.size,
+                "max_bytes": self.config["max_bytes"]
+            }
+
+
+user_cache = UserDataCache()
+
+
+# Холодные чаты: давно не менявшиеся чаты обслуживание (см. run_storage_maintenance)
+# сжимает в chats/<id>.json.gz. Читаются они так же, как обычные; первая запись
+# возвращает чат в обычный .json и удаляет сжатую копию.
+COLD_SUFFIX = ".gz"
+
+
+def iter_json_files(folder):
+    """Файлы данных папки: (имя без расширения, путь, функция открытия)
+
+    Сжатая копия пропускается, если рядом есть обычный файл - он новее.
+    """
+    if not os.path.exists(folder):
+        return
+    with os.scandir(folder) as it:
+        for entry in it:
+            if entry.name.endswith('.json'):
+                name, opener = entry.name[:-5], open
+            elif entry.name.endswith('.json' + COLD_SUFFIX):
+                if os.path.exists(entry.path[:-len(COLD_SUFFIX)]):
+                    continue
+                name, opener = entry.name[:-5 - len(COLD_SUFFIX)], gzip.open
+            else:
+                continue
+            if entry.is_file():
+                yield name, entry.path, opener
+
+
+def read_json_file(path):
+    """Читает JSON из обычного или сжатого (.gz) файла"""
+    opener = gzip.open if path.endswith(COLD_SUFFIX) else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def find_chat_file(user_folder, chat_id):
+    """Путь к файлу чата (обычному или холодному), None если чата нет"""
+    filepath = os.path.join(user_folder, "chats", f"{chat_id}.json")
+    for path in (filepath, filepath + COLD_SUFFIX):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def scan_json_folder(folder):
+    """Читает .json файлы папки по одному: (имя без .json, данные)
+
+    Генератор - в памяти держится только текущий файл.
+    """
+    for name, path, opener in iter_json_files(folder):
+        try:
+            with opener(path, 'rt', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception:
+            continue
+        yield name, data
+
+
+def chat_manifest(chat_id, chat_data):
+    """Запись манифеста чата: все кроме самих сообщений"""
+    messages = active_chat_path(chat_data)
+    return {
+        "name": chat_data.get('name', chat_id),
+        "character_id": chat_data.get('character_id'),
+        # Старые чаты хранят имя персонажа прямо в файле
+        "character_name": chat_data.get('character_name'),
+        "created_at": chat_data.get('created_at'),
+        "version": chat_data.get('version', 0),
+        "branch_count": len(chat_data.get('branches', {})) or 1,
+        "message_count": len(messages),
+        "last_message": messages[-1].get('content', '')[:50] if messages else None
+    }
+
+
+def build_chats_index(user_folder):
+    """Манифест чатов: chat_id -> chat_manifest
+
+    Для чатов в памяти файл может отставать - их манифест строится по памяти.
+    """
+    index = {chat_id: chat_manifest(chat_id, chat_data) for chat_id, chat_data
+             in scan_json_folder(os.path.join(user_folder, "chats"))}
+    for chat_id, chat_data in game_states.active_chats(user_folder):
+        index[chat_id] = chat_manifest(chat_id, chat_data)
+    return index
+
+
+def build_characters_index(user_folder):
+    """Индекс персонажей: имя файла -> запись персонажа"""
+    index = {}
+    for filename, char_data in scan_json_folder(os.path.join(user_folder, "characters")):
+        index[filename] = {
+            "filename": filename,
+            "id": char_data.get('id'),
+            "name": char_data.get('name', filename),
+            "description": char_data.get('description', ''),
+            "created_at": char_data.get('created_at')
+        }
+    return index
+
+
+def build_saves_index(user_folder):
+    """Индекс сохранений: имя файла -> краткая информация"""
+    index = {}
+    for filename, save_data in scan_json_folder(os.path.join(user_folder, "saves")):
+        index[filename] = {
+            "filename": filename,
+            "timestamp": save_data.get('timestamp', 'Неизвестно'),
+            "character_name": save_data.get('character_name', 'Неизвестный персонаж'),
+            "chat_id": save_data.get('chat_id')
+        }
+    return index
+
+
+STORAGE_INDEX_BUILDERS = {
+    "chats": build_chats_index,
+    "characters": build_characters_index,
+    "saves": build_saves_index,
+}
+
+
+def cached_user_data(name, kinds, builder, user_folder=None):
+    """Данные пользователя, построенные builder(user_folder) по разделам kinds
+
+    Перестраиваются только после изменения одного из разделов.
+    """
+    if user_folder is None:
+        user_folder = get_user_folder(session['username'], session['user_id'])
+    versions = tuple((kind, get_storage_version(kind, user_folder)[0]) for kind in kinds)
+    return user_cache.get(user_folder, name, versions, lambda: builder(user_folder))
+
+
+def get_storage_index(kind, user_folder=None):
+    """Возвращает индекс раздела, перестраивая его только после изменений"""
+    return cached_user_data(kind, (kind,), STORAGE_INDEX_BUILDERS[kind], user_folder)
+
+
+# События для открытых вкладок пользователя (WebSocket)
+WS_CONFIG = {
+    "heartbeat_interval": 25,
+    "heartbeat_timeout": 75,
+    "event_buffer": 200,
+    # Канал без подключений живет столько, чтобы вкладка успела переподключиться
+    "channel_idle_ttl": 600,
+}
+
+
+class UserEventChannel:
+    """Поток событий одного пользователя для всех его WebSocket-подключений
+
+    Буферизуемые события получают event_seq, последние event_buffer из них
+    хранятся, чтобы после переподключения дослать пропущенное. Временные события
+    (статус генерации, части ответа) рассылаются без номера и не хранятся.
+    """
+
+    def __init__(self, buffer_size):
+        self.lock = threading.Lock()
+        self.next_seq = 1
+        self.events = deque(maxlen=buffer_size)
+        self.connections = set()
+        self.last_active = time.monotonic()
+
+    def publish(self, event_type, payload, buffered=True):
+        event = {"type": event_type, **payload}
+        with self.lock:
+            if buffered:
+                event["event_seq"] = self.next_seq
+                self.next_seq += 1
+                self.events.append(event)
+            connections = list(self.connections)
+        for connection in connections:
+            connection.send_json(event)
+
+    def attach(self, connection, last_event_seq=None):
+        """Подключает вкладку и досылает события после last_event_seq"""
+        with self.lock:
+            self.connections.add(connection)
+            self.last_active = time.monotonic()
+            if last_event_seq is None:
+                missed = []
+            elif self.events and self.events[0]["event_seq"] > last_event_seq + 1:
+                missed = None
+            else:
+                missed = [e for e in self.events if e["event_seq"] > last_event_seq]
+            current_seq = self.next_seq - 1
+
+        connection.send_json({"type": "hello", "event_seq": current_seq})
+        if missed is None or (last_event_seq is not None and last_event_seq > current_seq):
+            # Пропущено больше, чем хранится (или сервер перезапускался)
+            connection.send_json({"type": "reset", "event_seq": current_seq})
+        else:
+            for event in missed:
+                connection.send_json(event)
+
+    def detach(self, connection):
+        with self.lock:
+            self.connections.discard(connection)
+            self.last_active = time.monotonic()
+
+
+user_channels = {}
+user_channels_lock = threading.Lock()
+
+
+def get_user_channel(user_id, create=True):
+    """Канал событий пользователя; неактивные каналы других пользователей удаляются"""
+    user_id = str(user_id)
+    with user_channels_lock:
+        channel = user_channels.get(user_id)
+        if channel is None and create:
+            now = time.monotonic()
+            for other_id, other in list(user_channels.items()):
+                if not other.connections and now - other.last_active > WS_CONFIG["channel_idle_ttl"]:
+                    del user_channels[other_id]
+            channel = user_channels[user_id] = UserEventChannel(WS_CONFIG["event_buffer"])
+        return channel
+
+
+def publish_user_event(user_id, event_type, payload, buffered=True):
+    """Рассылает событие вкладкам пользователя (если они подключены по WebSocket)"""
+    channel = get_user_channel(user_id, create=False)
+    if channel is not None:
+        channel.publish(event_type, payload, buffered)
+
+
+def has_user_connections(user_id):
+    channel = get_user_channel(user_id, create=False)
+    return bool(channel and channel.connections)
+
+
+# Получатель частей ответа LLM и текущий ход ГМ для потока (см. gm_turn)
+llm_stream = threading.local()
+
+# Как часто проверять, не закрыл ли клиент HTTP-соединение, с
+TURN_PROBE_INTERVAL_S = 0.5
+# Действия WebSocket, заменяющие ответ ГМ, который еще генерируется
+TURN_SUPERSEDING_ACTIONS = {"edit_message", "reroll", "start_game_with_character"}
+
+
+class GenerationCancelled(Exception):
+    """Ход ГМ отменен: игрок ушел или начал в этом чате новый ход"""
+
+    def __init__(self, reason):
+        super().__init__(f"Генерация отменена ({reason})")
+        self.reason = reason
+        # (токенов запроса, токенов ответа), потраченные до отмены
+        self.spent = None
+
+
+class GenerationTurn:
+    """Ход ГМ в чате; alive() сообщает, ждет ли еще ответ клиент"""
+
+    def __init__(self, key, alive=None):
+        self.key = key
+        self.alive = alive
+        self.reason = None
+        self.cancelled = threading.Event()
+        self.probed_at = 0.0
+
+    def cancel(self, reason):
+        if not self.cancelled.is_set():
+            self.reason = reason
+            self.cancelled.set()
+
+    def check(self):
+        """Бросает GenerationCancelled, если ход отменен или клиент отключился"""
+        if not self.cancelled.is_set() and self.alive is not None:
+            now = time.monotonic()
+            if now - self.probed_at >= TURN_PROBE_INTERVAL_S:
+                self.probed_at = now
+                if not self.alive():
+                    self.cancel("disconnected")
+        if self.cancelled.is_set():
+            raise GenerationCancelled(self.reason)
+
+
+# (user_id, chat_id) -> текущий GenerationTurn
+active_turns = {}
+active_turns_lock = threading.Lock()
+
+
+def begin_turn(user_id, chat_id, alive=None):
+    """Регистрирует новый ход в чате; прежний ход этого чата отменяется"""
+    turn = GenerationTurn((user_id, chat_id), alive)
+    with active_turns_lock:
+        previous = active_turns.get(turn.key)
+        active_turns[turn.key] = turn
+    if previous is not None:
+        previous.cancel("superseded")
+    return turn
+
+
+def end_turn(turn):
+    """Снимает ход с учета; False - его уже сменил более новый"""
+    with active_turns_lock:
+        if active_turns.get(turn.key) is not turn:
+            return False
+        del active_turns[turn.key]
+        return True
+
+
+def cancel_chat_turn(user_id, chat_id, reason="superseded"):
+    with active_turns_lock:
+        turn = active_turns.get((user_id, chat_id))
+    if turn is not None:
+        turn.cancel(reason)
+
+
+def connection_probe(environ):
+    """Функция проверки, что клиент еще подключен, или None, если сокет недоступен"""
+    sock = environ.get('werkzeug.socket') or environ.get('gunicorn.socket')
+    if sock is None:
+        return None
+
+    def alive():
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            # Закрытое клиентом соединение читается как конец потока
+            return not readable or sock.recv(1, socket.MSG_PEEK) != b""
+        except ValueError:
+            # TLS-сокет не умеет MSG_PEEK - считаем, что клиент на месте
+            return True
+        except OSError:
+            return False
+
+    return alive
+
+
+@contextmanager
+def gm_turn(chat_id):
+    """Ход ГМ: сообщает вкладкам о генерации, транслирует ответ по частям
+
+    Генерация прерывается, если клиент отключился или в этом чате начат
+    новый ход - отмененный ответ не сохраняется (см. chat_with_ai).
+    """
+    user_id = session['user_id']
+    alive = getattr(llm_stream, 'alive', None) or connection_probe(request.environ)
+    turn = begin_turn(user_id, chat_id, alive)
+    llm_stream.turn = turn
+    publish_user_event(user_id, "status", {"chat_id": chat_id, "state": "generating"},
+                       buffered=False)
+    if has_user_connections(user_id):
+        llm_stream.listener = lambda text: publish_user_event(
+            user_id, "gm_delta", {"chat_id": chat_id, "text": text}, buffered=False)
+    try:
+        yield turn
+    finally:
+        llm_stream.listener = None
+        llm_stream.turn = None
+        # Если ход сменил более новый, вкладки уже видят его генерацию
+        if end_turn(turn):
+            publish_user_event(user_id, "status", {"chat_id": chat_id, "state": "idle"},
+                               buffered=False)
+
+
 # Проверка аутентификации
 def login_required(f):
 
@@ -74,6 +825,430 @@ def login_required(f):
     return decorated_function
 
 
+def conditional_get(*kinds):
+    """ETag/Last-Modified для списков по версиям разделов хранилища
+
+    Если клиент прислал актуальный ETag, отвечаем 304 до вызова обработчика -
+    без чтения файлов. Ставится после login_required.
+    """
+
+    def decorator(f):
+
+        def decorated_function(*args, **kwargs):
+            versions = [get_storage_version(kind) for kind in kinds]
+            etag = "-".join([STORAGE_EPOCH, str(session['user_id'])] +
+                            [str(version) for version, _ in versions])
+            last_modified = max(modified_at for _, modified_at in versions)
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = bool(request.if_modified_since and
+                                    request.if_modified_since
+                                    >= last_modified.replace(microsecond=0))
+
+            if not_modified:
+                response = app.response_class(status=304)
+            else:
+                response = app.make_response(f(*args, **kwargs))
+            response.set_etag(etag, weak=True)
+            response.last_modified = last_modified
+            # Браузер хранит ответ, но перепроверяет его при каждом запросе
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+            return response
+
+        decorated_function.__name__ = f.__name__
+        return decorated_function
+
+    return decorator
+
+
+# Идемпотентность игровых действий: повтор запроса (двойной клик, повтор
+# клиента после таймаута) не запускает генерацию заново, а получает результат
+# первого. Ключ - заголовок Idempotency-Key или поле idempotency_key; если
+# клиент его не передал - хеш пользователя, действия, состояния файла чата и
+# данных запроса. Удачные результаты хранятся IDEMPOTENCY_TTL_S секунд.
+IDEMPOTENCY_TTL_S = float(os.environ.get("IDEMPOTENCY_TTL_S", "60"))
+SINGLE_FLIGHT_PATHS = {"/send_message", "/start_game_with_character", "/save_game"}
+
+
+class SingleFlight:
+    """Выполняет работу один раз на ключ; повторы ждут и получают ее результат"""
+
+    def __init__(self, ttl_s=IDEMPOTENCY_TTL_S, clock=time.monotonic):
+        self.ttl_s = ttl_s
+        self.clock = clock
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn, keep=None):
+        """(результат fn, повтор ли это); keep(result) решает, хранить ли результат"""
+        with self.lock:
+            now = self.clock()
+            for stale in [k for k, entry in self.entries.items()
+                          if entry["expires"] is not None and entry["expires"] <= now]:
+                del self.entries[stale]
+            entry = self.entries.get(key)
+            leader = entry is None
+            if leader:
+                entry = self.entries[key] = {"done": threading.Event(), "result": None,
+                                             "error": None, "expires": None}
+        if not leader:
+            entry["done"].wait()
+            if entry["error"] is not None:
+                raise entry["error"]
+            return entry["result"], True
+
+        try:
+            entry["result"] = fn()
+        except Exception as e:
+            entry["error"] = e
+            raise
+        finally:
+            with self.lock:
+                # Ошибку при повторе стоит попробовать снова - не храним
+                if entry["error"] is not None or (keep and not keep(entry["result"])):
+                    self.entries.pop(key, None)
+                entry["expires"] = self.clock() + self.ttl_s
+            entry["done"].set()
+        return entry["result"], False
+
+
+idempotent_actions = SingleFlight()
+
+
+def chat_state_token(chat_id):
+    """Состояние чата без чтения: меняется при каждом сохранении"""
+    user_folder = get_user_folder(session['username'], session['user_id'])
+    stamp = game_states.stamp(user_folder, chat_id)
+    if stamp is not None:
+        # Файл чата в памяти пишется с задержкой - берем отметку сохранения
+        return f"m{stamp}"
+    filepath = find_chat_file(user_folder, chat_id)
+    if not filepath:
+        return "new"
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return "new"
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+def idempotency_key():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        # Не объект (список, строка) - ключ строится как для пустого тела
+        data = {}
+    scope = f"{session['user_id']}:{request.path}"
+    client_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+    if client_key:
+        return f"{scope}:key:{client_key}"
+    chat_id = data.get('chat_id', 'default')
+    payload = json.dumps(data, sort_keys=True, ensure_ascii=False)
+    return ":".join([scope, str(chat_id), chat_state_token(chat_id),
+                     hashlib.sha256(payload.encode('utf-8')).hexdigest()])
+
+
+def single_flight(f):
+    """Одинаковые одновременные запросы выполняются один раз. Ставится после login_required"""
+
+    def decorated_function(*args, **kwargs):
+
+        def run():
+            response = app.make_response(f(*args, **kwargs))
+            body = response.get_json(silent=True)
+            failed = bool(isinstance(body, dict) and body.get("error"))
+            # Ответ сохраняется данными: after_request (сжатие) меняет объект ответа
+            return response.get_data(), response.status_code, response.mimetype, failed
+
+        (data, status, mimetype, _), replay = idempotent_actions.do(
+            idempotency_key(), run, keep=lambda result: not result[3])
+        if replay:
+            record_metric("idempotent_replays")
+            logger.info("Повтор %s: отдан результат первого запроса", request.path,
+                        extra={"event": "idempotent_replay"})
+        return app.response_class(data, status=status, mimetype=mimetype)
+
+    decorated_function.__name__ = f.__name__
+    return decorated_function
+
+
+# Сжатие ответов
+COMPRESSION_CONFIG = {
+    "min_size": int(os.environ.get("COMPRESS_MIN_SIZE", "1024")),
+    "gzip_level": 6,
+    "brotli_quality": 5,
+    "mimetypes": {
+        "application/json", "text/html", "text/css", "text/plain",
+        "application/javascript", "text/javascript"
+    },
+}
+
+
+def choose_content_encoding():
+    """Выбирает кодировку по Accept-Encoding: brotli (если доступен), затем gzip"""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough
+            or response.is_streamed or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSION_CONFIG["mimetypes"]):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < COMPRESSION_CONFIG["min_size"]:
+        return response
+
+    encoding = choose_content_encoding()
+    if encoding == 'br':
+        compressed = brotli.compress(data, quality=COMPRESSION_CONFIG["brotli_quality"])
+    elif encoding == 'gzip':
+        compressed = gzip.compress(data, compresslevel=COMPRESSION_CONFIG["gzip_level"])
+    else:
+        return response
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+# Администраторы задаются через переменную окружения: ADMIN_USERS=lewa,admin
+ADMIN_USERS = {
+    name.strip()
+    for name in os.environ.get("ADMIN_USERS", "").split(",") if name.strip()
+}
+
+
+def admin_required(f):
+
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            return jsonify({
+                "error": "Требуется авторизация",
+                "need_login": True
+            })
+        if session.get('username') not in ADMIN_USERS:
+            return jsonify({"error": "Недостаточно прав"})
+        return f(*args, **kwargs)
+
+    decorated_function.__name__ = f.__name__
+    return decorated_function
+
+
+# Профилирование запросов
+PROFILE_CONFIG = {
+    "profile_dir": os.environ.get("PROFILE_DIR", "profiles"),
+    "sample_interval": float(os.environ.get("PROFILE_SAMPLE_INTERVAL_MS", "5")) / 1000,
+    "slow_request_ms": float(os.environ.get("SLOW_REQUEST_MS", "1000")),
+}
+
+# Пользователи, все запросы которых профилируются (включается админом)
+profiled_users = set()
+# Последние медленные и профилированные запросы для /admin/profiles
+recent_slow_requests = deque(maxlen=200)
+
+
+class SamplingProfiler:
+    """Семплирующий профайлер одного потока
+
+    Раз в interval секунд снимает стек целевого потока и копит его в
+    формате "folded stacks" (func;func;func count), который понимают
+    flamegraph.pl, speedscope и inferno.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name="request-profiler",
+                                        daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} "
+                             f"({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def write_folded(self, filepath):
+        """Записывает профиль в формате folded stacks"""
+        with open(filepath, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def should_profile_request():
+    """Профилируем по запросу админа (?_profile=1 / X-Profile: 1) или по пользователю"""
+    username = session.get('username')
+    if not username:
+        return False
+    if username in profiled_users:
+        return True
+    if username in ADMIN_USERS:
+        return bool(request.args.get('_profile') or request.headers.get('X-Profile'))
+    return False
+
+
+@app.before_request
+def start_request_profiling():
+    g.request_started = time.perf_counter()
+    g.profiler = None
+    if should_profile_request():
+        g.profiler = SamplingProfiler(threading.get_ident(),
+                                      PROFILE_CONFIG["sample_interval"])
+        g.profiler.start()
+
+
+@app.after_request
+def finish_request_profiling(response):
+    started = g.get('request_started')
+    if started is None or request.endpoint == 'game_socket':
+        # WebSocket живет все время подключения - это не медленный запрос
+        return response
+    duration_ms = (time.perf_counter() - started) * 1000
+    profiler = g.get('profiler')
+
+    profile_name = None
+    if profiler:
+        profiler.stop()
+        try:
+            os.makedirs(PROFILE_CONFIG["profile_dir"], exist_ok=True)
+            endpoint = (request.endpoint or "unknown").replace('.', '_')
+            username = "".join(c for c in session.get('username', 'anonymous')
+                               if c.isalnum() or c in ('-', '_'))
+            profile_name = (f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+                            f"_{endpoint}_{username}.folded")
+            profiler.write_folded(
+                os.path.join(PROFILE_CONFIG["profile_dir"], profile_name))
+        except Exception as e:
+            logger.error("Ошибка записи профиля: %s", e)
+            profile_name = None
+
+    if profile_name or duration_ms >= PROFILE_CONFIG["slow_request_ms"]:
+        recent_slow_requests.append({
+            "timestamp": datetime.now().isoformat(),
+            "method": request.method,
+            "path": request.path,
+            "endpoint": request.endpoint,
+            "username": session.get('username'),
+            "duration_ms": round(duration_ms, 1),
+            "status": response.status_code,
+            "profile": profile_name,
+            "samples": profiler.samples if profiler else 0
+        })
+
+    return response
+
+
+@app.route('/admin/profiling', methods=['POST'])
+@admin_required
+def set_user_profiling():
+    """Включает или выключает профилирование всех запросов пользователя"""
+    data = request.get_json()
+    username = data.get('username', '').strip()
+    enabled = data.get('enabled', True)
+
+    if not username:
+        return jsonify({"error": "Не указан пользователь"})
+
+    if enabled:
+        profiled_users.add(username)
+    else:
+        profiled_users.discard(username)
+
+    return jsonify({"success": True, "profiled_users": sorted(profiled_users)})
+
+
+@app.route('/admin/profiles', methods=['GET'])
+@admin_required
+def list_profiles():
+    """Список последних медленных и профилированных запросов (новые сверху)"""
+    try:
+        min_ms = float(request.args.get('min_ms', 0))
+    except ValueError:
+        return jsonify({"error": "min_ms должно быть числом"})
+    requests_list = [
+        entry for entry in reversed(recent_slow_requests)
+        if entry["duration_ms"] >= min_ms
+    ]
+    return jsonify({
+        "requests": requests_list,
+        "profiled_users": sorted(profiled_users),
+        "slow_request_ms": PROFILE_CONFIG["slow_request_ms"]
+    })
+
+
+@app.route('/admin/profiles/<path:profile_name>', methods=['GET'])
+@admin_required
+def download_profile(profile_name):
+    """Отдает файл профиля в формате folded stacks"""
+    return send_from_directory(os.path.abspath(PROFILE_CONFIG["profile_dir"]),
+                               profile_name,
+                               mimetype='text/plain')
+
+
+# Счетчики работы приложения (с момента запуска процесса)
+metrics = Counter()
+metrics_lock = threading.Lock()
+
+
+def record_metric(name, amount=1):
+    with metrics_lock:
+        metrics[name] += amount
+
+
+def metrics_snapshot():
+    with metrics_lock:
+        return dict(metrics)
+
+
+@app.route('/admin/metrics', methods=['GET'])
+@admin_required
+def get_metrics():
+    """Счетчики приложения и производные от них показатели"""
+    counters = metrics_snapshot()
+    reroll_requests = counters.get("reroll_requests", 0)
+    return jsonify({
+        "started_at": STORAGE_STARTED_AT.isoformat(),
+        "counters": counters,
+        "reroll_hit_rate": (counters.get("reroll_hits", 0) / reroll_requests
+                            if reroll_requests else None),
+        "context": context_controller.snapshot(),
+        "routes": route_stats_snapshot(),
+        "breakers": {model: breaker.snapshot() for model, breaker in list(llm_breakers.items())},
+        "hedging": hedge_policy.snapshot(),
+        "user_cache": user_cache.snapshot(),
+        "game_state": game_states.snapshot()
+    })
+
+
 class ContextManager:
     def __init__(self, max_messages=50, max_tokens=128000, summary_enabled=True):
         """
@@ -102,16 +1277,18 @@ class ContextManager:
             config = self.context_configs[size]
             self.max_messages = config["max_messages"]
             self.max_tokens = config["max_tokens"]
-            logger.info(f"Установлен размер контекста: {size} ({self.max_messages} сообщений, {self.max_tokens} токенов)")
+            logger.debug("Установлен размер контекста: %s (%s сообщений, %s токенов)",
+                         size, self.max_messages, self.max_tokens)
         else:
-            logger.warning(f"Неизвестный размер контекста: {size}")
+            logger.warning("Неизвестный размер контекста: %s", size)
     
     def set_custom_context(self, max_messages, max_tokens=None):
         """Устанавливает кастомные параметры контекста"""
         self.max_messages = max_messages
         if max_tokens:
             self.max_tokens = max_tokens
-        logger.info(f"Установлен кастомный контекст: {self.max_messages} сообщений, {self.max_tokens} токенов")
+        logger.info("Установлен кастомный контекст: %s сообщений, %s токенов",
+                    self.max_messages, self.max_tokens)
 
     def estimate_tokens(self, text):
         """Улучшенная оценка количества токенов (1 токен ≈ 3.5 символа для русского)"""
@@ -188,14 +1365,17 @@ class ContextManager:
         if len(conversation_history) <= self.max_messages:
             total_tokens = sum(self.estimate_tokens(msg["content"]) for msg in conversation_history)
             if total_tokens <= self.max_tokens:
-                logger.debug(f"Контекст в норме: {len(conversation_history)} сообщений, ~{total_tokens} токенов")
+                logger.debug("Контекст в норме: %s сообщений, ~%s токенов",
+                             len(conversation_history), total_tokens,
+                             extra={"event": "context_ok"})
                 return conversation_history
         
-        logger.info(f"Оптимизация контекста: {len(conversation_history)} сообщений -> {self.max_messages}")
+        logger.info("Оптимизация контекста: %s сообщений -> %s",
+                    len(conversation_history), self.max_messages)
         
         # Если резюме отключено - просто обрезаем
         if not self.summary_enabled:
-            return conversation_history[-self.max_messages:]
+            return self.fit_token_budget(None, conversation_history[-self.max_messages:])
         
         # Стратегия с резюме: оставляем 70% от лимита для новых сообщений
         keep_recent = int(self.max_messages * 0.7)
@@ -206,21 +1386,214 @@ class ContextManager:
         if older_messages:
             summary = self.create_detailed_summary(older_messages)
             if summary:
-                result = [summary] + recent_messages
+                result = self.fit_token_budget(summary, recent_messages)
                 total_tokens = sum(self.estimate_tokens(msg["content"]) for msg in result)
-                logger.info(f"Контекст оптимизирован: {len(result)} сообщений (~{total_tokens} токенов)")
+                logger.info("Контекст оптимизирован: %s сообщений (~%s токенов)",
+                            len(result), total_tokens)
                 return result
         
-        return recent_messages
+        return self.fit_token_budget(None, recent_messages)
+
+    def fit_token_budget(self, summary, recent_messages):
+        """Укладывает резюме и последние сообщения в max_tokens
+
+        Сначала отбрасываются самые старые сообщения (последнее остается всегда),
+        затем у резюме обрезается начало - недавние события важнее.
+        """
+        recent_tokens = [self.estimate_tokens(msg["content"]) for msg in recent_messages]
+        summary_tokens = self.estimate_tokens(summary["content"]) if summary else 0
+        total = summary_tokens + sum(recent_tokens)
+        start = 0
+        while total > self.max_tokens and start < len(recent_messages) - 1:
+            total -= recent_tokens[start]
+            start += 1
+        recent_messages = recent_messages[start:]
+
+        if not summary:
+            return recent_messages
+        budget = self.max_tokens - (total - summary_tokens)
+        if budget <= 0:
+            return recent_messages
+        if summary_tokens > budget:
+            content = summary["content"]
+            header = "📜 РЕЗЮМЕ ПРЕДЫДУЩИХ СОБЫТИЙ (сокращено):\n\n..."
+            tail = max(int(budget * 3.5) - len(header), 0)
+            summary = {"role": "system", "content": header + content[len(content) - tail:]}
+        return [summary] + recent_messages
+
+
+# Адаптивный размер контекста.
+# CONTEXT_TARGET_P95_S - целевой p95 времени ответа модели; предустановки
+# ContextManager выбираются от CONTEXT_CONFIG["context_size"] (потолок) вниз,
+# пока оценка p95 для запроса не уложится в цель. Пока наблюдений мало,
+# используется CONTEXT_CONFIG как есть.
+ADAPTIVE_CONTEXT_CONFIG = {
+    "enabled": os.environ.get("ADAPTIVE_CONTEXT", "1") == "1",
+    "target_p95_s": float(os.environ.get("CONTEXT_TARGET_P95_S", "20")),
+    "window": 200,
+    # Старые наблюдения не отражают текущую нагрузку провайдера
+    "max_age_s": 900,
+    "min_samples": 20,
+    # Меньше этого бюджета истории не урезаем даже при перегрузке
+    "min_history_tokens": 2000
+}
+
+
+class ContextSizeController:
+    """Оценка времени ответа модели от размера запроса
+
+    По каждой модели хранит последние наблюдения (токены запроса, секунды) и
+    строит по ним прямую intercept + slope * tokens методом наименьших
+    квадратов. Запас до p95 - 95-й процентиль остатков, поэтому рост
+    задержек под нагрузкой сразу уменьшает допустимый размер контекста.
+    """
+
+    def __init__(self, window, max_age, min_samples, clock=time.monotonic):
+        self.window = window
+        self.max_age = max_age
+        self.min_samples = min_samples
+        self.clock = clock
+        self.samples = {}
+        self.decisions = {}
+        self.lock = threading.Lock()
+
+    def observe(self, model, prompt_tokens, latency):
+        with self.lock:
+            samples = self.samples.setdefault(model, deque(maxlen=self.window))
+            samples.append((self.clock(), prompt_tokens, latency))
+
+    def estimate(self, model):
+        """(intercept, slope, p95 остатков) или None, если наблюдений мало"""
+        with self.lock:
+            samples = self.samples.get(model)
+            if not samples:
+                return None
+            horizon = self.clock() - self.max_age
+            while samples and samples[0][0] < horizon:
+                samples.popleft()
+            points = [(tokens, latency) for _, tokens, latency in samples]
+        if len(points) < self.min_samples:
+            return None
+
+        mean_x = sum(x for x, _ in points) / len(points)
+        mean_y = sum(y for _, y in points) / len(points)
+        variance = sum((x - mean_x) ** 2 for x, _ in points)
+        # Запросы одного размера не дают наклона - время считаем постоянным
+        slope = (sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+                 if variance else 0.0)
+        slope = max(slope, 0.0)
+        intercept = mean_y - slope * mean_x
+        residuals = sorted(y - intercept - slope * x for x, y in points)
+        return intercept, slope, residuals[int(0.95 * (len(residuals) - 1))]
+
+    @staticmethod
+    def predict_p95(fit, prompt_tokens):
+        intercept, slope, margin = fit
+        return intercept + slope * prompt_tokens + margin
+
+    def record_decision(self, model, decision):
+        with self.lock:
+            previous = self.decisions.get(model)
+            self.decisions[model] = decision
+        return previous
+
+    def snapshot(self):
+        result = {}
+        for model in list(self.samples):
+            fit = self.estimate(model)
+            result[model] = {
+                "samples": len(self.samples.get(model, ())),
+                "intercept_s": round(fit[0], 3) if fit else None,
+                "s_per_1k_tokens": round(fit[1] * 1000, 4) if fit else None,
+                "p95_margin_s": round(fit[2], 3) if fit else None,
+                "last_decision": self.decisions.get(model)
+            }
+        return result
+
+
+context_controller = ContextSizeController(ADAPTIVE_CONTEXT_CONFIG["window"],
+                                           ADAPTIVE_CONTEXT_CONFIG["max_age_s"],
+                                           ADAPTIVE_CONTEXT_CONFIG["min_samples"])
+
+
+def assemble_llm_messages(system_prompt, history, prompt):
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.extend(history)
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+def build_llm_messages(model, prompt, system_prompt, conversation_history):
+    """Сообщения для API с размером контекста под целевой p95
+
+    Возвращает (сообщения, оценка токенов запроса).
+    """
+    context_manager = ContextManager(
+        max_messages=CONTEXT_CONFIG["max_messages"],
+        max_tokens=CONTEXT_CONFIG["max_tokens"],
+        summary_enabled=CONTEXT_CONFIG["summary_enabled"]
+    )
+
+    def count_tokens(messages):
+        return sum(context_manager.estimate_tokens(msg["content"]) for msg in messages)
+
+    fit = context_controller.estimate(model) if ADAPTIVE_CONTEXT_CONFIG["enabled"] else None
+    if fit is None:
+        messages = assemble_llm_messages(
+            system_prompt, context_manager.optimize_context(conversation_history), prompt)
+        return messages, count_tokens(messages)
+
+    target = ADAPTIVE_CONTEXT_CONFIG["target_p95_s"]
+    presets = list(context_manager.context_configs)
+    ceiling = presets.index(CONTEXT_CONFIG["context_size"])
+    # От потолка к меньшим
+    for size in reversed(presets[:ceiling + 1]):
+        context_manager.set_context_size(size)
+        messages = assemble_llm_messages(
+            system_prompt, context_manager.optimize_context(conversation_history), prompt)
+        tokens = count_tokens(messages)
+        predicted = context_controller.predict_p95(fit, tokens)
+        if predicted <= target:
+            break
+    else:
+        # Даже самая маленькая предустановка не укладывается - бюджет истории
+        # считаем из оценки: сколько токенов модель успевает обработать за цель
+        intercept, slope, margin = fit
+        if slope > 0:
+            fixed_tokens = count_tokens(assemble_llm_messages(system_prompt, [], prompt))
+            budget = max(ADAPTIVE_CONTEXT_CONFIG["min_history_tokens"],
+                         int((target - intercept - margin) / slope) - fixed_tokens)
+            if budget < context_manager.max_tokens:
+                size = "custom"
+                context_manager.max_tokens = budget
+                messages = assemble_llm_messages(
+                    system_prompt, context_manager.optimize_context(conversation_history), prompt)
+                tokens = count_tokens(messages)
+                predicted = context_controller.predict_p95(fit, tokens)
+
+    decision = {"size": size, "prompt_tokens": tokens,
+                "predicted_p95_s": round(predicted, 2), "target_met": predicted <= target}
+    previous = context_controller.record_decision(model, decision)
+    record_metric(f"context_size_{size}")
+    if predicted > target:
+        record_metric("context_target_missed")
+    # Смену размера пишем в INFO, остальные решения - в DEBUG
+    level = logging.INFO if not previous or previous["size"] != size else logging.DEBUG
+    logger.log(level, "Размер контекста для %s: %s (~%s токенов, p95 %.1f с при цели %.1f с)",
+               model, size, tokens, predicted, target,
+               extra={"event": "context_decision"})
+    return messages, tokens
+
+
+GM_RULES_PATH = "attached_assets/2. Правила для гейм мастера_1751298976539.json"
 
 
 def load_gm_rules():
     """Загружает правила ГМ из JSON файла"""
     try:
-        with open(
-                "attached_assets/2. Правила для гейм мастера_1751298976539.json",
-                "r",
-                encoding="utf-8") as f:
+        with open(GM_RULES_PATH, "r", encoding="utf-8") as f:
             rules = json.load(f)
         return rules
     except FileNotFoundError:
@@ -263,6 +1636,23 @@ def create_gm_system_prompt(rules):
     return system_prompt
 
 
+# Системный промпт ГМ общий для всех чатов: строится один раз и заново -
+# только после изменения файла правил
+gm_prompt_cache = {"mtime": None, "prompt": None}
+
+
+def gm_system_prompt():
+    """Системный промпт ГМ по текущим правилам"""
+    try:
+        mtime = os.stat(GM_RULES_PATH).st_mtime_ns
+    except OSError:
+        mtime = None
+    if gm_prompt_cache["prompt"] is None or gm_prompt_cache["mtime"] != mtime:
+        gm_prompt_cache["prompt"] = create_gm_system_prompt(load_gm_rules())
+        gm_prompt_cache["mtime"] = mtime
+    return gm_prompt_cache["prompt"]
+
+
 def process_content(content):
     # Более аккуратная обработка тегов мышления
     import re
@@ -282,64 +1672,1082 @@ def process_content(content):
     return cleaned
 
 
-def chat_with_ai(prompt, system_prompt="", conversation_history=[]):
-    if not API_KEY:
-        return "🔑 **Ошибка**: API ключ Mistral не найден. Добавьте MISTRAL_API_KEY в Secrets."
+def get_llm_client():
+    """Клиент Mistral; библиотека загружается при первом вызове"""
+    global Mistral
+    if Mistral is None:
+        from mistralai import Mistral
+    if MISTRAL_SERVER_URL:
+        return Mistral(api_key=API_KEY, server_url=MISTRAL_SERVER_URL)
+    return Mistral(api_key=API_KEY)
+
+
+# Статистика маршрутов: время последних ответов и до какого момента основная
+# модель маршрута считается ограниченной по скорости
+route_latencies = {}
+route_rate_limited_until = {}
+route_stats_lock = threading.Lock()
+
+
+def is_rate_limited(error):
+    """Ошибка ограничения скорости или емкости тарифа (429)"""
+    if getattr(error, 'status_code', None) == 429:
+        return True
+    error_str = str(error)
+    return ("Status 429" in error_str or "Service tier capacity exceeded" in error_str
+            or "Rate limit" in error_str)
+
+
+def record_route_call(route, model, latency, tokens):
+    with route_stats_lock:
+        route_latencies.setdefault(route, deque(maxlen=500)).append(latency)
+    record_metric(f"llm_{route}_requests")
+    record_metric(f"llm_{route}_tokens", tokens)
+    record_metric(f"llm_model_{model}_tokens", tokens)
+
+
+def route_stats_snapshot():
+    """Модели маршрутов и время их ответов (p50/p95 по последним запросам), с"""
+    now = time.monotonic()
+    result = {}
+    with route_stats_lock:
+        for route, config in MODEL_ROUTES.items():
+            latencies = sorted(route_latencies.get(route, ()))
+            result[route] = dict(config,
+                                 samples=len(latencies),
+                                 p50_s=round(latencies[len(latencies) // 2], 3) if latencies else None,
+                                 p95_s=round(latencies[int(0.95 * (len(latencies) - 1))], 3)
+                                 if latencies else None,
+                                 on_fallback=route_rate_limited_until.get(route, 0) > now)
+    return result
+
+
+# Автомат защиты для моделей (circuit breaker).
+# closed - запросы идут; если за window_s среди не меньше min_calls запросов
+# доля ошибок (429, 5xx, таймауты, сеть) или медленных ответов (дольше
+# slow_call_s) превысила порог - open: запросы сразу отклоняются open_s секунд.
+# Затем half_open: пропускается по одному пробному запросу; после
+# close_after успешных подряд - снова closed, при ошибке - снова open.
+BREAKER_CONFIG = {
+    "window_s": 60,
+    "min_calls": 5,
+    "failure_rate": 0.5,
+    "slow_call_s": float(os.environ.get("LLM_SLOW_CALL_S", "45")),
+    "slow_rate": 0.8,
+    "open_s": float(os.environ.get("LLM_BREAKER_OPEN_S", "30")),
+    "close_after": 2
+}
+
 
+class CircuitOpenError(Exception):
+    """Модель отключена автоматом защиты - запрос не отправлялся"""
+
+    def __init__(self, model, retry_after):
+        super().__init__(f"Модель {model} временно недоступна")
+        self.model = model
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Автомат защиты одной модели; clock подменяется в симуляции (bench.py breaker)"""
+
+    def __init__(self, config=BREAKER_CONFIG, clock=time.monotonic):
+        self.config = config
+        self.clock = clock
+        self.state = "closed"
+        self.outcomes = deque()
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.probe_successes = 0
+        self.lock = threading.Lock()
+
+    def _open(self, now):
+        self.state = "open"
+        self.opened_at = now
+        self.outcomes.clear()
+        self.probe_in_flight = False
+        self.probe_successes = 0
+
+    def allow(self):
+        """Можно ли отправить запрос; в half_open занимает место пробного запроса"""
+        with self.lock:
+            now = self.clock()
+            if self.state == "open" and now - self.opened_at >= self.config["open_s"]:
+                self.state = "half_open"
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+            return False
+
+    def release(self):
+        """Запрос отменен игроком - исход не учитывается, место пробного освобождается"""
+        with self.lock:
+            if self.state == "half_open":
+                self.probe_in_flight = False
+
+    def retry_after(self):
+        with self.lock:
+            if self.state != "open":
+                return 0.0
+            return max(0.0, self.opened_at + self.config["open_s"] - self.clock())
+
+    def record(self, failed, latency):
+        """Итог запроса, разрешенного allow(); медленный ответ считается отдельно"""
+        config = self.config
+        slow = latency >= config["slow_call_s"]
+        with self.lock:
+            now = self.clock()
+            if self.state == "half_open":
+                self.probe_in_flight = False
+                if failed or slow:
+                    self._open(now)
+                    return
+                self.probe_successes += 1
+                if self.probe_successes >= config["close_after"]:
+                    self.state = "closed"
+                    self.outcomes.clear()
+                return
+            if self.state != "closed":
+                return
+
+            self.outcomes.append((now, failed, slow))
+            while self.outcomes and self.outcomes[0][0] < now - config["window_s"]:
+                self.outcomes.popleft()
+            calls = len(self.outcomes)
+            if calls < config["min_calls"]:
+                return
+            failures = sum(1 for _, f, _ in self.outcomes if f)
+            slow_calls = sum(1 for _, _, s in self.outcomes if s)
+            if failures / calls >= config["failure_rate"] or slow_calls / calls >= config["slow_rate"]:
+                self._open(now)
+
+    def snapshot(self):
+        with self.lock:
+            return {"state": self.state, "recent_calls": len(self.outcomes)}
+
+
+llm_breakers = {}
+llm_breakers_lock = threading.Lock()
+
+
+def get_llm_breaker(model):
+    with llm_breakers_lock:
+        breaker = llm_breakers.get(model)
+        if breaker is None:
+            breaker = llm_breakers[model] = CircuitBreaker()
+        return breaker
+
+
+def is_breaker_failure(error):
+    """Ошибка, говорящая о проблемах провайдера, а не запроса"""
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        # Без кода ответа провайдер виноват только в таймаутах и обрывах
+        # соединения; прочие исключения (разбор ответа, ошибки в нашем коде)
+        # модель не отключают. httpx уже загружен вместе с клиентом Mistral
+        httpx = sys.modules.get('httpx')
+        network_errors = (TimeoutError, ConnectionError) + \
+            ((httpx.TransportError,) if httpx else ())
+        return isinstance(error, network_errors)
+    return status == 429 or status >= 500
+
+
+def route_degraded(route="narration"):
+    """Основная модель маршрута отключена автоматом - фоновые заготовки не делаем"""
+    return get_llm_breaker(MODEL_ROUTES[route]["model"]).snapshot()["state"] != "closed"
+
+
+# Дублирование медленных запросов (hedging): если первый токен ответа не пришел
+# за перцентиль недавних задержек модели, отправляется такой же второй запрос.
+# Берется ответ, начавшийся раньше, второй поток закрывается. Дубли ограничены
+# бюджетом: каждый запрос добавляет budget кредита (не больше burst), дубль
+# тратит один - так дублей не больше доли budget от всех запросов.
+HEDGE_CONFIG = {
+    "enabled": os.environ.get("LLM_HEDGING", "0") == "1",
+    "percentile": float(os.environ.get("LLM_HEDGE_PERCENTILE", "95")),
+    "min_delay_s": float(os.environ.get("LLM_HEDGE_MIN_DELAY_S", "1")),
+    "budget": float(os.environ.get("LLM_HEDGE_BUDGET", "0.05")),
+    "burst": 5,
+    "window": 200,
+    "min_samples": 20
+}
+
+
+class HedgePolicy:
+    """Когда дублировать запрос к модели и остался ли бюджет на дубль"""
+
+    def __init__(self, config=HEDGE_CONFIG):
+        self.config = config
+        self.first_token = {}
+        self.credits = float(config["burst"])
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+        self.denied = 0
+        self.lock = threading.Lock()
+
+    def observe(self, model, latency):
+        """Время до первого события потока, с"""
+        with self.lock:
+            self.first_token.setdefault(
+                model, deque(maxlen=self.config["window"])).append(latency)
+
+    def _percentile_delay(self, samples):
+        if len(samples) < self.config["min_samples"]:
+            return None
+        samples = sorted(samples)
+        index = min(len(samples) - 1, int(len(samples) * self.config["percentile"] / 100))
+        return max(self.config["min_delay_s"], samples[index])
+
+    def delay(self, model):
+        """Через сколько секунд дублировать запрос; None - не дублировать"""
+        if not self.config["enabled"]:
+            return None
+        with self.lock:
+            samples = list(self.first_token.get(model, ()))
+        return self._percentile_delay(samples)
+
+    def on_request(self):
+        with self.lock:
+            self.requests += 1
+            self.credits = min(self.config["burst"], self.credits + self.config["budget"])
+
+    def try_hedge(self):
+        with self.lock:
+            if self.credits < 1:
+                self.denied += 1
+                return False
+            self.credits -= 1
+            self.hedges += 1
+            return True
+
+    def on_hedge_win(self):
+        with self.lock:
+            self.wins += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "enabled": self.config["enabled"],
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_wins": self.wins,
+                "denied": self.denied,
+                "hedge_rate": self.hedges / self.requests if self.requests else None,
+                "delay_s": {model: self._percentile_delay(list(samples))
+                            for model, samples in self.first_token.items()}
+            }
+
+
+hedge_policy = HedgePolicy()
+
+
+def close_llm_stream(stream):
+    """Закрывает поток ответа: соединение с API рвется, генерация прекращается"""
     try:
-        client = Mistral(api_key=API_KEY)
-
-        # Создаем менеджер контекста с текущими настройками
-        context_manager = ContextManager(
-            max_messages=CONTEXT_CONFIG["max_messages"],
-            max_tokens=CONTEXT_CONFIG["max_tokens"], 
-            summary_enabled=CONTEXT_CONFIG["summary_enabled"]
-        )
-        
-        # Оптимизируем контекст
-        optimized_history = context_manager.optimize_context(conversation_history)
-        
-        messages = []
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
+        stream.__exit__(None, None, None)
+    except Exception as e:
+        logger.debug("Ошибка закрытия потока LLM: %s", e)
+
+
+def start_llm_stream(client, model, messages, timeout_ms, policy):
+    """Запрос потока, ожидание первого события: (поток, итератор событий)"""
+    started = time.monotonic()
+    stream = client.chat.stream(model=model, messages=messages, timeout_ms=timeout_ms)
+    events = iter(stream)
+    first = next(events, None)
+    policy.observe(model, time.monotonic() - started)
+    return stream, events if first is None else itertools.chain([first], events)
+
+
+class StreamAttempt:
+    """Запрос потока к модели; первое событие ждет в отдельном потоке
+
+    Так ожидание можно прервать отменой хода, а медленный запрос - продублировать.
+    """
+
+    def __init__(self, client, model, messages, timeout_ms, changed, policy):
+        self.model = model
+        self.changed = changed
+        self.policy = policy
+        self.started = time.monotonic()
+        self.finished = None
+        self.stream = None
+        self.events = None
+        self.error = None
+        self.abandoned = False
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        threading.Thread(target=self._run, args=(client, messages, timeout_ms),
+                         name="llm-attempt", daemon=True).start()
+
+    def _run(self, client, messages, timeout_ms):
+        try:
+            stream, events = start_llm_stream(client, self.model, messages, timeout_ms,
+                                              self.policy)
+            with self.lock:
+                self.stream = stream
+                self.events = events
+                abandoned = self.abandoned
+            if abandoned:
+                close_llm_stream(stream)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished = time.monotonic()
+            self.done.set()
+            self.changed.set()
+
+    @property
+    def succeeded(self):
+        return self.done.is_set() and self.error is None
+
+    def abandon(self):
+        with self.lock:
+            self.abandoned = True
+            stream = self.stream
+        if stream is not None:
+            close_llm_stream(stream)
+
+
+def open_llm_stream(client, model, messages, timeout_ms, turn=None, policy=None, losers=None):
+    """Открывает поток ответа модели: (поток, итератор событий)
+
+    Если первое событие задерживается дольше hedge-задержки и бюджет позволяет,
+    отправляет дубль и берет поток, начавшийся раньше. Поток закрывает
+    вызывающий (close_llm_stream). Исход запроса, чей поток возвращен (или чья
+    ошибка проброшена), учитывает в автомате защиты вызывающий; остальные
+    отправленные запросы учитываются здесь, их длительность добавляется в losers.
+    """
+    policy = policy or hedge_policy
+    policy.on_request()
+    delay = policy.delay(model)
+    if delay is None:
+        # Дубля не будет - лишний поток для ожидания не нужен
+        return start_llm_stream(client, model, messages, timeout_ms, policy)
+    breaker = get_llm_breaker(model)
+    changed = threading.Event()
+    attempts = [StreamAttempt(client, model, messages, timeout_ms, changed, policy)]
+    deadline = attempts[0].started + delay
+    winner = None
+    try:
+        while winner is None:
+            changed.clear()
+            if turn is not None:
+                turn.check()
+            winner = next((attempt for attempt in attempts if attempt.succeeded), None)
+            if winner is not None:
+                break
+            if all(attempt.done.is_set() for attempt in attempts):
+                # Ошибка до дубля пробрасывается сразу - ее разбирает generate_reply
+                raise attempts[0].error
+
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                deadline = None
+                # Дубль - такой же запрос к модели: в half_open автомат его не пустит
+                if breaker.allow() and policy.try_hedge():
+                    record_metric("llm_hedges")
+                    logger.info("Модель %s не ответила за %.1f с, дублируем запрос",
+                                model, delay, extra={"event": "llm_hedge"})
+                    attempts.append(StreamAttempt(client, model, messages, timeout_ms,
+                                                  changed, policy))
+                else:
+                    record_metric("llm_hedge_denied")
+                continue
 
-        messages.extend(optimized_history)
-        messages.append({"role": "user", "content": prompt})
-        
-        # Логируем информацию о контексте для отладки
-        total_messages = len(messages)
-        estimated_tokens = sum(context_manager.estimate_tokens(msg["content"]) for msg in messages)
-        logger.debug(f"Отправка в API: {total_messages} сообщений, ~{estimated_tokens} токенов")
+            timeouts = [deadline - now] if deadline is not None else []
+            if turn is not None:
+                timeouts.append(TURN_PROBE_INTERVAL_S)
+            changed.wait(min(timeouts) if timeouts else None)
+    finally:
+        for attempt in attempts:
+            if attempt is not winner:
+                attempt.abandon()
+        for attempt in attempts:
+            if attempt is (winner or attempts[0]):
+                continue
+            latency = (attempt.finished or time.monotonic()) - attempt.started
+            if attempt.error is not None:
+                breaker.record(is_breaker_failure(attempt.error), latency)
+            elif winner is not None:
+                breaker.record(False, latency)
+            else:
+                # Ход отменен - исход запроса неизвестен
+                breaker.release()
+            if losers is not None:
+                losers.append(latency)
+
+    if winner is not attempts[0]:
+        policy.on_hedge_win()
+        record_metric("llm_hedge_wins")
+    return winner.stream, winner.events
+
+
+# Учет расхода LLM по пользователям и чатам.
+# Вызовы только складывают счетчики в памяти; в users.db (llm_usage, строка на
+# день, пользователя, чат, маршрут и модель) они пишутся пачкой фоновым
+# потоком раз в flush_interval_s и при остановке. Дневные суммы пользователей
+# тоже в памяти (при старте читаются из базы) - по ним до запроса к модели
+# проверяются лимиты; 0 - без лимита. Сутки считаются по UTC.
+USAGE_CONFIG = {
+    "flush_interval_s": float(os.environ.get("USAGE_FLUSH_INTERVAL_S", "10")),
+    "daily_tokens": int(os.environ.get("USAGE_DAILY_TOKENS", "0")),
+    "daily_llm_s": float(os.environ.get("USAGE_DAILY_LLM_S", "0"))
+}
+
+
+class QuotaExceededError(Exception):
+    """Дневной лимит пользователя исчерпан - запрос к модели не отправлялся"""
+
+
+def usage_day():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d')
+
+
+class UsageAccountant:
+    """Счетчики токенов и времени LLM с пакетной записью в SQLite"""
+
+    def __init__(self, db_path='users.db', config=USAGE_CONFIG):
+        self.db_path = db_path
+        self.config = config
+        # (день, user_id, chat_id, маршрут, модель) -> [запросы, prompt, completion, мс]
+        self.pending = {}
+        # user_id -> [токены, секунды LLM] за день self.day
+        self.day = usage_day()
+        self.today = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def _roll_day(self):
+        day = usage_day()
+        if day != self.day:
+            self.day = day
+            self.today = {}
+
+    def load_today(self):
+        """Дневные суммы из базы - после перезапуска лимиты не обнуляются"""
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            rows = conn.execute(
+                '''SELECT user_id, SUM(prompt_tokens + completion_tokens), SUM(llm_ms)
+                   FROM llm_usage WHERE day = ? GROUP BY user_id''', (usage_day(),)).fetchall()
+        finally:
+            conn.close()
+        with self.lock:
+            self._roll_day()
+            for user_id, tokens, llm_ms in rows:
+                totals = self.today.setdefault(user_id, [0, 0.0])
+                totals[0] += tokens or 0
+                totals[1] += (llm_ms or 0) / 1000
+
+    def record(self, user_id, chat_id, route, model, prompt_tokens, completion_tokens,
+               seconds):
+        with self.lock:
+            self._roll_day()
+            key = (self.day, user_id, chat_id, route, model)
+            row = self.pending.setdefault(key, [0, 0, 0, 0])
+            row[0] += 1
+            row[1] += prompt_tokens
+            row[2] += completion_tokens
+            row[3] += round(seconds * 1000)
+            totals = self.today.setdefault(user_id, [0, 0.0])
+            totals[0] += prompt_tokens + completion_tokens
+            totals[1] += seconds
+
+    def used_today(self, user_id):
+        """(токены, секунды LLM) пользователя за сегодня"""
+        with self.lock:
+            self._roll_day()
+            tokens, seconds = self.today.get(user_id, (0, 0.0))
+        return tokens, seconds
+
+    def check_quota(self, user_id):
+        tokens, seconds = self.used_today(user_id)
+        if self.config["daily_tokens"] and tokens >= self.config["daily_tokens"]:
+            raise QuotaExceededError(
+                f"Дневной лимит токенов исчерпан ({tokens} из {self.config['daily_tokens']})")
+        if self.config["daily_llm_s"] and seconds >= self.config["daily_llm_s"]:
+            raise QuotaExceededError(
+                f"Дневной лимит времени ГМ исчерпан ({round(seconds)} из "
+                f"{round(self.config['daily_llm_s'])} с)")
+
+    def quota_exceeded(self, user_id):
+        try:
+            self.check_quota(user_id)
+        except QuotaExceededError:
+            return True
+        return False
+
+    def flush(self):
+        """Пишет накопленное одной транзакцией; при ошибке вернет пачку в очередь"""
+        with self.lock:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return 0
+        try:
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            try:
+                with conn:
+                    conn.executemany(
+                        '''INSERT INTO llm_usage (day, user_id, chat_id, route, model, requests,
+                                                  prompt_tokens, completion_tokens, llm_ms)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                           ON CONFLICT (day, user_id, chat_id, route, model) DO UPDATE SET
+                               requests = requests + excluded.requests,
+                               prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                               completion_tokens = completion_tokens + excluded.completion_tokens,
+                               llm_ms = llm_ms + excluded.llm_ms''',
+                        [key + tuple(row) for key, row in batch.items()])
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning("Не удалось записать расход LLM: %s", e)
+            with self.lock:
+                for key, row in batch.items():
+                    pending = self.pending.setdefault(key, [0, 0, 0, 0])
+                    for index, value in enumerate(row):
+                        pending[index] += value
+            return 0
+        return len(batch)
+
+    def start(self):
+        """Фоновая запись раз в flush_interval_s"""
+
+        def loop():
+            while not self.stop_event.wait(self.config["flush_interval_s"]):
+                self.flush()
+
+        threading.Thread(target=loop, name="usage-flush", daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.flush()
+
+
+usage_accountant = UsageAccountant()
+
+
+def current_usage_owner():
+    """(user_id, chat_id), на счет которых идет вызов LLM в этом потоке, или None"""
+    turn = getattr(llm_stream, 'turn', None)
+    if turn is not None:
+        return turn.key
+    if has_request_context() and 'user_id' in session:
+        data = request.get_json(silent=True)
+        chat_id = data.get('chat_id') if isinstance(data, dict) else None
+        return session['user_id'], chat_id or session.get('current_chat_id') or 'default'
+    return None
+
+
+@app.route('/admin/usage', methods=['GET'])
+@admin_required
+def get_usage():
+    """Расход LLM за последние days дней: по пользователям, дням и (для ?user=) чатам"""
+    try:
+        days = max(1, min(int(request.args.get('days', 7)), 366))
+    except ValueError:
+        return jsonify({"error": "days должно быть числом"})
+    since = (datetime.now(timezone.utc) - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    # Свежие счетчики из памяти тоже попадают в отчет
+    usage_accountant.flush()
+
+    conn = sqlite3.connect('users.db')
+    conn.row_factory = sqlite3.Row
+    try:
+        user_filter, params = "", [since]
+        username = request.args.get('user')
+        if username:
+            row = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
+            if row is None:
+                return jsonify({"error": "Пользователь не найден"})
+            user_filter, params = " AND u.user_id = ?", [since, row['id']]
+
+        totals = '''SUM(u.requests) AS requests, SUM(u.prompt_tokens) AS prompt_tokens,
+                    SUM(u.completion_tokens) AS completion_tokens,
+                    ROUND(SUM(u.llm_ms) / 1000.0, 1) AS llm_s'''
+        users = conn.execute(f'''
+            SELECT u.user_id, users.username, {totals}
+            FROM llm_usage u LEFT JOIN users ON users.id = u.user_id
+            WHERE u.day >= ?{user_filter}
+            GROUP BY u.user_id ORDER BY SUM(u.prompt_tokens + u.completion_tokens) DESC''',
+                             params).fetchall()
+        daily = conn.execute(f'''
+            SELECT u.day, {totals} FROM llm_usage u
+            WHERE u.day >= ?{user_filter} GROUP BY u.day ORDER BY u.day''', params).fetchall()
+        chats = []
+        if username:
+            chats = conn.execute(f'''
+                SELECT u.chat_id, u.route, u.model, {totals} FROM llm_usage u
+                WHERE u.day >= ?{user_filter} GROUP BY u.chat_id, u.route, u.model
+                ORDER BY SUM(u.prompt_tokens + u.completion_tokens) DESC''',
+                                 params).fetchall()
+    finally:
+        conn.close()
+
+    result_users = []
+    for row in users:
+        tokens_today, seconds_today = usage_accountant.used_today(row['user_id'])
+        result_users.append(dict(row, today_tokens=tokens_today,
+                                 today_llm_s=round(seconds_today, 1)))
+    return jsonify({
+        "since": since,
+        "quotas": {"daily_tokens": USAGE_CONFIG["daily_tokens"],
+                   "daily_llm_s": USAGE_CONFIG["daily_llm_s"]},
+        "users": result_users,
+        "daily": [dict(row) for row in daily],
+        "chats": [dict(row) for row in chats]
+    })
 
-        chat_response = client.chat.complete(model=MODEL, messages=messages)
 
+def generate_reply(prompt, system_prompt="", conversation_history=[], route="narration",
+                   owner=None):
+    """Запрос к модели маршрута route без обработки ошибок
+
+    Возвращает (обработанный ответ, потрачено токенов). Если основная модель
+    ограничивает скорость или отключена автоматом защиты, отвечает запасная.
+    Ошибки API пробрасываются (CircuitOpenError - если все модели маршрута
+    отключены, QuotaExceededError - если исчерпан дневной лимит) - для показа
+    игроку используйте chat_with_ai. owner - (user_id, chat_id) для учета
+    расхода; по умолчанию берется из хода ГМ или запроса.
+    """
+    owner = owner or current_usage_owner()
+    if owner is not None:
+        usage_accountant.check_quota(owner[0])
+
+    config = MODEL_ROUTES[route]
+    models = [config["model"]]
+    if config["fallback"]:
+        if route_rate_limited_until.get(route, 0) > time.monotonic():
+            models = [config["fallback"]]
+        else:
+            models.append(config["fallback"])
+
+    last_error = None
+    for attempt, model in enumerate(models):
+        breaker = get_llm_breaker(model)
+        if not breaker.allow():
+            # Быстрый отказ вместо ожидания заведомо неудачного запроса
+            record_metric(f"llm_{route}_rejected")
+            last_error = CircuitOpenError(model, breaker.retry_after())
+            continue
+        parts = []
+        losers = []
+        started = time.monotonic()
+
+        def charge_losers(prompt_tokens):
+            # Проигравшие дубли тоже отправлены: платим хотя бы за запрос
+            if owner is not None:
+                for latency in losers:
+                    usage_accountant.record(*owner, route, model, prompt_tokens, 0, latency)
+            return prompt_tokens * len(losers)
+
+        try:
+            content, prompt_tokens, completion_tokens = call_model(
+                model, prompt, system_prompt, conversation_history, config["timeout_s"], parts,
+                losers)
+        except GenerationCancelled as e:
+            # Отмена - не сбой модели и не повод переключаться на запасную
+            breaker.release()
+            if owner is not None and e.spent:
+                usage_accountant.record(*owner, route, model, *e.spent,
+                                        time.monotonic() - started)
+            charge_losers(e.spent[0] if e.spent else 0)
+            raise
+        except Exception as e:
+            breaker.record(is_breaker_failure(e), time.monotonic() - started)
+            spent = getattr(e, 'spent', None)
+            if owner is not None and spent:
+                usage_accountant.record(*owner, route, model, *spent,
+                                        time.monotonic() - started)
+            charge_losers(spent[0] if spent else 0)
+            record_metric(f"llm_{route}_errors")
+            # Часть ответа уже ушла вкладкам - начать заново другой моделью нельзя
+            if parts or attempt == len(models) - 1 or not is_rate_limited(e):
+                raise
+            with route_stats_lock:
+                route_rate_limited_until[route] = time.monotonic() + MODEL_RATE_LIMIT_COOLDOWN_S
+            record_metric(f"llm_{route}_fallbacks")
+            logger.warning("Модель %s ограничивает скорость, маршрут %s переключен на %s",
+                           model, route, models[attempt + 1],
+                           extra={"event": "llm_fallback"})
+            continue
+        latency = time.monotonic() - started
+        breaker.record(False, latency)
+        tokens = prompt_tokens + completion_tokens + charge_losers(prompt_tokens)
+        record_route_call(route, model, latency, tokens)
+        if owner is not None:
+            usage_accountant.record(*owner, route, model, prompt_tokens, completion_tokens,
+                                    latency)
+        return content, tokens
+    raise last_error
+
+
+def call_model(model, prompt, system_prompt, conversation_history, timeout_s, parts,
+               losers=None):
+    """Один запрос к модели: (обработанный ответ, токенов запроса, токенов ответа)
+
+    Части потокового ответа складываются в parts, длительности дублей, чей
+    ответ не понадобился, - в losers (см. open_llm_stream).
+    """
+    client = get_llm_client()
+
+    # Контекст подбирается под целевое время ответа модели
+    messages, prompt_tokens = build_llm_messages(model, prompt, system_prompt,
+                                                 conversation_history)
+    logger.debug("Отправка в API %s: %s сообщений, ~%s токенов",
+                 model, len(messages), prompt_tokens,
+                 extra={"event": "llm_request"})
+
+    turn = getattr(llm_stream, 'turn', None)
+    if turn is not None:
+        try:
+            turn.check()
+        except GenerationCancelled as e:
+            e.spent = record_cancelled_generation(e.reason, model, prompt_tokens, parts,
+                                                  sent=False)
+            raise
+
+    started = time.monotonic()
+    timeout_ms = int(timeout_s * 1000)
+    on_delta = getattr(llm_stream, 'listener', None)
+    usage = None
+    if on_delta or turn is not None or HEDGE_CONFIG["enabled"]:
+        # Ответ ждут по частям (вкладки по WebSocket), его может понадобиться
+        # прервать или продублировать - стримим; закрытие потока рвет соединение
+        # с API, и генерация на стороне Mistral останавливается
+        try:
+            stream, events = open_llm_stream(client, model, messages, timeout_ms, turn,
+                                             losers=losers)
+        except GenerationCancelled as e:
+            e.spent = record_cancelled_generation(e.reason, model, prompt_tokens, parts)
+            raise
+        try:
+            for event in events:
+                if turn is not None:
+                    try:
+                        turn.check()
+                    except GenerationCancelled as e:
+                        e.spent = record_cancelled_generation(e.reason, model,
+                                                              prompt_tokens, parts)
+                        raise
+                # usage приходит в последнем событии потока
+                usage = getattr(event.data, 'usage', None) or usage
+                if not event.data.choices:
+                    continue
+                delta = event.data.choices[0].delta.content
+                if isinstance(delta, str) and delta:
+                    parts.append(delta)
+                    if on_delta:
+                        on_delta(delta)
+        except GenerationCancelled:
+            raise
+        except Exception as e:
+            if parts:
+                # Поток оборвался на середине - сгенерированное провайдер уже посчитал
+                e.spent = (prompt_tokens, ContextManager().estimate_tokens("".join(parts)))
+            raise
+        finally:
+            close_llm_stream(stream)
+        content = "".join(parts)
+    else:
+        chat_response = client.chat.complete(model=model, messages=messages,
+                                             timeout_ms=timeout_ms)
         content = chat_response.choices[0].message.content
-        processed_content = process_content(content)
+        usage = chat_response.usage
+    context_controller.observe(model, prompt_tokens, time.monotonic() - started)
+
+    completion_tokens = getattr(usage, 'completion_tokens', None)
+    if completion_tokens is None:
+        completion_tokens = ContextManager().estimate_tokens(content)
+    observe_reply_tokens(model, completion_tokens)
+    # Провайдер считает токены точнее нашей оценки
+    prompt_tokens = getattr(usage, 'prompt_tokens', None) or prompt_tokens
+
+    return process_content(content), prompt_tokens, completion_tokens
+
+
+# Средняя длина ответа модели в токенах - для оценки сэкономленного отменой
+REPLY_TOKENS_DEFAULT = 600
+reply_tokens_avg = {}
+reply_tokens_lock = threading.Lock()
+
+
+def observe_reply_tokens(model, completion_tokens):
+    with reply_tokens_lock:
+        previous = reply_tokens_avg.get(model)
+        reply_tokens_avg[model] = (completion_tokens if previous is None
+                                   else previous * 0.9 + completion_tokens * 0.1)
 
-        return processed_content
+
+def record_cancelled_generation(reason, model, prompt_tokens, parts, sent=True):
+    """Метрики отмены: сколько токенов не сгенерировано и сколько потрачено зря
+
+    Возвращает потраченное (токенов запроса, токенов ответа) - для учета расхода.
+    """
+    with reply_tokens_lock:
+        expected = reply_tokens_avg.get(model, REPLY_TOKENS_DEFAULT)
+    generated = ContextManager().estimate_tokens("".join(parts))
+    saved = max(0, round(expected) - generated)
+    if not sent:
+        saved += prompt_tokens
+    record_metric("llm_cancelled")
+    record_metric(f"llm_cancelled_{reason}")
+    record_metric("llm_tokens_saved", saved)
+    if sent:
+        record_metric("llm_tokens_wasted", prompt_tokens + generated)
+    logger.info("Генерация %s прервана (%s): ~%s токенов сэкономлено",
+                model, reason, saved, extra={"event": "llm_cancelled"})
+    return (prompt_tokens, generated) if sent else None
+
+
+class LLMErrorResponse(str):
+    """Текст ошибки для игрока вместо ответа ГМ - в историю чата не записывается"""
+
+
+def cancelled_reply(error):
+    """Сообщение игроку об отмененном ходе ГМ"""
+    if error.reason == "superseded":
+        return LLMErrorResponse("↩️ Ответ ГМ отменен: в чате начат новый ход.")
+    return LLMErrorResponse("↩️ Ответ ГМ отменен: соединение закрыто.")
+
+
+def chat_with_ai(prompt, system_prompt="", conversation_history=[], route="narration"):
+    """Ответ модели или LLMErrorResponse с понятным игроку текстом ошибки"""
+    if not API_KEY:
+        return LLMErrorResponse(
+            "🔑 **Ошибка**: API ключ Mistral не найден. Добавьте MISTRAL_API_KEY в Secrets.")
+
+    turn = getattr(llm_stream, 'turn', None)
+    try:
+        response, _ = generate_reply(prompt, system_prompt, conversation_history, route)
+        if turn is not None and turn.cancelled.is_set():
+            # Ответ успел прийти целиком, но ход уже сменился - не сохраняем
+            record_metric("llm_cancelled_late")
+            raise GenerationCancelled(turn.reason)
+        return response
+
+    except QuotaExceededError as e:
+        return LLMErrorResponse(f"⛔ **{e}**. Лимит обновится в полночь по UTC.")
+
+    except GenerationCancelled as e:
+        return cancelled_reply(e)
+
+    except CircuitOpenError as e:
+        return LLMErrorResponse(
+            f"🔌 **ГМ временно недоступен**: сервис Mistral не отвечает. "
+            f"Попробуйте через {max(1, round(e.retry_after))} с.")
 
     except Exception as e:
         error_str = str(e)
 
         # Специальная обработка ошибки лимитов
         if "Service tier capacity exceeded" in error_str or "Status 429" in error_str:
-            return """⚠️ **Превышен лимит API Mistral**
+            return LLMErrorResponse("""⚠️ **Превышен лимит API Mistral**
 
 Возможные решения:
 1. Подождите несколько минут и попробуйте снова
 2. Проверьте ваш тарифный план на mistral.ai
 3. Обновите API ключ или тарифный план
 
-Попробуйте отправить сообщение позже."""
+Попробуйте отправить сообщение позже.""")
 
         elif "API key" in error_str or "401" in error_str:
-            return "🔑 **Ошибка авторизации**: Проверьте правильность API ключа Mistral в Secrets."
+            return LLMErrorResponse(
+                "🔑 **Ошибка авторизации**: Проверьте правильность API ключа Mistral в Secrets.")
 
         elif "Rate limit" in error_str:
-            return "⏱️ **Превышена скорость запросов**: Подождите немного перед следующим сообщением."
+            return LLMErrorResponse(
+                "⏱️ **Превышена скорость запросов**: Подождите немного перед следующим сообщением.")
 
         else:
-            return f"❌ **Ошибка Mistral AI**: {error_str}"
+            return LLMErrorResponse(f"❌ **Ошибка Mistral AI**: {error_str}")
+
+
+# Статические ресурсы: при запуске исходники из static/ минифицируются,
+# получают имя с хешем содержимого и отдаются с вечным кэшированием
+STATIC_ASSETS = {
+    "game.css": ("css/game.css", "text/css"),
+    "game.js": ("js/game.js", "text/javascript"),
+}
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+# логическое имя -> собранный ресурс; имя с хешем -> тот же ресурс
+asset_bundles = {}
+asset_files = {}
+
+
+# Строки CSS и комментарии; строки остаются как есть
+CSS_TOKEN_RE = re.compile(r'(/\*.*?\*/|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\')', re.DOTALL)
+
+
+def minify_css(source):
+    """Убирает комментарии и лишние пробелы из CSS, не трогая строки в кавычках"""
+    def compact(code):
+        code = re.sub(r'\s+', ' ', code)
+        code = re.sub(r'\s*([{};,>])\s*', r'\1', code)
+        code = re.sub(r':\s+', ':', code)
+        return code.replace(';}', '}')
+
+    parts = []
+    code = ''
+    for index, part in enumerate(CSS_TOKEN_RE.split(source)):
+        if not index % 2:
+            code += part
+        elif not part.startswith('/*'):
+            parts.extend([compact(code), part])
+            code = ''
+    parts.append(compact(code))
+    return ''.join(parts).strip()
+
+
+# После этих символов "/" начинает регулярное выражение, а не деление
+JS_REGEX_PRECEDERS = set('(,=:[!&|?{};+-*%<>~^')
+
+
+def skip_js_regex(source, start):
+    """Индекс после регулярного выражения, начатого в start, или start + 1"""
+    position = start + 1
+    in_class = False
+    while position < len(source) and source[position] != '\n':
+        char = source[position]
+        if char == '\\':
+            position += 2
+            continue
+        if char == '[':
+            in_class = True
+        elif char == ']':
+            in_class = False
+        elif char == '/' and not in_class:
+            return position + 1
+        position += 1
+    return start + 1
+
+
+def js_line_states(source):
+    """Для каждой строки JS: (начинается в коде, заканчивается в коде)
+
+    "Не в коде" - внутри строки, шаблонной строки или комментария. Разбор
+    упрощенный: выражения ${...} внутри шаблонов не разбираются.
+    """
+    states = []
+    state = line_start = 'code'
+    previous = ''  # последний значимый символ кода
+    position = 0
+    while position < len(source):
+        char = source[position]
+        if char == '\n':
+            if state == 'line_comment':
+                state = 'code'
+            states.append((line_start == 'code', state == 'code'))
+            line_start = state
+        elif state == 'code':
+            if char in '\'"`':
+                state = char
+            elif source.startswith('//', position):
+                state = 'line_comment'
+            elif source.startswith('/*', position):
+                state = 'block_comment'
+                position += 1
+            elif char == '/' and (not previous or previous in JS_REGEX_PRECEDERS):
+                position = skip_js_regex(source, position)
+                previous = '/'
+                continue
+            elif not char.isspace():
+                previous = char
+        elif state == 'block_comment':
+            if source.startswith('*/', position):
+                state = 'code'
+                position += 1
+        elif state in '\'"`':
+            if char == '\\' and source[position + 1:position + 2] != '\n':
+                position += 2
+                continue
+            if char == state:
+                state = 'code'
+                previous = char
+        position += 1
+    states.append((line_start == 'code', state == 'code'))
+    return states
+
+
+def minify_js(source):
+    """Убирает отступы, пустые строки и строки-комментарии из JS
+
+    Переводы строк сохраняются, чтобы не сломать автоподстановку точек с запятой.
+    Строки, начинающиеся или заканчивающиеся внутри шаблонной строки или
+    комментария, с этой стороны не меняются.
+    """
+    lines = []
+    for line, (starts_in_code, ends_in_code) in zip(source.split('\n'), js_line_states(source)):
+        if starts_in_code:
+            line = line.lstrip()
+            if ends_in_code and (not line or line.startswith('//')):
+                continue
+        if ends_in_code:
+            line = line.rstrip()
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def build_static_assets():
+    """Собирает минифицированные ресурсы с хешем содержимого в имени"""
+    minifiers = {"text/css": minify_css, "text/javascript": minify_js}
+
+    for name, (source_path, mimetype) in STATIC_ASSETS.items():
+        with open(os.path.join(app.static_folder, source_path), 'r', encoding='utf-8') as f:
+            data = minifiers[mimetype](f.read()).encode('utf-8')
+
+        content_hash = hashlib.sha256(data).hexdigest()[:12]
+        base, ext = os.path.splitext(name)
+        asset = {
+            "filename": f"{base}.{content_hash}.min{ext}",
+            "hash": content_hash,
+            "mimetype": mimetype,
+            "data": data,
+            # Сжимаем один раз при сборке, а не на каждый запрос
+            "gzip": gzip.compress(data, compresslevel=9),
+            "br": brotli.compress(data) if brotli is not None else None,
+        }
+        asset_bundles[name] = asset
+        asset_files[asset["filename"]] = asset
+
+    logger.info("Собраны статические ресурсы: %s",
+                ", ".join(asset["filename"] for asset in asset_bundles.values()))
+
+
+def asset_url(name):
+    """URL собранного ресурса для шаблонов: {{ asset_url('game.js') }}"""
+    if name not in asset_bundles:
+        build_static_assets()
+    return url_for('serve_asset', filename=asset_bundles[name]["filename"])
+
+
+app.jinja_env.globals['asset_url'] = asset_url
+
+
+@app.route('/assets/<filename>')
+def serve_asset(filename):
+    """Отдает собранный ресурс с неизменяемым кэшированием"""
+    asset = asset_files.get(filename)
+    if not asset:
+        abort(404)
+
+    encoding = choose_content_encoding()
+    if encoding and asset.get(encoding):
+        response = app.response_class(asset[encoding], mimetype=asset["mimetype"])
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = app.response_class(asset["data"], mimetype=asset["mimetype"])
+
+    response.vary.add('Accept-Encoding')
+    response.set_etag(asset["hash"])
+    response.cache_control.public = True
+    response.cache_control.max_age = ASSET_MAX_AGE
+    response.cache_control.immutable = True
+    return response
 
 
 # Веб-интерфейс
@@ -438,6 +2846,8 @@ def login():
 
 @app.route('/logout', methods=['POST'])
 def logout():
+    if 'user_id' in session:
+        cancel_opening_scenes(session['user_id'])
     session.clear()
     return jsonify({"success": True})
 
@@ -453,64 +2863,41 @@ def get_user_info():
 
 @app.route('/get_saves', methods=['GET'])
 @login_required
+@conditional_get("saves")
 def get_saves():
     """Получает список сохранений пользователя"""
-    user_folder = get_user_folder(session['username'], session['user_id'])
-    saves_folder = os.path.join(user_folder, "saves")
+    return jsonify({"saves": list_saves()})
 
-    saves = []
-    if os.path.exists(saves_folder):
-        for filename in os.listdir(saves_folder):
-            if filename.endswith('.json'):
-                filepath = os.path.join(saves_folder, filename)
-                try:
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        save_data = json.load(f)
-                    saves.append({
-                        "filename":
-                        filename[:-5],  # убираем .json
-                        "timestamp":
-                        save_data.get('timestamp', 'Неизвестно'),
-                        "character_name":
-                        save_data.get('character_name', 'Неизвестный персонаж')
-                    })
-                except:
-                    continue
 
-    return jsonify({"saves": saves})
+def list_saves():
+    """Список сохранений для UI"""
+    return [{
+        "filename": save["filename"],
+        "timestamp": save["timestamp"],
+        "character_name": save["character_name"]
+    } for save in get_storage_index("saves").values()]
 
 
 @app.route('/get_characters', methods=['GET'])
 @login_required
+@conditional_get("characters")
 def get_characters():
     """Получает список персонажей пользователя"""
-    user_folder = get_user_folder(session['username'], session['user_id'])
-    characters_folder = os.path.join(user_folder, "characters")
+    return jsonify({"characters": list_characters()})
 
-    characters = []
-    if os.path.exists(characters_folder):
-        for filename in os.listdir(characters_folder):
-            if filename.endswith('.json'):
-                filepath = os.path.join(characters_folder, filename)
-                try:
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        char_data = json.load(f)
-                    characters.append({
-                        "filename":
-                        filename[:-5],  # убираем .json
-                        "name":
-                        char_data.get('name', filename[:-5]),
-                        "description":
-                        char_data.get('description', '')[:100] + '...'
-                    })
-                except:
-                    continue
 
-    return jsonify({"characters": characters})
+def list_characters():
+    """Список персонажей для UI: описание обрезается до 100 символов"""
+    return [{
+        "filename": character["filename"],
+        "name": character["name"],
+        "description": character["description"][:100] + '...'
+    } for character in get_storage_index("characters").values()]
 
 
 @app.route('/get_chats', methods=['GET'])
 @login_required
+@conditional_get("chats", "characters")
 def get_chats():
     """Получает список чатов пользователя с информацией о персонажах"""
     user_folder = get_user_folder(session['username'], session['user_id'])
@@ -519,50 +2906,540 @@ def get_chats():
     if not os.path.exists(chats_folder):
         os.makedirs(chats_folder, exist_ok=True)
 
+    # Файлы чатов в памяти могут отставать - такие чаты берем из памяти
+    active = dict(game_states.active_chats(user_folder))
     chats = {}
-    for filename in os.listdir(chats_folder):
-        if filename.endswith('.json'):
-            filepath = os.path.join(chats_folder, filename)
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    chat_data = json.load(f)
-
-                chat_id = filename[:-5]  # убираем .json
+    for chat_id, chat_data in scan_json_folder(chats_folder):
+        try:
+            chat_data = chat_view(active.get(chat_id) or ensure_chat_sequence(chat_data))
 
-                # Добавляем информацию о персонаже для UI
-                character_desc, character_name = get_chat_character(chat_data)
-                if character_name:
-                    chat_data['character_name'] = character_name
+            # Добавляем информацию о персонаже для UI
+            character_desc, character_name = get_chat_character(chat_data)
+            if character_name:
+                chat_data['character_name'] = character_name
 
-                chats[chat_id] = chat_data
-            except:
-                continue
+            chats[chat_id] = chat_data
+        except:
+            continue
 
     # Если нет чатов, создаем основной
     if not chats:
-        default_chat = {
-            "name": "Основной чат",
-            "messages": [],
-            "character_id": None,
-            "created_at": datetime.now().isoformat()
-        }
-        chats['default'] = default_chat
-        save_chat_file('default', default_chat)
+        chats['default'] = create_default_chat()
 
     return jsonify({"chats": chats})
 
 
+def create_default_chat():
+    """Создает основной чат для пользователя без чатов"""
+    default_chat = {
+        "name": "Основной чат",
+        "messages": [],
+        "character_id": None,
+        "created_at": datetime.now().isoformat()
+    }
+    save_chat_file('default', default_chat)
+    return default_chat
+
+
+def list_chat_manifests():
+    """Манифест чатов для UI с именами персонажей из индекса персонажей"""
+    chats = get_storage_index("chats")
+    if not chats:
+        create_default_chat()
+        chats = get_storage_index("chats")
+
+    # У старых персонажей нет id - такие не сопоставляются ни с одним чатом
+    characters_by_id = {
+        character["id"]: character
+        for character in get_storage_index("characters").values()
+        if character["id"] and character["id"] != 'None'
+    }
+    manifests = {}
+    for chat_id, manifest in chats.items():
+        manifest = dict(manifest)
+        character = characters_by_id.get(manifest["character_id"])
+        if character:
+            manifest["character_name"] = character["name"]
+        manifests[chat_id] = manifest
+    return manifests
+
+
+def storage_token(*kinds):
+    """Токен версии раздела для частичного обновления /bootstrap"""
+    return ".".join([STORAGE_EPOCH] +
+                    [str(get_storage_version(kind)[0]) for kind in kinds])
+
+
+# Раздел /bootstrap -> (разделы хранилища, от которых он зависит, построитель)
+BOOTSTRAP_SECTIONS = {
+    "chats": (("chats", "characters"), list_chat_manifests),
+    "characters": (("characters",), list_characters),
+    "saves": (("saves",), list_saves),
+}
+
+
+@app.route('/bootstrap', methods=['GET'])
+@login_required
+def bootstrap():
+    """Все данные для загрузки страницы одним запросом
+
+    Клиент может передать известные ему токены версий (?chats=...&saves=...):
+    неизменившиеся разделы возвращаются как null.
+    """
+    result = {
+        "user": {
+            "username": session['username'],
+            "user_id": session['user_id']
+        },
+        "versions": {}
+    }
+    for section, (kinds, builder) in BOOTSTRAP_SECTIONS.items():
+        token = storage_token(*kinds)
+        if request.args.get(section) == token:
+            result[section] = None
+        else:
+            result[section] = builder()
+            # Построитель мог изменить хранилище (основной чат) - берем свежий токен
+            token = storage_token(*kinds)
+        result["versions"][section] = token
+
+    return jsonify(result)
+
+
+@app.route('/get_chat', methods=['GET'])
+@login_required
+def get_chat():
+    """Получает чат целиком, вместе с сообщениями"""
+    chat_id = request.args.get('chat_id')
+    if not chat_id:
+        return jsonify({"error": "ID чата не указан"})
+
+    chat_data = load_chat_data(chat_id)
+    if chat_data is None:
+        return jsonify({"error": "Чат не найден"})
+
+    character_desc, character_name = get_chat_character(chat_data)
+    if character_name:
+        chat_data['character_name'] = character_name
+
+    return jsonify({"chat_id": chat_id, "chat": chat_view(chat_data)})
+
+
+# Активные чаты в памяти.
+# Загруженный чат - единственный источник истории, веток и персонажа для ходов:
+# load_chat_data отдает копию из памяти, save_chat_file заменяет ее и дописывает
+# в <chat_id>.journal одну строку с изменениями (новые и измененные сообщения,
+# удаленные seq, поля верхнего уровня). Файл чата целиком фоновый поток пишет не
+# позже flush_after_s после первого несохраненного изменения (.part, fsync,
+# os.replace), после чего журнал удаляется. При загрузке журнал проигрывается
+# поверх файла: повтор уже записанных строк ничего не меняет, оборванная
+# последняя строка пропускается. Чаты без обращений дольше idle_s и сверх
+# max_chats (давно не использованные) сбрасываются и выгружаются.
+# journal_fsync: always - fsync каждой строки журнала; batch - только при записи
+# файла чата (сбой процесса не теряет ходов, сбой ОС - не больше flush_after_s);
+# off - без fsync.
+GAME_STATE_CONFIG = {
+    "flush_after_s": float(os.environ.get("CHAT_FLUSH_AFTER_S", "5")),
+    "idle_s": float(os.environ.get("CHAT_IDLE_S", "900")),
+    "max_chats": int(os.environ.get("ACTIVE_CHATS_MAX", "2000")),
+    "journal_fsync": os.environ.get("CHAT_JOURNAL_FSYNC", "always"),
+}
+JOURNAL_SUFFIX = ".journal"
+
+# Отметки сохранений чатов для chat_state_token: возрастают во всем процессе
+chat_commit_stamps = itertools.count(1)
+
+
+def copy_chat_data(chat_data):
+    """Копия чата, которую можно менять, не трогая оригинал
+
+    Сообщения копируются по одному (без вложенных данных), путь активной
+    ветки строится заново из скопированных сообщений.
+    """
+    copied = dict(chat_data)
+    copied['turns'] = [dict(turn) for turn in chat_data['turns']]
+    copied['branches'] = {branch_id: dict(branch)
+                          for branch_id, branch in chat_data['branches'].items()}
+    copied['deleted'] = list(chat_data['deleted'])
+    copied['messages'] = active_chat_path(copied)
+    return copied
+
+
+def chat_journal_record(old, new):
+    """Строка журнала: чем new отличается от old, None если ничем"""
+    old_turns = {turn['seq']: turn for turn in old['turns']}
+    new_seqs = set()
+    upsert = []
+    for turn in new['turns']:
+        new_seqs.add(turn['seq'])
+        if old_turns.get(turn['seq']) != turn:
+            upsert.append(turn)
+    removed = [seq for seq in old_turns if seq not in new_seqs]
+    meta = {key: value for key, value in new.items()
+            if key not in ('turns', 'messages') and (key not in old or old[key] != value)}
+    dropped = [key for key in old if key not in new and key not in ('turns', 'messages')]
+    if not (upsert or removed or meta or dropped):
+        return None
+    return {"meta": meta, "drop": dropped, "upsert": upsert, "removed": removed}
+
+
+def apply_chat_journal(chat_data, record):
+    """Применяет строку журнала к чату (повторное применение ничего не меняет)"""
+    for key in record['drop']:
+        chat_data.pop(key, None)
+    chat_data.update(record['meta'])
+    removed = set(record['removed'])
+    turns = [turn for turn in chat_data['turns'] if turn['seq'] not in removed]
+    positions = {turn['seq']: position for position, turn in enumerate(turns)}
+    for turn in record['upsert']:
+        if turn['seq'] in positions:
+            turns[positions[turn['seq']]] = turn
+        else:
+            positions[turn['seq']] = len(turns)
+            turns.append(turn)
+    chat_data['turns'] = turns
+
+
+def fsync_folder(folder):
+    """fsync каталога - чтобы os.replace и удаление файла пережили сбой ОС"""
+    fd = os.open(folder, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class ChatState:
+    """Загруженный чат: данные, блокировка и отметки для фонового сброса"""
+
+    def __init__(self, user_folder, chat_id, config):
+        self.user_folder = user_folder
+        self.chat_id = chat_id
+        self.config = config
+        self.path = os.path.join(user_folder, "chats", f"{chat_id}.json")
+        self.journal_path = os.path.join(user_folder, "chats", f"{chat_id}{JOURNAL_SUFFIX}")
+        self.lock = threading.Lock()
+        # None - чат еще не загружен (или его нет на диске)
+        self.chat_data = None
+        self.stamp = 0
+        self.dirty_since = None
+        self.last_access = time.monotonic()
+        self.evicted = False
+
+    def load(self):
+        """Читает файл чата и проигрывает журнал; возвращает число строк журнала"""
+        filepath = find_chat_file(self.user_folder, self.chat_id)
+        if filepath is None:
+            # Журнал без файла остается от удаленного чата
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            return 0
+        try:
+            chat_data = ensure_chat_sequence(read_json_file(filepath))
+        except (OSError, ValueError) as e:
+            # Как и раньше, поврежденный чат считается отсутствующим
+            logger.warning("Не удалось прочитать чат %s: %s", filepath, e)
+            return 0
+        replayed = 0
+        if os.path.exists(self.journal_path):
+            intact = 0
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("строка не дописана")
+                        record = json.loads(line)
+                    except ValueError:
+                        # Строка оборвана сбоем - дальше ничего не записано
+                        break
+                    apply_chat_journal(chat_data, record)
+                    replayed += 1
+                    intact += len(line)
+            if intact < os.path.getsize(self.journal_path):
+                # Обрывок отрезаем, иначе следующая строка журнала допишется к нему
+                logger.warning("Журнал чата %s оборван, отрезано %s байт", self.journal_path,
+                               os.path.getsize(self.journal_path) - intact)
+                with open(self.journal_path, 'r+b') as f:
+                    f.truncate(intact)
+            chat_data['messages'] = active_chat_path(chat_data)
+            # Проигранное попадет в файл чата при ближайшем сбросе
+            self.dirty_since = time.monotonic()
+        self.chat_data = chat_data
+        return replayed
+
+    def append_journal(self, record):
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n"
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(line)
+            if self.config["journal_fsync"] == "always":
+                f.flush()
+                os.fsync(f.fileno())
+        return len(line)
+
+    def write_snapshot(self):
+        """Пишет чат целиком и удаляет журнал и сжатую копию"""
+        durable = self.config["journal_fsync"] != "off"
+        stored = {key: value for key, value in self.chat_data.items() if key != 'messages'}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        partial = f"{self.path}.part"
+        with open(partial, 'w', encoding='utf-8') as f:
+            json.dump(stored, f, ensure_ascii=False, indent=2)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(partial, self.path)
+        if durable:
+            # Журнал можно удалять только после того, как файл чата на диске
+            fsync_folder(os.path.dirname(self.path))
+        for path in (self.journal_path, self.path + COLD_SUFFIX):
+            if os.path.exists(path):
+                os.remove(path)
+        self.dirty_since = None
+
+
+class GameStateStore:
+    """Чаты, загруженные в память, с журналом изменений и отложенной записью"""
+
+    def __init__(self, config=GAME_STATE_CONFIG):
+        self.config = config
+        # (папка пользователя, chat_id) -> ChatState, в порядке последнего обращения
+        self.states = OrderedDict()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.stats = Counter()
+
+    @contextmanager
+    def _locked(self, user_folder, chat_id):
+        """ChatState под его блокировкой; при первом обращении чат читается с диска
+
+        Если чата нет и тело его не создало, состояние не остается в памяти.
+        """
+        key = (user_folder, chat_id)
+        while True:
+            with self.lock:
+                state = self.states.get(key)
+                if state is None:
+                    state = self.states[key] = ChatState(user_folder, chat_id, self.config)
+                else:
+                    self.states.move_to_end(key)
+            with state.lock:
+                if state.evicted:
+                    # Выгружено, пока ждали блокировку - берем новое состояние
+                    continue
+                try:
+                    if state.chat_data is None:
+                        replayed = state.load()
+                        if state.chat_data is not None:
+                            self.stats["loads"] += 1
+                            self.stats["journal_replayed"] += replayed
+                    state.last_access = time.monotonic()
+                    yield state
+                finally:
+                    if state.chat_data is None:
+                        self._forget(state)
+                return
+
+    def _forget(self, state):
+        """Убирает состояние из памяти; вызывается под state.lock"""
+        state.evicted = True
+        with self.lock:
+            key = (state.user_folder, state.chat_id)
+            if self.states.get(key) is state:
+                del self.states[key]
+
+    def _existing(self, user_folder=None):
+        with self.lock:
+            return [state for state in self.states.values()
+                    if user_folder is None or state.user_folder == user_folder]
+
+    def checkout(self, user_folder, chat_id):
+        """Копия чата для изменения или None, если чата нет"""
+        with self._locked(user_folder, chat_id) as state:
+            if state.chat_data is None:
+                return None
+            return copy_chat_data(state.chat_data)
+
+    def commit(self, user_folder, chat_id, chat_data):
+        """Делает chat_data текущим состоянием чата
+
+        Новый чат сразу пишется файлом (его видят списки чатов), для
+        существующего дописывается только строка журнала.
+        """
+        with self._locked(user_folder, chat_id) as state:
+            previous = state.chat_data
+            state.chat_data = copy_chat_data(chat_data)
+            state.stamp = next(chat_commit_stamps)
+            if previous is None:
+                state.write_snapshot()
+                self.stats["snapshots"] += 1
+                return
+            record = chat_journal_record(previous, state.chat_data)
+            if record is None:
+                return
+            self.stats["journal_records"] += 1
+            self.stats["journal_bytes"] += state.append_journal(record)
+            if state.dirty_since is None:
+                state.dirty_since = time.monotonic()
+
+    def stamp(self, user_folder, chat_id):
+        """Отметка последнего сохранения загруженного чата, None если чат не в памяти"""
+        with self.lock:
+            state = self.states.get((user_folder, chat_id))
+        if state is None or not state.stamp:
+            return None
+        return state.stamp
+
+    def active_chats(self, user_folder):
+        """(chat_id, данные) загруженных чатов пользователя - только для чтения
+
+        Данные в памяти не меняются на месте (сохранение заменяет их целиком),
+        поэтому читать их можно без блокировки.
+        """
+        return [(state.chat_id, state.chat_data) for state in self._existing(user_folder)
+                if state.chat_data is not None]
+
+    def is_active(self, user_folder, chat_id):
+        with self.lock:
+            return (user_folder, chat_id) in self.states
+
+    @contextmanager
+    def hold_idle(self, user_folder, chat_id):
+        """Не дает загрузить чат, пока выполняется тело (обслуживание файла)
+
+        Дает False, если чат уже в памяти - тогда его файл трогать нельзя.
+        Загрузка, начатая в это время, ждет и читает файл уже после тела.
+        """
+        key = (user_folder, chat_id)
+        with self.lock:
+            active = key in self.states
+            if not active:
+                state = self.states[key] = ChatState(user_folder, chat_id, self.config)
+                state.lock.acquire()
+        if active:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            self._forget(state)
+            state.lock.release()
+
+    def discard(self, user_folder, chat_id):
+        """Забывает чат вместе с журналом - перед удалением файла чата"""
+        with self.lock:
+            state = self.states.get((user_folder, chat_id))
+        if state is not None:
+            with state.lock:
+                self._forget(state)
+        journal_path = os.path.join(user_folder, "chats", f"{chat_id}{JOURNAL_SUFFIX}")
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+
+    def _flush(self, state, release=False):
+        """Пишет файл чата, если есть несохраненное; вызывается под state.lock"""
+        if state.chat_data is not None and state.dirty_since is not None:
+            try:
+                state.write_snapshot()
+                self.stats["snapshots"] += 1
+            except OSError as e:
+                # Журнал на месте - изменения не потеряны, попробуем позже
+                logger.error("Не удалось записать чат %s: %s", state.path, e)
+                self.stats["snapshot_errors"] += 1
+                return False
+        if release:
+            self._forget(state)
+            self.stats["evictions"] += 1
+        return True
+
+    def flush_user(self, user_folder, release=False):
+        """Сбрасывает на диск все чаты пользователя, включая журналы прошлых запусков
+
+        С release чаты выгружаются - после этого файлы на диске снова главные
+        (импорт, обслуживание в другом процессе).
+        """
+        chat_ids = {state.chat_id for state in self._existing(user_folder)}
+        chats_folder = os.path.join(user_folder, "chats")
+        if os.path.isdir(chats_folder):
+            chat_ids.update(name[:-len(JOURNAL_SUFFIX)] for name in os.listdir(chats_folder)
+                            if name.endswith(JOURNAL_SUFFIX))
+        for chat_id in chat_ids:
+            with self._locked(user_folder, chat_id) as state:
+                if state.chat_data is not None:
+                    self._flush(state, release)
+
+    def flush_due(self):
+        """Фоновый шаг: сброс устаревших снимков и выгрузка простаивающих чатов"""
+        now = time.monotonic()
+        states = self._existing()
+        overflow = len(states) - self.config["max_chats"]
+        for position, state in enumerate(states):
+            # states идут от давно не использованных к недавним
+            release = position < overflow or now - state.last_access >= self.config["idle_s"]
+            due = state.dirty_since is not None and \
+                now - state.dirty_since >= self.config["flush_after_s"]
+            if not (release or due):
+                continue
+            with state.lock:
+                if not state.evicted:
+                    self._flush(state, release)
+
+    def flush_all(self):
+        for state in self._existing():
+            with state.lock:
+                if not state.evicted:
+                    self._flush(state)
+
+    def start(self):
+        """Фоновый сброс: проверка несколько раз за flush_after_s"""
+        interval = max(0.05, min(1.0, self.config["flush_after_s"] / 4))
+
+        def loop():
+            while not self.stop_event.wait(interval):
+                try:
+                    self.flush_due()
+                except Exception as e:
+                    logger.error("Ошибка фонового сброса чатов: %s", e)
+
+        threading.Thread(target=loop, name="chat-flush", daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.flush_all()
+
+    def snapshot(self):
+        states = self._existing()
+        return {
+            "active_chats": len(states),
+            "dirty_chats": sum(1 for state in states if state.dirty_since is not None),
+            "max_chats": self.config["max_chats"],
+            "flush_after_s": self.config["flush_after_s"],
+            "journal_fsync": self.config["journal_fsync"],
+            **dict(self.stats)
+        }
+
+
+game_states = GameStateStore()
+
+
 # УБИРАЕМ ИЗБЫТОЧНУЮ ФУНКЦИЮ save_chat - теперь сохранение только при необходимости
 def save_chat_file(chat_id, chat_data):
     """Сохраняет файл чата (только когда реально нужно)"""
     try:
+        ensure_chat_sequence(chat_data)
         user_folder = get_user_folder(session['username'], session['user_id'])
-        chats_folder = os.path.join(user_folder, "chats")
-        os.makedirs(chats_folder, exist_ok=True)
-
-        filepath = os.path.join(chats_folder, f"{chat_id}.json")
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(chat_data, f, ensure_ascii=False, indent=2)
+        # Файл чата целиком пишется позже, сейчас - только строка журнала
+        game_states.commit(user_folder, chat_id, chat_data)
+        manifest = chat_manifest(chat_id, chat_data)
+        bump_storage_version("chats", refresh=lambda index: {**index, chat_id: manifest})
+        drop_reroll_candidates(session['user_id'], chat_id, chat_data['version'])
+        try:
+            index_chat(session['user_id'], chat_id, chat_data)
+        except sqlite3.Error as e:
+            logger.warning("Не удалось обновить поисковый индекс чата %s: %s", chat_id, e)
+        publish_user_event(session['user_id'], "chat_updated", {
+            "chat_id": chat_id,
+            "version": chat_data['version']
+        })
     except Exception as e:
         print(f"Ошибка сохранения чата: {e}")
 
@@ -587,7 +3464,7 @@ def create_chat():
     return jsonify({
         "success": True,
         "chat_id": chat_id,
-        "chat_data": chat_data
+        "chat_data": chat_view(chat_data)
     })
 
 
@@ -602,11 +3479,19 @@ def delete_chat():
         return jsonify({"error": "ID чата не указан"})
 
     user_folder = get_user_folder(session['username'], session['user_id'])
-    filepath = os.path.join(user_folder, "chats", f"{chat_id}.json")
+    filepath = find_chat_file(user_folder, chat_id)
 
     try:
-        if os.path.exists(filepath):
+        if filepath:
+            game_states.discard(user_folder, chat_id)
             os.remove(filepath)
+            if os.path.exists(filepath + COLD_SUFFIX):
+                os.remove(filepath + COLD_SUFFIX)
+            bump_storage_version("chats", refresh=lambda index: {
+                other_id: manifest for other_id, manifest in index.items() if other_id != chat_id})
+            cancel_opening_scenes(session['user_id'], chat_id)
+            drop_reroll_candidates(session['user_id'], chat_id, None)
+            remove_chat_from_search(session['user_id'], chat_id)
             return jsonify({"success": True, "message": "Чат удален"})
         else:
             return jsonify({"error": "Чат не найден"})
@@ -627,11 +3512,7 @@ def start_game():
     chat_id = data.get('chat_id', 'default')
     character = data.get('character')  # Персонаж может быть передан сразу
 
-    rules = load_gm_rules()
-    system_prompt = create_gm_system_prompt(rules)
-
-    session['conversation_history'] = []
-    session['system_prompt'] = system_prompt
+    system_prompt = gm_system_prompt()
     session['current_chat_id'] = chat_id
 
     # Если персонаж передан, используем его
@@ -655,15 +3536,11 @@ def start_game():
             response = "🎭 **Добро пожаловать в игру!**\n\nПрежде чем начать, выберите персонажа из списка или создайте нового."
             session['character'] = None
 
-    if response and response.strip():
-        session['conversation_history'] = [{
-            "role": "user",
-            "content": "Начни игру"
-        }, {
-            "role": "assistant",
-            "content": response
-        }]
+    if isinstance(response, LLMErrorResponse):
+        # Текст ошибки показываем игроку, но в историю чата не пишем
+        return jsonify({"error": response})
 
+    if response and response.strip():
         # Сохраняем в чат только если есть реальные изменения
         update_chat_messages(chat_id, [{
             "role": "user",
@@ -685,21 +3562,381 @@ def start_game():
 
 
 def load_chat_data(chat_id):
-    """Загружает данные чата"""
+    """Загружает данные чата из памяти (с диска - при первом обращении)
+
+    Возвращается копия: изменения попадают в чат только через save_chat_file.
+    """
     try:
         user_folder = get_user_folder(session['username'], session['user_id'])
-        filepath = os.path.join(user_folder, "chats", f"{chat_id}.json")
+        return game_states.checkout(user_folder, chat_id)
+    except Exception as e:
+        print(f"Ошибка загрузки чата: {e}")
+    return None
+
+
+# Версии и номера сообщений чата.
+# Каждое сообщение получает возрастающий seq и версию v, в которой оно было
+# записано (или снова стало видимым); любое изменение чата увеличивает
+# chat_data['version'].
+# Удаленные из видимой истории сообщения оставляют метки в chat_data['deleted'],
+# чтобы /sync_chat мог сообщить клиенту об удалении. Меток храним не больше
+# MAX_CHAT_TOMBSTONES: клиенты старше min_sync_version получают чат целиком.
+MAX_CHAT_TOMBSTONES = 500
+
+# Ветки чата.
+# Сообщения хранятся деревом: chat_data['turns'] - все сообщения всех веток,
+# у каждого parent - seq предыдущего сообщения. Ветка - это только ссылка на
+# последнее сообщение (head), общие начала веток хранятся один раз.
+# chat_data['messages'] - путь активной ветки; он строится при загрузке из тех же
+# объектов, что и turns, и не записывается на диск.
+
+
+def ensure_chat_sequence(chat_data):
+    """Добавляет версию, номера сообщений и дерево веток старым чатам"""
+    chat_data.setdefault('version', 0)
+    chat_data.setdefault('deleted', [])
+    chat_data.setdefault('min_sync_version', 0)
+    next_seq = chat_data.get('next_seq', 1)
+
+    if 'turns' not in chat_data:
+        # Линейный чат старого формата - одна ветка из его сообщений
+        parent = None
+        for message in chat_data.setdefault('messages', []):
+            if 'seq' not in message:
+                message['seq'] = next_seq
+                message['v'] = chat_data['version']
+                next_seq += 1
+            message['parent'] = parent
+            parent = message['seq']
+        chat_data['turns'] = list(chat_data['messages'])
+        chat_data['branches'] = {
+            "main": {
+                "name": "Основная",
+                "head": parent,
+                "created_at": chat_data.get('created_at')
+            }
+        }
+        chat_data['active_branch'] = "main"
+        chat_data.setdefault('next_branch', 1)
+    elif 'messages' not in chat_data:
+        chat_data['messages'] = active_chat_path(chat_data)
+
+    chat_data['next_seq'] = next_seq
+    return chat_data
+
+
+def chat_path(chat_data, head):
+    """Сообщения от начала чата до head по ссылкам на родителя"""
+    turns = {turn['seq']: turn for turn in chat_data['turns']}
+    path = []
+    while head is not None:
+        turn = turns[head]
+        path.append(turn)
+        head = turn.get('parent')
+        if len(path) > len(turns):
+            raise ValueError("цикл в ссылках на родителя")
+    path.reverse()
+    return path
+
+
+def active_chat_path(chat_data):
+    """Сообщения активной ветки (подходит и для чатов старого формата)"""
+    if 'turns' not in chat_data:
+        return chat_data.get('messages', [])
+    return chat_path(chat_data, chat_data['branches'][chat_data['active_branch']]['head'])
+
+
+def chat_view(chat_data):
+    """Чат для клиента: активная ветка без дерева всех сообщений"""
+    return {key: value for key, value in chat_data.items() if key != 'turns'}
+
+
+def chat_history(messages):
+    """История для модели: только роли и тексты сообщений"""
+    return [{"role": message["role"], "content": message["content"]} for message in messages]
+
+
+def touch_chat(chat_data):
+    """Отмечает изменение чата, возвращает новую версию"""
+    ensure_chat_sequence(chat_data)
+    chat_data['version'] += 1
+    return chat_data['version']
+
+
+def append_chat_messages(chat_data, messages):
+    """Добавляет сообщения в конец активной ветки, присваивая им seq"""
+    version = touch_chat(chat_data)
+    branch = chat_data['branches'][chat_data['active_branch']]
+    for message in messages:
+        message['seq'] = chat_data['next_seq']
+        message['v'] = version
+        message['parent'] = branch['head']
+        chat_data['next_seq'] += 1
+        chat_data['turns'].append(message)
+        chat_data['messages'].append(message)
+        branch['head'] = message['seq']
+    return messages
+
+
+def add_chat_tombstones(chat_data, messages, version):
+    """Отмечает сообщения, пропавшие из видимой истории"""
+    chat_data['deleted'].extend({"seq": message['seq'], "v": version} for message in messages)
+
+    if len(chat_data['deleted']) > MAX_CHAT_TOMBSTONES:
+        dropped = chat_data['deleted'][:-MAX_CHAT_TOMBSTONES]
+        chat_data['deleted'] = chat_data['deleted'][-MAX_CHAT_TOMBSTONES:]
+        chat_data['min_sync_version'] = max(chat_data['min_sync_version'],
+                                            max(mark['v'] for mark in dropped))
+
+
+def collect_chat_turns(chat_data):
+    """Удаляет сообщения, не достижимые ни из одной ветки, возвращает их число"""
+    turns = {turn['seq']: turn for turn in chat_data['turns']}
+    reachable = set()
+    for branch in chat_data['branches'].values():
+        head = branch['head']
+        while head is not None and head not in reachable:
+            reachable.add(head)
+            head = turns[head].get('parent')
+
+    removed = len(chat_data['turns']) - len(reachable)
+    if removed:
+        chat_data['turns'] = [turn for turn in chat_data['turns'] if turn['seq'] in reachable]
+    return removed
+
+
+def truncate_chat_messages(chat_data, keep_count):
+    """Отматывает активную ветку до позиции keep_count, удаляя дальнейшие сообщения
+
+    Сообщения, общие с другими ветками, остаются в дереве.
+    """
+    removed = chat_data['messages'][keep_count:]
+    if not removed:
+        return []
+    version = touch_chat(chat_data)
+    chat_data['messages'] = chat_data['messages'][:keep_count]
+    chat_data['branches'][chat_data['active_branch']]['head'] = (
+        chat_data['messages'][-1]['seq'] if chat_data['messages'] else None)
+    add_chat_tombstones(chat_data, removed, version)
+    collect_chat_turns(chat_data)
+    return removed
+
+
+def fork_chat_branch(chat_data, keep_count, name=None):
+    """Создает ветку от позиции keep_count активной ветки и делает ее активной
+
+    Старая ветка сохраняется целиком, новая делит с ней первые keep_count
+    сообщений. Возвращает id новой ветки.
+    """
+    ensure_chat_sequence(chat_data)
+    keep_count = min(keep_count, len(chat_data['messages']))
+    base = chat_data['messages'][keep_count - 1]['seq'] if keep_count else None
+
+    chat_data.setdefault('next_branch', 1)
+    branch_id = f"b{chat_data['next_branch']}"
+    chat_data['next_branch'] += 1
+    chat_data['branches'][branch_id] = {
+        "name": name or f"Ветка {chat_data['next_branch'] - 1}",
+        "head": base,
+        "base": base,
+        "created_at": datetime.now().isoformat()
+    }
+
+    removed = chat_data['messages'][keep_count:]
+    version = touch_chat(chat_data)
+    chat_data['messages'] = chat_data['messages'][:keep_count]
+    chat_data['active_branch'] = branch_id
+    add_chat_tombstones(chat_data, removed, version)
+    return branch_id
+
+
+def switch_chat_branch(chat_data, branch_id):
+    """Делает ветку активной; клиенту уходят только различия путей"""
+    ensure_chat_sequence(chat_data)
+    if branch_id == chat_data['active_branch']:
+        return False
+
+    new_path = chat_path(chat_data, chat_data['branches'][branch_id]['head'])
+    old_seqs = {message['seq'] for message in chat_data['messages']}
+    new_seqs = {message['seq'] for message in new_path}
+
+    version = touch_chat(chat_data)
+    # Снова видимые сообщения больше не удалены - иначе дельта и добавит, и удалит их
+    chat_data['deleted'] = [mark for mark in chat_data['deleted'] if mark['seq'] not in new_seqs]
+    add_chat_tombstones(chat_data,
+                        [m for m in chat_data['messages'] if m['seq'] not in new_seqs],
+                        version)
+    for message in new_path:
+        if message['seq'] not in old_seqs:
+            # Снова видимое сообщение попадает в дельту как новое
+            message['v'] = version
+    chat_data['messages'] = new_path
+    chat_data['active_branch'] = branch_id
+    return True
+
+
+def prune_chat_branch(chat_data, branch_id):
+    """Удаляет неактивную ветку и ее собственные сообщения, возвращает их число"""
+    ensure_chat_sequence(chat_data)
+    del chat_data['branches'][branch_id]
+    touch_chat(chat_data)
+    return collect_chat_turns(chat_data)
+
+
+def find_message_position(chat_data, seq):
+    """Позиция сообщения с данным seq в активной ветке или None"""
+    for position, message in enumerate(chat_data['messages']):
+        if message.get('seq') == seq:
+            return position
+    return None
+
+
+def chat_delta(chat_data, since_version):
+    """Изменения чата после версии since_version для клиента"""
+    full = since_version > chat_data['version'] or since_version < chat_data['min_sync_version']
+    if full:
+        since_version = -1
+    return {
+        "version": chat_data['version'],
+        "full": full,
+        "messages": [m for m in chat_data['messages'] if m.get('v', 0) > since_version],
+        "deleted": [] if full else [
+            mark['seq'] for mark in chat_data['deleted'] if mark['v'] > since_version
+        ],
+    }
+
+
+@app.route('/sync_chat', methods=['GET'])
+@login_required
+def sync_chat():
+    """Возвращает только изменения чата после версии ?since=
+
+    Клиент хранит версию чата и номера сообщений, поэтому при переподключении
+    или в другой вкладке получает только новые, измененные и удаленные сообщения.
+    """
+    chat_id = request.args.get('chat_id')
+    if not chat_id:
+        return jsonify({"error": "ID чата не указан"})
+
+    try:
+        since_version = int(request.args.get('since', -1))
+    except ValueError:
+        return jsonify({"error": "Некорректная версия"})
+
+    chat_data = load_chat_data(chat_id)
+    if chat_data is None:
+        return jsonify({"error": "Чат не найден"})
+
+    character_desc, character_name = get_chat_character(chat_data)
+    result = chat_delta(chat_data, since_version)
+    result.update({
+        "chat_id": chat_id,
+        "branch_id": chat_data['active_branch'],
+        "branch_count": len(chat_data['branches']),
+        "name": chat_data.get('name'),
+        "character_id": chat_data.get('character_id'),
+        "character_name": character_name
+    })
+    if not chat_data.get('character_id'):
+        # Старые чаты хранят описание персонажа прямо в файле
+        result["character"] = chat_data.get('character')
+    return jsonify(result)
+
+
+@app.route('/chat_branches', methods=['GET'])
+@login_required
+def chat_branches():
+    """Список веток чата"""
+    chat_id = request.args.get('chat_id')
+    if not chat_id:
+        return jsonify({"error": "ID чата не указан"})
+
+    chat_data = load_chat_data(chat_id)
+    if chat_data is None:
+        return jsonify({"error": "Чат не найден"})
+
+    branches = []
+    for branch_id, branch in chat_data['branches'].items():
+        path = chat_path(chat_data, branch['head'])
+        branches.append({
+            "id": branch_id,
+            "name": branch['name'],
+            "head": branch['head'],
+            "base": branch.get('base'),
+            "created_at": branch.get('created_at'),
+            "message_count": len(path),
+            "last_message": path[-1].get('content', '')[:50] if path else None
+        })
+
+    return jsonify({
+        "chat_id": chat_id,
+        "active": chat_data['active_branch'],
+        "branches": branches,
+        "turn_count": len(chat_data['turns'])
+    })
+
+
+@app.route('/switch_branch', methods=['POST'])
+@login_required
+def switch_branch():
+    """Переключает активную ветку чата"""
+    data = request.get_json()
+    chat_id = data.get('chat_id')
+    branch_id = data.get('branch_id')
+
+    chat_data = load_chat_data(chat_id) if chat_id else None
+    if chat_data is None:
+        return jsonify({"error": "Чат не найден"})
+    if branch_id not in chat_data['branches']:
+        return jsonify({"error": "Ветка не найдена"})
+
+    if switch_chat_branch(chat_data, branch_id):
+        save_chat_file(chat_id, chat_data)
+
+    # Контекст ИИ строится только по активной ветке (см. chat_history)
+    session['current_chat_id'] = chat_id
+
+    return jsonify({
+        "success": True,
+        "branch_id": branch_id,
+        "chat_version": chat_data['version']
+    })
+
+
+@app.route('/prune_branch', methods=['POST'])
+@login_required
+def prune_branch():
+    """Удаляет ветку чата вместе с сообщениями, которых нет в других ветках"""
+    data = request.get_json()
+    chat_id = data.get('chat_id')
+    branch_id = data.get('branch_id')
+
+    chat_data = load_chat_data(chat_id) if chat_id else None
+    if chat_data is None:
+        return jsonify({"error": "Чат не найден"})
+    if branch_id not in chat_data['branches']:
+        return jsonify({"error": "Ветка не найдена"})
+    if branch_id == chat_data['active_branch']:
+        return jsonify({"error": "Нельзя удалить активную ветку"})
 
-        if os.path.exists(filepath):
-            with open(filepath, 'r', encoding='utf-8') as f:
-                return json.load(f)
-    except Exception as e:
-        print(f"Ошибка загрузки чата: {e}")
-    return None
+    removed_turns = prune_chat_branch(chat_data, branch_id)
+    save_chat_file(chat_id, chat_data)
+    return jsonify({
+        "success": True,
+        "removed_turns": removed_turns,
+        "chat_version": chat_data['version']
+    })
 
 
 def update_chat_messages(chat_id, messages):
-    """Обновляет сообщения в чате (ТОЛЬКО при реальных изменениях)"""
+    """Обновляет сообщения в чате (ТОЛЬКО при реальных изменениях)
+
+    Возвращает данные чата после сохранения или None при ошибке.
+    """
+    if any(isinstance(message.get('content'), LLMErrorResponse) for message in messages):
+        logger.error("Попытка сохранить ошибку модели в чат %s", chat_id)
+        return None
+
     try:
         chat_data = load_chat_data(chat_id)
         if not chat_data:
@@ -711,26 +3948,28 @@ def update_chat_messages(chat_id, messages):
                 "created_at": datetime.now().isoformat()
             }
 
-        # Проверяем, есть ли реально новые сообщения
-        old_count = len(chat_data['messages'])
-        chat_data['messages'].extend(messages)
-
-        # Сохраняем только если действительно что-то изменилось
-        if len(chat_data['messages']) > old_count:
+        # Сохраняем только если действительно есть новые сообщения
+        if messages:
+            append_chat_messages(ensure_chat_sequence(chat_data), messages)
             save_chat_file(chat_id, chat_data)
+        return chat_data
     except Exception as e:
         print(f"Ошибка обновления чата: {e}")
+        return None
 
 
 @app.route('/send_message', methods=['POST'])
 @login_required
+@single_flight
 def send_message():
     data = request.get_json()
     user_message = data.get('message', '')
     chat_id = data.get('chat_id', 'default')
 
-    logger.debug(
-        f"send_message вызван: message='{user_message}', chat_id='{chat_id}'")
+    # Полный текст сообщения не логируем - только длину
+    logger.debug("send_message вызван: chat_id=%s, длина сообщения=%s",
+                 chat_id, len(user_message),
+                 extra={"event": "send_message"})
 
     if not user_message:
         logger.warning("Попытка отправить пустое сообщение")
@@ -740,20 +3979,21 @@ def send_message():
 
     # Проверяем, находимся ли в режиме создания персонажа
     if session.get('character_creation_mode'):
-        logger.debug("В режиме создания персонажа")
+        logger.debug("В режиме создания персонажа", extra={"event": "send_message"})
         return create_character_continue(user_message, chat_id)
 
     # Проверяем, запрашивает ли игрок создание персонажа
     if 'создать персонажа' in user_message.lower(
     ) or 'создание персонажа' in user_message.lower():
-        logger.debug("Запрос на создание персонажа")
+        logger.debug("Запрос на создание персонажа", extra={"event": "send_message"})
         return create_character_start(chat_id)
 
     # Проверяем персонажа в чате
     chat_data = load_chat_data(chat_id)
     chat_character, chat_character_name = get_chat_character(chat_data)
 
-    logger.debug(f"Проверка персонажа в чате: {bool(chat_character)}")
+    logger.debug("Проверка персонажа в чате: %s", bool(chat_character),
+                 extra={"event": "send_message"})
 
     # Проверяем, есть ли персонаж
     if not chat_character:
@@ -763,27 +4003,20 @@ def send_message():
             "⚠️ Сначала нужно создать или загрузить персонажа! Напишите 'создать персонажа' или выберите персонажа из списка."
         })
 
-    conversation_history = session.get('conversation_history', [])
-    system_prompt = session.get('system_prompt', '')
-
     # Добавляем информацию о персонаже в контекст
     enhanced_prompt = f"{user_message}\n\n[ПЕРСОНАЖ ИГРОКА: {chat_character}]"
 
-    response = chat_with_ai(enhanced_prompt, system_prompt,
-                            conversation_history)
+    with gm_turn(chat_id):
+        response = chat_with_ai(enhanced_prompt, gm_system_prompt(),
+                                chat_history(chat_data['messages']))
 
-    if response and response.strip():
-        conversation_history.extend([{
-            "role": "user",
-            "content": user_message
-        }, {
-            "role": "assistant",
-            "content": response
-        }])
-        session['conversation_history'] = conversation_history
+    if isinstance(response, LLMErrorResponse):
+        # Текст ошибки показываем игроку, но в историю чата не пишем
+        return jsonify({"error": response})
 
+    if response and response.strip():
         # Сохраняем в чат
-        update_chat_messages(chat_id, [{
+        new_messages = [{
             "role": "user",
             "content": user_message,
             "timestamp": datetime.now().isoformat()
@@ -791,7 +4024,17 @@ def send_message():
             "role": "assistant",
             "content": response,
             "timestamp": datetime.now().isoformat()
-        }])
+        }]
+        saved_chat = update_chat_messages(chat_id, new_messages)
+        if saved_chat:
+            schedule_reroll_prefetch(chat_id, saved_chat)
+            # Клиент с версией base_version может просто добавить эти сообщения
+            return jsonify({
+                "response": response,
+                "chat_version": saved_chat['version'],
+                "base_version": saved_chat['version'] - 1,
+                "messages": new_messages
+            })
 
     return jsonify({"response": response})
 
@@ -799,45 +4042,57 @@ def send_message():
 @app.route('/edit_message', methods=['POST'])
 @login_required
 def edit_message():
-    """Редактирует сообщение и генерирует новый ответ ИИ"""
+    """Редактирует сообщение и генерирует новый ответ ИИ в новой ветке
+
+    Сообщение задается номером seq (надежно) или позицией message_id в
+    активной ветке (устаревший способ, позиция может устареть).
+    Прежнее продолжение остается в своей ветке - см. /chat_branches.
+    """
     data = request.get_json()
     message_id = data.get('message_id')
+    seq = data.get('seq')
     new_content = data.get('new_content', '')
     chat_id = data.get('chat_id', 'default')
 
     if not new_content:
         return jsonify({"error": "Пустое сообщение"})
 
-    conversation_history = session.get('conversation_history', [])
-    system_prompt = session.get('system_prompt', '')
-
-    # Обрезаем историю до редактируемого сообщения
-    if message_id < len(conversation_history):
-        conversation_history = conversation_history[:message_id]
-        conversation_history.append({"role": "user", "content": new_content})
+    # Позицию, историю и персонажа берем из чата - там же, где будем обрезать
+    chat_data = load_chat_data(chat_id)
+    if chat_data is None:
+        return jsonify({"error": "Чат не найден"})
+    if seq is not None:
+        message_id = find_message_position(chat_data, seq)
+        if message_id is None:
+            return jsonify({"error": "Сообщение не найдено"})
+    elif message_id is None:
+        return jsonify({"error": "Не указано сообщение"})
+    else:
+        message_id = min(message_id, len(chat_data['messages']))
 
     # Добавляем информацию о персонаже в контекст
-    character_info = session.get('character')
+    character_info, _ = get_chat_character(chat_data)
     if character_info:
         enhanced_prompt = f"{new_content}\n\n[ПЕРСОНАЖ ИГРОКА: {character_info}]"
     else:
         enhanced_prompt = new_content
 
-    response = chat_with_ai(enhanced_prompt, system_prompt,
-                            conversation_history[:-1])
+    with gm_turn(chat_id):
+        response = chat_with_ai(enhanced_prompt, gm_system_prompt(),
+                                chat_history(chat_data['messages'][:message_id]))
 
-    if response and response.strip():
-        conversation_history.append({"role": "assistant", "content": response})
-        session['conversation_history'] = conversation_history
+    if isinstance(response, LLMErrorResponse):
+        # Текст ошибки показываем игроку, но в историю чата не пишем
+        return jsonify({"error": response})
 
+    if response and response.strip():
         # Обновляем чат
         chat_data = load_chat_data(chat_id)
         if chat_data:
-            # Обрезаем сообщения в чате и добавляем новые
+            # Ответвляемся от редактируемого сообщения и продолжаем новую ветку
             if message_id < len(chat_data['messages']):
-                chat_data['messages'] = chat_data['messages'][:message_id]
-
-            chat_data['messages'].extend([{
+                fork_chat_branch(chat_data, message_id)
+            append_chat_messages(chat_data, [{
                 "role":
                 "user",
                 "content":
@@ -853,10 +4108,250 @@ def edit_message():
                 datetime.now().isoformat()
             }])
             save_chat_file(chat_id, chat_data)
+            schedule_reroll_prefetch(chat_id, chat_data)
+            return jsonify({
+                "response": response,
+                "chat_version": chat_data['version'],
+                "branch_id": chat_data['active_branch']
+            })
 
     return jsonify({"response": response})
 
 
+# Заготовки для "другого варианта" ответа ГМ.
+# REROLL_PREFETCH=1 включает фоновую генерацию REROLL_CANDIDATES (1-2)
+# альтернативных ответов сразу после ответа ГМ. Токены на заготовки ограничены
+# REROLL_TOKEN_BUDGET на пользователя за час. Заготовки привязаны к версии чата
+# и выбрасываются при любом его изменении.
+REROLL_CONFIG = {
+    "enabled": os.environ.get("REROLL_PREFETCH", "0") == "1",
+    "candidates": min(2, max(1, int(os.environ.get("REROLL_CANDIDATES", "1")))),
+    "token_budget": int(os.environ.get("REROLL_TOKEN_BUDGET", "20000")),
+    "budget_window": 3600,
+    # Сколько reroll ждет уже начатую заготовку, прежде чем генерировать сам
+    "wait_timeout": 30,
+}
+
+# (user_id, chat_id) -> {"version", "candidates": [(текст, токены)], "pending", "dropped"}
+reroll_cache = {}
+# user_id -> deque[[время, токены]] - расход бюджета заготовок. Запущенная
+# заготовка сразу резервирует оценку своей стоимости, по готовности оценка
+# заменяется фактическим расходом
+reroll_spent = {}
+reroll_lock = threading.Lock()
+reroll_ready = threading.Condition(reroll_lock)
+reroll_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="reroll")
+
+
+def reroll_budget_left(user_id):
+    """Сколько токенов пользователь еще может потратить на заготовки (под reroll_lock)"""
+    spent = reroll_spent.setdefault(user_id, deque())
+    horizon = time.monotonic() - REROLL_CONFIG["budget_window"]
+    while spent and spent[0][0] < horizon:
+        spent.popleft()
+    return REROLL_CONFIG["token_budget"] - sum(tokens for _, tokens in spent)
+
+
+def estimate_reroll_tokens(chat_data, prompt, system_prompt, history):
+    """Оценка стоимости одной заготовки: запрос плюс ответ длиной с текущий"""
+    recent = history[-CONTEXT_CONFIG["max_messages"]:]
+    chars = (len(system_prompt) + len(prompt) + len(chat_data['messages'][-1]['content'])
+             + sum(len(message['content']) for message in recent))
+    return int(chars / 3.5) + 1
+
+
+def reroll_context(chat_data):
+    """Промпт, системный промпт и история для повторной генерации последнего ответа"""
+    messages = chat_data['messages']
+    character, _ = get_chat_character(chat_data)
+    user_message = messages[-2]['content']
+    prompt = f"{user_message}\n\n[ПЕРСОНАЖ ИГРОКА: {character}]" if character else user_message
+    return prompt, gm_system_prompt(), chat_history(messages[:-2])
+
+
+def can_reroll(chat_data):
+    messages = chat_data['messages'] if chat_data else []
+    return (len(messages) >= 2 and messages[-1]['role'] == 'assistant'
+            and messages[-2]['role'] == 'user')
+
+
+def schedule_reroll_prefetch(chat_id, chat_data, entry=None):
+    """Запускает фоновую генерацию вариантов последнего ответа ГМ
+
+    entry - оставшиеся заготовки того же промпта (после reroll), их переносим
+    на новую версию чата вместо новой генерации.
+    """
+    if not REROLL_CONFIG["enabled"] or not can_reroll(chat_data):
+        discard_reroll_entry(entry)
+        return
+    if route_degraded() or usage_accountant.quota_exceeded(session['user_id']):
+        # Модель сбоит - не тратим ее пробные запросы на заготовки;
+        # лимит исчерпан - заготовки все равно не сгенерировать
+        discard_reroll_entry(entry)
+        record_metric("reroll_prefetch_skipped")
+        return
+
+    key = (session['user_id'], chat_id)
+    prompt, system_prompt, history = reroll_context(chat_data)
+    estimate = estimate_reroll_tokens(chat_data, prompt, system_prompt, history)
+    with reroll_lock:
+        if entry and (entry['candidates'] or entry['pending']):
+            entry['version'] = chat_data['version']
+            reroll_cache[key] = entry
+            return
+        # Бюджет резервируется на каждую заготовку до ее запуска, чтобы
+        # параллельные запуски не превысили его вместе
+        reserved = []
+        spent = reroll_spent.setdefault(session['user_id'], deque())
+        for _ in range(REROLL_CONFIG["candidates"]):
+            if reroll_budget_left(session['user_id']) < estimate:
+                break
+            reserved.append([time.monotonic(), estimate])
+            spent.append(reserved[-1])
+        if not reserved:
+            record_metric("reroll_prefetch_skipped")
+            return
+        entry = {
+            "version": chat_data['version'],
+            "candidates": [],
+            "pending": len(reserved),
+            "dropped": False
+        }
+        reroll_cache[key] = entry
+
+    for reservation in reserved:
+        reroll_executor.submit(prefetch_reroll_candidate, key, entry, reservation, prompt,
+                               system_prompt, history)
+
+
+def prefetch_reroll_candidate(key, entry, reservation, prompt, system_prompt, history):
+    """Генерирует одну заготовку (в фоновом потоке, без сессии)"""
+    try:
+        response, tokens = generate_reply(prompt, system_prompt, history, owner=key)
+    except Exception as e:
+        logger.warning("Не удалось подготовить вариант ответа: %s", e)
+        with reroll_ready:
+            reroll_ready.notify_all()
+            entry['pending'] -= 1
+            # Резерв заменяется тем, что успела потратить неудачная попытка
+            reservation[1] = sum(getattr(e, 'spent', None) or ())
+        return
+
+    record_metric("reroll_prefetch_tokens", tokens)
+    with reroll_ready:
+        reroll_ready.notify_all()
+        entry['pending'] -= 1
+        reservation[1] = tokens
+        if entry['dropped']:
+            # Игрок успел сделать ход - заготовка уже не нужна
+            record_metric("reroll_wasted_tokens", tokens)
+        elif response.strip():
+            entry['candidates'].append((response, tokens))
+
+
+def discard_reroll_entry(entry):
+    """Выбрасывает запись заготовок, которой уже нет в кэше
+
+    Заготовки, которые еще генерируются, засчитаются как лишние по готовности.
+    """
+    if entry is None:
+        return
+    with reroll_lock:
+        entry['dropped'] = True
+        wasted = sum(tokens for _, tokens in entry['candidates'])
+        entry['candidates'] = []
+    if wasted:
+        record_metric("reroll_wasted_tokens", wasted)
+
+
+def drop_reroll_candidates(user_id, chat_id, version):
+    """Выбрасывает заготовки, сделанные для другой версии чата"""
+    with reroll_lock:
+        entry = reroll_cache.get((user_id, chat_id))
+        if entry is None or entry['version'] == version:
+            return
+        del reroll_cache[(user_id, chat_id)]
+    discard_reroll_entry(entry)
+
+
+def take_reroll_candidate(user_id, chat_id, version):
+    """Забирает заготовку для версии чата: (текст или None, запись с остальными)
+
+    Если заготовка еще генерируется, ждет ее - она начата раньше и будет готова
+    быстрее новой генерации.
+    """
+    key = (user_id, chat_id)
+    with reroll_ready:
+        entry = reroll_cache.get(key)
+        if entry is None or entry['version'] != version:
+            return None, None
+        reroll_ready.wait_for(
+            lambda: entry['candidates'] or not entry['pending'] or reroll_cache.get(key) is not entry,
+            timeout=REROLL_CONFIG["wait_timeout"])
+        if reroll_cache.get(key) is not entry:
+            return None, None
+        # Запись вернется в кэш с новой версией чата после сохранения
+        del reroll_cache[(user_id, chat_id)]
+        if not entry['candidates']:
+            return None, entry
+        response, tokens = entry['candidates'].pop(0)
+    record_metric("reroll_served_tokens", tokens)
+    return response, entry
+
+
+@app.route('/reroll', methods=['POST'])
+@login_required
+def reroll():
+    """Другой вариант последнего ответа ГМ в новой ветке
+
+    Если заготовка для текущей версии чата уже готова, ответ мгновенный.
+    """
+    data = request.get_json()
+    chat_id = data.get('chat_id', 'default')
+
+    chat_data = load_chat_data(chat_id)
+    if not can_reroll(chat_data):
+        return jsonify({"error": "Нет ответа ГМ для перегенерации"})
+
+    record_metric("reroll_requests")
+    response, entry = take_reroll_candidate(session['user_id'], chat_id, chat_data['version'])
+    hit = response is not None
+    if hit:
+        record_metric("reroll_hits")
+        # Заготовка заменяет ответ - генерация, еще идущая в этом чате, не нужна
+        cancel_chat_turn(session['user_id'], chat_id)
+    else:
+        record_metric("reroll_misses")
+        prompt, system_prompt, history = reroll_context(chat_data)
+        with gm_turn(chat_id):
+            response = chat_with_ai(prompt, system_prompt, history)
+        if isinstance(response, LLMErrorResponse):
+            discard_reroll_entry(entry)
+            return jsonify({"error": response})
+
+    if not response or not response.strip():
+        discard_reroll_entry(entry)
+        return jsonify({"error": "Не удалось получить ответ"})
+
+    # Прежний ответ остается в своей ветке
+    fork_chat_branch(chat_data, len(chat_data['messages']) - 1)
+    append_chat_messages(chat_data, [{
+        "role": "assistant",
+        "content": response,
+        "timestamp": datetime.now().isoformat()
+    }])
+    save_chat_file(chat_id, chat_data)
+
+    session['current_chat_id'] = chat_id
+    schedule_reroll_prefetch(chat_id, chat_data, entry)
+    return jsonify({
+        "response": response,
+        "chat_version": chat_data['version'],
+        "branch_id": chat_data['active_branch'],
+        "prefetched": hit
+    })
+
+
 def create_character_start(chat_id='default'):
     """Начинает процесс создания персонажа"""
     session['character_creation_history'] = []
@@ -874,7 +4369,7 @@ def create_character_start(chat_id='default'):
 
 def create_character_continue(user_input, chat_id='default'):
     """Продолжает процесс создания персонажа"""
-    system_prompt = session.get('system_prompt', '')
+    system_prompt = gm_system_prompt()
     creation_history = session.get('character_creation_history', [])
 
     # Специальный промпт для создания персонажа
@@ -895,8 +4390,13 @@ def create_character_continue(user_input, chat_id='default'):
 === КОНЕЦ ОПИСАНИЯ ===
 """
 
-    response = chat_with_ai(user_input, character_creation_prompt,
-                            creation_history)
+    with gm_turn(chat_id):
+        response = chat_with_ai(user_input, character_creation_prompt,
+                                creation_history, route="character_creation")
+
+    if isinstance(response, LLMErrorResponse):
+        # Текст ошибки показываем игроку, но в историю чата не пишем
+        return jsonify({"error": response})
 
     # Проверяем, завершено ли создание персонажа
     if "=== ПЕРСОНАЖ СОЗДАН ===" in response:
@@ -933,7 +4433,9 @@ def create_character_continue(user_input, chat_id='default'):
                 # Удаляем старые поля
                 chat_data.pop('character', None)
                 chat_data.pop('character_name', None)
+                touch_chat(chat_data)
                 save_chat_file(chat_id, chat_data)
+                start_opening_scene(chat_id, character_description)
 
             # Сохраняем в чат
             update_chat_messages(chat_id,
@@ -978,6 +4480,18 @@ def create_character_continue(user_input, chat_id='default'):
     return jsonify({"response": response, "character_created": False})
 
 
+character_id_lock = threading.Lock()
+last_character_ms = 0
+
+
+def new_character_id():
+    """char_<мс>; персонажи, созданные в одну миллисекунду (пакетная загрузка), не совпадают"""
+    global last_character_ms
+    with character_id_lock:
+        last_character_ms = max(last_character_ms + 1, int(datetime.now().timestamp() * 1000))
+        return f"char_{last_character_ms}"
+
+
 def save_character_to_file(character_description, character_name=None):
     """Сохраняет персонажа в файл"""
     try:
@@ -994,7 +4508,7 @@ def save_character_to_file(character_description, character_name=None):
         characters_folder = os.path.join(user_folder, "characters")
 
         # Генерируем уникальный ID
-        character_id = f"char_{int(datetime.now().timestamp() * 1000)}"
+        character_id = new_character_id()
 
         character_data = {
             "id": character_id,
@@ -1012,6 +4526,12 @@ def save_character_to_file(character_description, character_name=None):
                   'w',
                   encoding='utf-8') as f:
             json.dump(character_data, f, ensure_ascii=False, indent=2)
+        bump_storage_version("characters")
+        try:
+            index_character(session['user_id'], filename[:-5], character_name,
+                            character_description)
+        except sqlite3.Error as e:
+            logger.warning("Не удалось обновить поисковый индекс персонажа: %s", e)
 
         return character_id  # Возвращаем ID персонажа
 
@@ -1021,24 +4541,16 @@ def save_character_to_file(character_description, character_name=None):
 
 
 def get_character_by_id(character_id):
-    """Загружает персонажа по ID из файла"""
+    """Находит персонажа по ID в индексе персонажей"""
     try:
-        user_folder = get_user_folder(session['username'], session['user_id'])
-        characters_folder = os.path.join(user_folder, "characters")
-
-        # Ищем файл с нужным ID
-        for filename in os.listdir(characters_folder):
-            if filename.endswith('.json'):
-                filepath = os.path.join(characters_folder, filename)
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    char_data = json.load(f)
-
-                if char_data.get('id') == character_id:
-                    return char_data
-
-        return None
+        characters_by_id = cached_user_data(
+            "characters_by_id", ("characters",),
+            lambda user_folder: {character['id']: character for character
+                                 in get_storage_index("characters", user_folder).values()
+                                 if character['id'] and character['id'] != 'None'})
+        return characters_by_id.get(character_id)
     except Exception as e:
-        logger.error(f"Ошибка загрузки персонажа по ID {character_id}: {e}")
+        logger.error("Ошибка загрузки персонажа по ID %s: %s", character_id, e)
         return None
 
 
@@ -1070,8 +4582,9 @@ def load_character():
     filename = data.get('filename')
     chat_id = data.get('chat_id', 'default')
 
-    logger.debug(
-        f"load_character вызван: filename='{filename}', chat_id='{chat_id}'")
+    logger.debug("load_character вызван: filename=%s, chat_id=%s",
+                 filename, chat_id,
+                 extra={"event": "load_character"})
 
     if not filename:
         logger.error("Не указано имя файла персонажа")
@@ -1080,7 +4593,7 @@ def load_character():
     # Проверяем, есть ли уже персонаж в текущем чате
     chat_data = load_chat_data(chat_id)
     if chat_data and chat_data.get('character_id'):
-        logger.warning(f"Персонаж уже выбран для чата {chat_id}")
+        logger.warning("Персонаж уже выбран для чата %s", chat_id)
         return jsonify({"error": "Персонаж для этой истории уже выбран"})
 
     user_folder = get_user_folder(session['username'], session['user_id'])
@@ -1094,16 +4607,18 @@ def load_character():
         character_name = character_data.get('name', filename)
         character_description = character_data['description']
 
-        logger.debug(
-            f"Загружен персонаж: {character_name} (ID: {character_id})")
+        logger.debug("Загружен персонаж: %s (ID: %s)",
+                     character_name, character_id,
+                     extra={"event": "load_character"})
 
         # Получаем ID персонажа, если его нет - создаем
         if not character_id:
-            character_id = f"char_{int(datetime.now().timestamp() * 1000)}"
+            character_id = new_character_id()
             # Пересохраняем персонажа с новым ID
             with open(filepath, 'w', encoding='utf-8') as f:
                 character_data['id'] = character_id
                 json.dump(character_data, f, ensure_ascii=False, indent=2)
+            bump_storage_version("characters")
 
         # Сохраняем только ID персонажа в чат
         if not chat_data:
@@ -1118,17 +4633,15 @@ def load_character():
             # Удаляем старые поля для совместимости
             chat_data.pop('character', None)
             chat_data.pop('character_name', None)
+            touch_chat(chat_data)
 
         save_chat_file(chat_id, chat_data)
 
-        # Загружаем правила ГМ для будущего использования
-        rules = load_gm_rules()
-        system_prompt = create_gm_system_prompt(rules)
-        session['system_prompt'] = system_prompt
+        # Клиент сразу попросит начать игру - начинаем генерацию заранее
+        start_opening_scene(chat_id, character_description)
 
-        logger.info(
-            f"Персонаж '{character_name}' (ID: {character_id}) успешно привязан к чату {chat_id}"
-        )
+        logger.info("Персонаж '%s' (ID: %s) успешно привязан к чату %s",
+                    character_name, character_id, chat_id)
 
         return jsonify({
             "success": True,
@@ -1158,37 +4671,174 @@ def create_chat_name_from_response(response):
     return chat_name or "Новое приключение"
 
 
+# Начальная сцена готовится заранее: как только к чату привязан персонаж
+# (load_character или завершение создания персонажа), ее генерация запускается
+# в фоне, и start_game_with_character забирает готовый или почти готовый ответ.
+# OPENING_PREFETCH=0 отключает подготовку. Неиспользованные за ttl секунд
+# заготовки отменяются, как и заготовки удаленных чатов.
+OPENING_CONFIG = {
+    "enabled": os.environ.get("OPENING_PREFETCH", "1") == "1",
+    "ttl": 600,
+    "wait_timeout": 120,
+}
+
+# (user_id, chat_id) -> {"character", "system_prompt", "future", "created", ...}
+opening_scenes = {}
+opening_lock = threading.Lock()
+opening_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="opening")
+
+
+def opening_prompt(character):
+    return f"Начни игру\n\n[ПЕРСОНАЖ ИГРОКА: {character}]"
+
+
+def generate_opening_scene(character, system_prompt, owner):
+    """Начальная сцена и название чата: (ответ, название, токены)"""
+    response, tokens = generate_reply(opening_prompt(character), system_prompt, [],
+                                      owner=owner)
+    return response, create_chat_name_from_response(response), tokens
+
+
+def cancel_opening_entry(entry):
+    """Отменяет заготовку, уже убранную из opening_scenes
+
+    Вызывается без opening_lock: Future.cancel() сразу выполняет обработчик
+    завершения, а он берет opening_lock.
+    """
+    if entry['future'].cancel():
+        return
+    with opening_lock:
+        entry['cancelled'] = True
+        wasted = entry.get('done') and entry['future'].exception() is None
+    if wasted:
+        record_metric("opening_prefetch_wasted_tokens", entry['future'].result()[2])
+
+
+def start_opening_scene(chat_id, character):
+    """Запускает фоновую генерацию начальной сцены для персонажа чата"""
+    if (not OPENING_CONFIG["enabled"] or not API_KEY or not character or route_degraded()
+            or usage_accountant.quota_exceeded(session['user_id'])):
+        return
+
+    entry = {
+        "character": character,
+        "system_prompt": gm_system_prompt(),
+        "created": time.monotonic(),
+        "cancelled": False
+    }
+    key = (session['user_id'], chat_id)
+    with opening_lock:
+        now = time.monotonic()
+        stale = [opening_scenes.pop(other_key) for other_key, other in list(opening_scenes.items())
+                 if other_key == key or now - other['created'] > OPENING_CONFIG["ttl"]]
+        entry['future'] = opening_executor.submit(generate_opening_scene, character,
+                                                  entry['system_prompt'], key)
+        opening_scenes[key] = entry
+    for other in stale:
+        cancel_opening_entry(other)
+    record_metric("opening_prefetch_started")
+
+    def finished(future):
+        with opening_lock:
+            entry['done'] = True
+            if entry['cancelled'] and not future.cancelled() and future.exception() is None:
+                record_metric("opening_prefetch_wasted_tokens", future.result()[2])
+
+    entry['future'].add_done_callback(finished)
+
+
+def cancel_opening_scenes(user_id, chat_id=None):
+    """Отменяет заготовки чата (или всех чатов пользователя)"""
+    with opening_lock:
+        cancelled = [opening_scenes.pop(key) for key in list(opening_scenes)
+                     if key[0] == user_id and chat_id in (None, key[1])]
+    for entry in cancelled:
+        cancel_opening_entry(entry)
+
+
+def take_opening_scene(chat_id, character, turn):
+    """Готовая или догенерирующаяся начальная сцена: (системный промпт, ответ, название) или None
+
+    Пока сцена догенерируется, ход turn проверяется каждые TURN_PROBE_INTERVAL_S;
+    если его отменили, заготовка возвращается на место и бросается
+    GenerationCancelled.
+    """
+    key = (session['user_id'], chat_id)
+    with opening_lock:
+        entry = opening_scenes.pop(key, None)
+    if entry is not None and entry['character'] != character:
+        cancel_opening_entry(entry)
+        entry = None
+    if entry is None:
+        record_metric("opening_prefetch_misses")
+        return None
+
+    record_metric("opening_prefetch_hits" if entry['future'].done() else "opening_prefetch_waits")
+    deadline = time.monotonic() + OPENING_CONFIG["wait_timeout"]
+    try:
+        while True:
+            try:
+                entry['future'].exception(timeout=TURN_PROBE_INTERVAL_S)
+                break
+            except TimeoutError:
+                if time.monotonic() >= deadline:
+                    raise
+                turn.check()
+        response, chat_name, _ = entry['future'].result()
+    except GenerationCancelled:
+        # Заготовка еще пригодится следующему запросу этого чата
+        with opening_lock:
+            restored = opening_scenes.setdefault(key, entry) is entry
+        if not restored:
+            cancel_opening_entry(entry)
+        raise
+    except Exception as e:
+        logger.warning("Заготовка начальной сцены не удалась: %s", e)
+        return None
+    if not response.strip():
+        return None
+    return entry['system_prompt'], response, chat_name
+
+
 @app.route('/start_game_with_character', methods=['POST'])
 @login_required
+@single_flight
 def start_game_with_character():
     """Начинает игру с уже выбранным персонажем"""
     data = request.get_json()
     chat_id = data.get('chat_id', 'default')
 
-    logger.debug(f"start_game_with_character вызван для chat_id='{chat_id}'")
+    logger.debug("start_game_with_character вызван для chat_id=%s", chat_id)
 
     # Загружаем данные чата для проверки персонажа
     chat_data = load_chat_data(chat_id)
     character, character_name = get_chat_character(chat_data)
 
     if not character:
-        logger.error(f"Персонаж не найден в чате {chat_id}")
+        logger.error("Персонаж не найден в чате %s", chat_id)
         return jsonify({"error": "Персонаж не выбран"})
 
-    logger.info(f"Начинаем игру с персонажем: {character_name}")
+    logger.info("Начинаем игру с персонажем: %s", character_name)
 
-    # Загружаем правила ГМ
-    rules = load_gm_rules()
-    system_prompt = create_gm_system_prompt(rules)
-    session['system_prompt'] = system_prompt
+    with gm_turn(chat_id) as turn:
+        try:
+            prefetched = take_opening_scene(chat_id, character, turn)
+        except GenerationCancelled as e:
+            return jsonify({"error": cancelled_reply(e)})
+        if prefetched:
+            _, response, chat_name = prefetched
+        else:
+            # Заготовки нет - генерируем сейчас
+            response = chat_with_ai(opening_prompt(character), gm_system_prompt(), [])
+            chat_name = None
 
-    # Начинаем игру
-    enhanced_prompt = f"Начни игру\n\n[ПЕРСОНАЖ ИГРОКА: {character}]"
-    response = chat_with_ai(enhanced_prompt, system_prompt, [])
+    if isinstance(response, LLMErrorResponse):
+        # Текст ошибки показываем игроку, но в историю чата не пишем
+        return jsonify({"error": response})
 
     if response and response.strip():
         # Создаем название чата из первых слов ответа
-        chat_name = create_chat_name_from_response(response)
+        chat_name = chat_name or create_chat_name_from_response(response)
 
         # Обновляем данные чата
         chat_data['name'] = chat_name
@@ -1203,19 +4853,20 @@ def start_game_with_character():
             "content": response,
             "timestamp": datetime.now().isoformat()
         }]
-        chat_data['messages'] = messages
+        truncate_chat_messages(chat_data, 0)
+        append_chat_messages(chat_data, messages)
 
         # Сохраняем чат
         save_chat_file(chat_id, chat_data)
-
-        # Обновляем сессию
-        session['conversation_history'] = messages
+        schedule_reroll_prefetch(chat_id, chat_data)
 
         return jsonify({
             "success": True,
             "response": response,
             "chat_name": chat_name,
-            "game_started": True
+            "game_started": True,
+            "chat_version": chat_data['version'],
+            "messages": messages
         })
 
     return jsonify({"error": "Не удалось начать игру"})
@@ -1223,6 +4874,7 @@ def start_game_with_character():
 
 @app.route('/save_game', methods=['POST'])
 @login_required
+@single_flight
 def save_game():
     """Сохраняет текущую игру"""
     data = request.get_json()
@@ -1243,6 +4895,7 @@ def save_game():
         "timestamp": datetime.now().isoformat(),
         "conversation_history": conversation_history,
         "character": character,
+        "character_id": chat_data.get('character_id'),
         "character_name": character_name,
         "save_name": save_name,
         "chat_id": chat_id
@@ -1259,6 +4912,7 @@ def save_game():
     try:
         with open(save_path, "w", encoding="utf-8") as f:
             json.dump(save_data, f, ensure_ascii=False, indent=2)
+        bump_storage_version("saves")
 
         return jsonify({"success": True, "message": "Игра сохранена"})
     except Exception as e:
@@ -1282,17 +4936,41 @@ def load_game():
         with open(save_path, "r", encoding="utf-8") as f:
             save_data = json.load(f)
 
-        session['conversation_history'] = save_data.get(
-            'conversation_history', [])
+        # История игры живет в чате: сохраненная история заменяет активную
+        # ветку чата сохранения и получает новые seq - вкладки видят ее через /sync_chat
+        chat_id = save_data.get('chat_id') or 'default'
+        history = save_data.get('conversation_history', [])
+        chat_data = load_chat_data(chat_id) or {
+            "name": save_data.get('save_name') or filename,
+            "messages": [],
+            "created_at": datetime.now().isoformat()
+        }
+        ensure_chat_sequence(chat_data)
+        for key in ('character_id', 'character'):
+            if save_data.get(key):
+                chat_data[key] = save_data[key]
+        # Генерация, еще идущая в этом чате, относится к заменяемой истории
+        cancel_chat_turn(session['user_id'], chat_id)
+        truncate_chat_messages(chat_data, 0)
+        append_chat_messages(chat_data, [{
+            "role": message['role'],
+            "content": message['content'],
+            "timestamp": message.get('timestamp') or save_data.get('timestamp')
+        } for message in history])
+        save_chat_file(chat_id, chat_data)
+
+        session['current_chat_id'] = chat_id
         session['character'] = save_data.get('character', None)
 
         return jsonify({
             "success": True,
             "message": "Игра загружена",
+            "chat_id": chat_id,
+            "chat_version": chat_data['version'],
             "timestamp": save_data.get('timestamp'),
             "character": save_data.get('character'),
             "character_name": save_data.get('character_name'),
-            "history": save_data.get('conversation_history', [])
+            "history": chat_data['messages']
         })
 
     except FileNotFoundError:
@@ -1317,6 +4995,8 @@ def delete_character():
     try:
         if os.path.exists(filepath):
             os.remove(filepath)
+            bump_storage_version("characters")
+            remove_character_from_search(session['user_id'], filename)
             return jsonify({"success": True, "message": "Персонаж удален"})
         else:
             return jsonify({"error": "Файл персонажа не найден"})
@@ -1361,6 +5041,7 @@ def delete_save():
     try:
         if os.path.exists(filepath):
             os.remove(filepath)
+            bump_storage_version("saves")
             return jsonify({"success": True, "message": "Сохранение удалено"})
         else:
             return jsonify({"error": "Файл сохранения не найден"})
@@ -1368,13 +5049,322 @@ def delete_save():
         return jsonify({"error": f"Ошибка удаления сохранения: {str(e)}"})
 
 
+# Экспорт и импорт всех данных пользователя архивом ZIP.
+# Архив пишется и читается по частям: память не зависит от объема данных,
+# в памяти целиком бывает только один файл при проверке (до max_entry_bytes).
+ARCHIVE_KINDS = ("chats", "characters", "saves")
+ARCHIVE_ENTRY_RE = re.compile(r'^(chats|characters|saves)/([^/\\]+)\.json$')
+ARCHIVE_CONFIG = {
+    "chunk_size": 256 * 1024,
+    "max_entry_bytes": int(os.environ.get("IMPORT_MAX_ENTRY_MB", "64")) * 1024 * 1024,
+    "max_reported_errors": 100,
+}
+
+
+class ZipStreamBuffer(io.RawIOBase):
+    """Несеекабельный приемник для zipfile: накопленное забирается по частям"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+@app.route('/export', methods=['GET'])
+@login_required
+def export_user_data():
+    """Отдает чаты, персонажей и сохранения пользователя архивом ZIP
+
+    Архив собирается на лету: файлы читаются и сжимаются кусками, клиент
+    получает данные сразу, размер архива заранее не известен.
+    """
+    user_folder = get_user_folder(session['username'], session['user_id'])
+    # Архив собирается из файлов - сначала дописываем в них чаты из памяти
+    game_states.flush_user(user_folder)
+    manifest = {
+        "format": 1,
+        "username": session['username'],
+        "exported_at": datetime.now().isoformat()
+    }
+
+    def generate():
+        buffer = ZipStreamBuffer()
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED,
+                             compresslevel=6) as archive:
+            archive.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False))
+            for kind in ARCHIVE_KINDS:
+                folder = os.path.join(user_folder, kind)
+                # Холодные чаты попадают в архив распакованными
+                for name, path, opener in iter_json_files(folder):
+                    with opener(path, 'rb') as src, \
+                            archive.open(f"{kind}/{name}.json", 'w', force_zip64=True) as dest:
+                        while True:
+                            chunk = src.read(ARCHIVE_CONFIG["chunk_size"])
+                            if not chunk:
+                                break
+                            dest.write(chunk)
+                            data = buffer.take()
+                            if data:
+                                yield data
+        # Центральный каталог архива
+        yield buffer.take()
+
+    filename = f"rpg_export_{session['user_id']}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    return Response(generate(), mimetype='application/zip', headers={
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "Cache-Control": "no-store"
+    })
+
+
+def read_archive_entry(archive, info):
+    """Читает файл из архива, не больше max_entry_bytes (заголовкам размеров не верим)"""
+    limit = ARCHIVE_CONFIG["max_entry_bytes"]
+    data = bytearray()
+    with archive.open(info) as src:
+        while True:
+            chunk = src.read(ARCHIVE_CONFIG["chunk_size"])
+            if not chunk:
+                break
+            data += chunk
+            if len(data) > limit:
+                raise ValueError(f"файл больше {limit // (1024 * 1024)} МБ")
+    return bytes(data)
+
+
+def validate_archive_entry(kind, data):
+    """Проверяет содержимое файла из архива, возвращает текст ошибки или None"""
+    if not isinstance(data, dict):
+        return "ожидается JSON-объект"
+    if kind == "chats":
+        try:
+            ensure_chat_sequence(data)
+        except (KeyError, TypeError, AttributeError):
+            return "некорректная структура чата"
+    elif kind == "characters":
+        if not isinstance(data.get('description'), str):
+            return "у персонажа нет описания"
+    elif kind == "saves":
+        if not isinstance(data.get('conversation_history', []), list):
+            return "некорректная история сохранения"
+    return None
+
+
+@app.route('/import', methods=['POST'])
+@login_required
+def import_user_data():
+    """Загружает архив, созданный /export
+
+    Архив принимается файлом формы (file) или телом запроса application/zip.
+    Каждый файл проверяется отдельно; существующие файлы не перезаписываются,
+    если не указан ?overwrite=1. Индексы перестраиваются один раз в конце.
+    """
+    overwrite = request.args.get('overwrite') == '1'
+    user_folder = get_user_folder(session['username'], session['user_id'])
+    # Импорт пишет файлы чатов напрямую - чаты в памяти не должны их затереть
+    game_states.flush_user(user_folder, release=True)
+
+    upload = request.files.get('file')
+    if upload is not None:
+        # Большие файлы формы werkzeug уже сохранил во временный файл
+        archive_file = upload.stream
+    else:
+        # zip читается с конца (центральный каталог) - сначала сохраняем тело
+        archive_file = tempfile.TemporaryFile()
+        shutil.copyfileobj(request.stream, archive_file, ARCHIVE_CONFIG["chunk_size"])
+        archive_file.seek(0)
+
+    imported = Counter()
+    skipped = 0
+    errors = []
+    error_count = 0
+
+    def report(name, error):
+        nonlocal error_count
+        error_count += 1
+        if len(errors) < ARCHIVE_CONFIG["max_reported_errors"]:
+            errors.append({"entry": name, "error": error})
+
+    try:
+        try:
+            archive = zipfile.ZipFile(archive_file)
+        except zipfile.BadZipFile:
+            return jsonify({"error": "Файл не является архивом ZIP"})
+
+        with archive:
+            for info in archive.infolist():
+                if info.is_dir() or info.filename == "manifest.json":
+                    continue
+                match = ARCHIVE_ENTRY_RE.match(info.filename)
+                if not match or match.group(2) in ('.', '..'):
+                    report(info.filename, "неизвестный файл")
+                    continue
+                kind, name = match.groups()
+
+                target = os.path.join(user_folder, kind, f"{name}.json")
+                exists = os.path.exists(target) or os.path.exists(target + COLD_SUFFIX)
+                if exists and not overwrite:
+                    skipped += 1
+                    continue
+
+                try:
+                    raw = read_archive_entry(archive, info)
+                    error = validate_archive_entry(kind, json.loads(raw))
+                except (ValueError, zipfile.BadZipFile, EOFError) as e:
+                    error = str(e)
+                if error:
+                    report(info.filename, error)
+                    continue
+
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                partial = f"{target}.part"
+                with open(partial, 'wb') as f:
+                    f.write(raw)
+                os.replace(partial, target)
+                if os.path.exists(target + COLD_SUFFIX):
+                    os.remove(target + COLD_SUFFIX)
+                imported[kind] += 1
+                if kind == "chats":
+                    drop_reroll_candidates(session['user_id'], name, None)
+    finally:
+        archive_file.close()
+
+    # Индексы - один раз на весь импорт
+    for kind in imported:
+        bump_storage_version(kind)
+    if imported["chats"] or imported["characters"]:
+        try:
+            reindex_user_search(session['user_id'], user_folder)
+        except sqlite3.Error as e:
+            logger.warning("Не удалось перестроить поисковый индекс после импорта: %s", e)
+
+    logger.info("Импорт: %s файлов, пропущено %s, ошибок %s",
+                sum(imported.values()), skipped, error_count)
+    return jsonify({
+        "success": True,
+        "imported": dict(imported),
+        "skipped": skipped,
+        "error_count": error_count,
+        "errors": errors
+    })
+
+
+# Загрузка файлов персонажей.
+# Файлы приходят формой multipart/form-data: werkzeug разбирает ее потоком,
+# держа в памяти только небольшие части (большие - во временном файле), а
+# размер формы ограничивается до разбора. Каждый файл читается кусками с
+# проверкой размера и UTF-8 по ходу чтения, JSON разбирается один раз.
+# /upload_characters принимает сразу много файлов (поле file повторяется).
+CHARACTER_UPLOAD_CONFIG = {
+    "max_file_bytes": int(os.environ.get("CHARACTER_UPLOAD_MAX_KB", "256")) * 1024,
+    "max_files": int(os.environ.get("CHARACTER_UPLOAD_MAX_FILES", "50")),
+    "chunk_size": 64 * 1024,
+    # Заголовки частей и обычные поля формы
+    "form_overhead_bytes": 64 * 1024,
+}
+
+
+def limit_character_upload(max_files):
+    """Ограничивает форму текущего запроса - до первого обращения к request.files"""
+    config = CHARACTER_UPLOAD_CONFIG
+    request.max_content_length = config["max_file_bytes"] * max_files + config["form_overhead_bytes"]
+    # Помимо файлов в форме бывает пара обычных полей
+    request.max_form_parts = max_files + 10
+
+
+def upload_too_large_error(max_files):
+    limit_kb = CHARACTER_UPLOAD_CONFIG["max_file_bytes"] // 1024
+    if max_files == 1:
+        return f"Файл больше {limit_kb} КБ"
+    return f"Слишком большая загрузка: не больше {max_files} файлов по {limit_kb} КБ"
+
+
+def read_character_upload(stream):
+    """Текст файла персонажа: читается кусками и не больше max_file_bytes"""
+    config = CHARACTER_UPLOAD_CONFIG
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    parts = []
+    size = 0
+    try:
+        while True:
+            chunk = stream.read(config["chunk_size"])
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > config["max_file_bytes"]:
+                raise ValueError(f"файл больше {config['max_file_bytes'] // 1024} КБ")
+            parts.append(decoder.decode(chunk))
+        parts.append(decoder.decode(b'', final=True))
+    except UnicodeDecodeError:
+        raise ValueError("файл не в кодировке UTF-8")
+    return ''.join(parts)
+
+
+def validate_character_data(character_data):
+    """Проверяет JSON персонажа, возвращает текст ошибки или None
+
+    Формат свободный: описание собирает то, что есть. Отклоняется только то,
+    что format_character_description не может разобрать.
+    """
+    if isinstance(character_data, dict) and 'stats' in character_data \
+            and not isinstance(character_data['stats'], dict):
+        return "stats должно быть объектом"
+    return None
+
+
+def parse_character_file(file_content):
+    """(описание, имя из файла или None); ValueError - файл не подходит
+
+    JSON-объект превращается в читаемое описание, остальное - текст как есть.
+    """
+    stripped = file_content.strip()
+    if not stripped:
+        raise ValueError("файл пустой")
+    if stripped[0] not in '{[':
+        return file_content, None
+    try:
+        character_data = json.loads(stripped)
+    except json.JSONDecodeError:
+        # Похоже на JSON, но не разбирается - сохраняем как текст
+        return file_content, None
+    error = validate_character_data(character_data)
+    if error:
+        raise ValueError(error)
+    name = character_data.get('name') if isinstance(character_data, dict) else None
+    return format_character_description(character_data), str(name) if name else None
+
+
 @app.route('/upload_character', methods=['POST'])
 @login_required
 def upload_character():
-    """Загружает файл персонажа с пользовательским именем"""
-    data = request.get_json()
-    file_content = data.get('file_content')
-    character_name = data.get('character_name', '').strip()
+    """Загружает файл персонажа с пользовательским именем
+
+    Файл передается полем file формы multipart/form-data, имя - полем
+    character_name. Старый способ (JSON с file_content) тоже принимается.
+    """
+    limit_character_upload(1)
+    try:
+        if request.mimetype == 'multipart/form-data':
+            upload = request.files.get('file')
+            character_name = request.form.get('character_name', '').strip()
+            file_content = read_character_upload(upload.stream) if upload else None
+        else:
+            data = request.get_json()
+            file_content = data.get('file_content')
+            character_name = data.get('character_name', '').strip()
+    except RequestEntityTooLarge:
+        return jsonify({"error": upload_too_large_error(1)})
+    except ValueError as e:
+        return jsonify({"error": f"Ошибка при обработке файла: {e}"})
 
     if not file_content:
         return jsonify({"error": "Содержимое файла не получено"})
@@ -1383,15 +5373,7 @@ def upload_character():
         return jsonify({"error": "Имя персонажа не указано"})
 
     try:
-        # Пытаемся распарсить как JSON
-        try:
-            character_data = json.loads(file_content)
-            # Создаем читаемое описание персонажа
-            character_description = format_character_description(
-                character_data)
-        except json.JSONDecodeError:
-            # Если не JSON, используем как текст
-            character_description = file_content
+        character_description, _ = parse_character_file(file_content)
 
         # Сохраняем персонажа с указанным именем
         filename = save_character_to_file(character_description,
@@ -1417,6 +5399,57 @@ def upload_character():
         return jsonify({"error": f"Ошибка при обработке файла: {str(e)}"})
 
 
+@app.route('/upload_characters', methods=['POST'])
+@login_required
+def upload_characters():
+    """Загружает сразу несколько файлов персонажей (поле file формы повторяется)
+
+    Имя берется из поля name JSON-файла, иначе из имени файла. Каждый файл
+    проверяется отдельно: ошибка в одном не мешает остальным.
+    """
+    max_files = CHARACTER_UPLOAD_CONFIG["max_files"]
+    limit_character_upload(max_files)
+    try:
+        uploads = request.files.getlist('file')
+    except RequestEntityTooLarge:
+        return jsonify({"error": upload_too_large_error(max_files)})
+    if not uploads:
+        return jsonify({"error": "Файлы не получены"})
+    if len(uploads) > max_files:
+        return jsonify({"error": upload_too_large_error(max_files)})
+
+    imported = []
+    errors = []
+    for upload in uploads:
+        label = upload.filename or "file"
+        try:
+            character_description, character_name = parse_character_file(
+                read_character_upload(upload.stream))
+        except ValueError as e:
+            errors.append({"file": label, "error": str(e)})
+            continue
+        character_name = (character_name or os.path.splitext(os.path.basename(label))[0]).strip()
+        character_id = save_character_to_file(character_description, character_name or None)
+        if character_id:
+            imported.append({"file": label, "character_name": character_name, "id": character_id})
+        else:
+            errors.append({"file": label, "error": "ошибка сохранения"})
+
+    logger.info("Загрузка персонажей: сохранено %s, ошибок %s", len(imported), len(errors))
+    return jsonify({"success": True, "imported": imported, "errors": errors})
+
+
+def character_list_items(value):
+    """Пункты списка персонажа: объект - "ключ: значение", null - пусто, не список - один пункт"""
+    if value is None:
+        return []
+    if isinstance(value, dict):
+        return [f"{key}: {item}" for key, item in value.items()]
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
 def format_character_description(character_data):
     """Форматирует данные персонажа из JSON в читаемый текст"""
     if isinstance(character_data, dict):
@@ -1441,13 +5474,13 @@ def format_character_description(character_data):
         # Навыки
         if 'skills' in character_data:
             description += "\nНавыки:\n"
-            for skill in character_data['skills']:
+            for skill in character_list_items(character_data['skills']):
                 description += f"- {skill}\n"
 
         # Снаряжение
         if 'equipment' in character_data:
             description += "\nСнаряжение:\n"
-            for item in character_data['equipment']:
+            for item in character_list_items(character_data['equipment']):
                 description += f"- {item}\n"
 
         # Предыстория
@@ -1459,13 +5492,884 @@ def format_character_description(character_data):
     return str(character_data)
 
 
-# Инициализация при запуске
-init_db()
-os.makedirs("user_data", exist_ok=True)
+# Полнотекстовый поиск по чатам и персонажам пользователя.
+# Индекс лежит в отдельной базе SEARCH_DB (SQLite FTS5) и обновляется по мере
+# записи: save_chat_file добавляет только новые сообщения чата, удаление чата,
+# ветки или персонажа убирает их записи. search_docs хранит сами документы,
+# search_fts индексирует их (external content) и синхронизируется триггерами.
+# owner ("u<id>") проиндексирован вместе с текстом, поэтому поиск сразу
+# ограничивается документами пользователя.
+SEARCH_DB = os.environ.get("SEARCH_DB", "search.db")
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 50
+
+# Окончания, которые отбрасываются у слов запроса: "таверне" ищется как "таверн*"
+RUSSIAN_ENDINGS = sorted([
+    "иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "иях",
+    "ией", "ой", "ей", "ий", "ый", "ая", "яя", "ое", "ее", "ие", "ые", "ую",
+    "юю", "ах", "ях", "ом", "ем", "ам", "ям", "ов", "ев", "ть", "ет", "ит",
+    "ут", "ют", "ат", "ят", "а", "я", "о", "е", "ы", "и", "у", "ю", "ь"
+], key=len, reverse=True)
+
+# Маркеры подсветки из FTS5; в HTML превращаются после экранирования текста
+HIGHLIGHT_START = "\ue000"
+HIGHLIGHT_END = "\ue001"
+
+
+def get_search_db():
+    conn = sqlite3.connect(SEARCH_DB, timeout=10)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def init_search_db():
+    conn = get_search_db()
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS search_docs
+            (id INTEGER PRIMARY KEY,
+             owner TEXT NOT NULL,
+             kind TEXT NOT NULL,
+             ref TEXT NOT NULL,
+             seq INTEGER,
+             role TEXT,
+             title TEXT NOT NULL DEFAULT '',
+             body TEXT NOT NULL DEFAULT '');
+        CREATE INDEX IF NOT EXISTS search_docs_ref ON search_docs (owner, kind, ref);
+
+        CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+            owner, title, body,
+            content='search_docs', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2');
+
+        -- unicode61 не считает ё и е одной буквой - в индекс пишем е
+        CREATE TRIGGER IF NOT EXISTS search_docs_ai AFTER INSERT ON search_docs BEGIN
+            INSERT INTO search_fts(rowid, owner, title, body)
+            VALUES (new.id, new.owner,
+                    replace(replace(new.title, 'ё', 'е'), 'Ё', 'Е'),
+                    replace(replace(new.body, 'ё', 'е'), 'Ё', 'Е'));
+        END;
+        CREATE TRIGGER IF NOT EXISTS search_docs_ad AFTER DELETE ON search_docs BEGIN
+            INSERT INTO search_fts(search_fts, rowid, owner, title, body)
+            VALUES ('delete', old.id, old.owner,
+                    replace(replace(old.title, 'ё', 'е'), 'Ё', 'Е'),
+                    replace(replace(old.body, 'ё', 'е'), 'Ё', 'Е'));
+        END;
+
+        -- Что уже проиндексировано в каждом чате
+        CREATE TABLE IF NOT EXISTS search_chats
+            (owner TEXT NOT NULL,
+             chat_id TEXT NOT NULL,
+             name TEXT,
+             max_seq INTEGER NOT NULL DEFAULT 0,
+             turn_count INTEGER NOT NULL DEFAULT 0,
+             PRIMARY KEY (owner, chat_id));
+
+        -- Пользователи, чьи файлы, созданные до индекса, уже проиндексированы
+        CREATE TABLE IF NOT EXISTS search_owners
+            (owner TEXT PRIMARY KEY,
+             indexed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+    ''')
+    conn.commit()
+    conn.close()
+
+
+def search_owner(user_id):
+    return f"u{user_id}"
+
+
+@contextmanager
+def search_db(conn=None):
+    """Соединение с поисковой базой
+
+    Переданное соединение используется как есть - коммитит его владелец
+    (так массовая переиндексация идет одной транзакцией).
+    """
+    if conn is not None:
+        yield conn
+        return
+    conn = get_search_db()
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def index_chat(user_id, chat_id, chat_data, conn=None):
+    """Добавляет в индекс новые сообщения чата и убирает удаленные"""
+    owner = search_owner(user_id)
+    turns = chat_data.get('turns', chat_data.get('messages', []))
+    name = chat_data.get('name', chat_id)
+
+    with search_db(conn) as db:
+        state = db.execute(
+            "SELECT name, max_seq, turn_count FROM search_chats WHERE owner = ? AND chat_id = ?",
+            (owner, chat_id)).fetchone()
+        indexed_name, max_seq, turn_count = state or (None, 0, 0)
+
+        new_turns = [turn for turn in turns if turn.get('seq', 0) > max_seq]
+        if turn_count + len(new_turns) != len(turns):
+            # Часть сообщений удалена (отмотка ветки или удаление ветки)
+            current = {turn.get('seq') for turn in turns}
+            stale = [(doc_id,) for doc_id, seq in db.execute(
+                "SELECT id, seq FROM search_docs WHERE owner = ? AND kind = 'message' AND ref = ?",
+                (owner, chat_id)) if seq not in current]
+            db.executemany("DELETE FROM search_docs WHERE id = ?", stale)
+
+        db.executemany(
+            "INSERT INTO search_docs (owner, kind, ref, seq, role, body) "
+            "VALUES (?, 'message', ?, ?, ?, ?)",
+            [(owner, chat_id, turn['seq'], turn.get('role'), turn.get('content', ''))
+             for turn in new_turns if turn.get('content')])
+
+        if name != indexed_name:
+            db.execute("DELETE FROM search_docs WHERE owner = ? AND kind = 'chat' AND ref = ?",
+                       (owner, chat_id))
+            db.execute("INSERT INTO search_docs (owner, kind, ref, title) VALUES (?, 'chat', ?, ?)",
+                       (owner, chat_id, name))
+
+        db.execute(
+            "INSERT OR REPLACE INTO search_chats (owner, chat_id, name, max_seq, turn_count) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (owner, chat_id, name,
+             max([max_seq] + [turn.get('seq', 0) for turn in new_turns]), len(turns)))
+
+
+def remove_chat_from_search(user_id, chat_id):
+    owner = search_owner(user_id)
+    with search_db() as db:
+        db.execute("DELETE FROM search_docs WHERE owner = ? AND kind IN ('chat', 'message') AND ref = ?",
+                   (owner, chat_id))
+        db.execute("DELETE FROM search_chats WHERE owner = ? AND chat_id = ?", (owner, chat_id))
+
+
+def index_character(user_id, filename, name, description, conn=None):
+    """Заменяет запись персонажа в индексе"""
+    owner = search_owner(user_id)
+    with search_db(conn) as db:
+        db.execute("DELETE FROM search_docs WHERE owner = ? AND kind = 'character' AND ref = ?",
+                   (owner, filename))
+        db.execute(
+            "INSERT INTO search_docs (owner, kind, ref, title, body) VALUES (?, 'character', ?, ?, ?)",
+            (owner, filename, name, description))
+
+
+def remove_character_from_search(user_id, filename):
+    with search_db() as db:
+        db.execute("DELETE FROM search_docs WHERE owner = ? AND kind = 'character' AND ref = ?",
+                   (search_owner(user_id), filename))
+
+
+def reindex_user_search(user_id, user_folder):
+    """Заново строит индекс пользователя по его файлам одной транзакцией"""
+    owner = search_owner(user_id)
+    # Файлы чатов в памяти могут отставать - такие чаты берем из памяти
+    active = dict(game_states.active_chats(user_folder))
+    with search_db() as db:
+        db.execute("DELETE FROM search_docs WHERE owner = ?", (owner,))
+        db.execute("DELETE FROM search_chats WHERE owner = ?", (owner,))
+        for chat_id, chat_data in scan_json_folder(os.path.join(user_folder, "chats")):
+            chat_data = active.get(chat_id) or ensure_chat_sequence(chat_data)
+            index_chat(user_id, chat_id, chat_data, conn=db)
+        for filename, char_data in scan_json_folder(os.path.join(user_folder, "characters")):
+            index_character(user_id, filename, char_data.get('name', filename),
+                            char_data.get('description', ''), conn=db)
+        db.execute("INSERT OR IGNORE INTO search_owners (owner) VALUES (?)", (owner,))
+
+
+def ensure_search_backfill(user_id, user_folder):
+    """Один раз индексирует файлы пользователя, созданные до появления поиска"""
+    with search_db() as db:
+        if db.execute("SELECT 1 FROM search_owners WHERE owner = ?",
+                      (search_owner(user_id),)).fetchone():
+            return
+    reindex_user_search(user_id, user_folder)
+
+
+def build_search_query(text):
+    """Запрос FTS5 из слов пользователя: все слова, с отброшенными окончаниями"""
+    terms = []
+    for word in re.findall(r'\w+', text.lower().replace('ё', 'е'))[:10]:
+        stem = word
+        for ending in RUSSIAN_ENDINGS:
+            if word.endswith(ending) and len(word) - len(ending) >= 2:
+                stem = word[:-len(ending)]
+                break
+        terms.append(f'"{stem}"*')
+    return " AND ".join(terms)
+
+
+def render_highlight(text):
+    """Экранирует текст и превращает маркеры FTS5 в <mark>"""
+    return html.escape(text or '').replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_END, '</mark>')
+
+
+@app.route('/search', methods=['GET'])
+@login_required
+def search():
+    """Поиск по сообщениям, названиям чатов и описаниям персонажей
+
+    ?q= - слова (ищутся все, с любыми окончаниями), ?page= - страница с 1,
+    ?per_page= - размер страницы. Подсветка - теги <mark> в экранированном тексте.
+    """
+    started = time.perf_counter()
+    text = request.args.get('q', '').strip()
+    query = build_search_query(text)
+    if not query:
+        return jsonify({"error": "Пустой запрос"})
+
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = min(SEARCH_MAX_PAGE_SIZE,
+                   max(1, request.args.get('per_page', SEARCH_PAGE_SIZE, type=int)))
+
+    user_folder = get_user_folder(session['username'], session['user_id'])
+    ensure_search_backfill(session['user_id'], user_folder)
+
+    match = f'owner : "{search_owner(session["user_id"])}" AND {{title body}} : ({query})'
+    conn = get_search_db()
+    try:
+        rows = conn.execute(
+            "SELECT d.kind, d.ref, d.seq, d.role, "
+            "       highlight(search_fts, 1, ?, ?), "
+            "       snippet(search_fts, 2, ?, ?, '…', 16) "
+            "FROM search_fts JOIN search_docs d ON d.id = search_fts.rowid "
+            "WHERE search_fts MATCH ? "
+            "ORDER BY bm25(search_fts, 0.0, 5.0, 1.0) "
+            "LIMIT ? OFFSET ?",
+            (HIGHLIGHT_START, HIGHLIGHT_END, HIGHLIGHT_START, HIGHLIGHT_END, match,
+             per_page + 1, (page - 1) * per_page)).fetchall()
+    except sqlite3.OperationalError as e:
+        return jsonify({"error": f"Ошибка поиска: {str(e)}"})
+    finally:
+        conn.close()
+
+    chats = get_storage_index("chats")
+    results = []
+    for kind, ref, seq, role, title, snippet in rows[:per_page]:
+        if kind == 'character':
+            results.append({
+                "kind": kind,
+                "filename": ref,
+                "title": render_highlight(title),
+                "snippet": render_highlight(snippet)
+            })
+        else:
+            chat_name = chats.get(ref, {}).get('name', ref)
+            results.append({
+                "kind": kind,
+                "chat_id": ref,
+                "seq": seq,
+                "role": role,
+                "title": render_highlight(title) if kind == 'chat' else html.escape(chat_name),
+                "snippet": render_highlight(snippet) if kind == 'message' else ''
+            })
+
+    return jsonify({
+        "query": text,
+        "page": page,
+        "per_page": per_page,
+        "has_more": len(rows) > per_page,
+        "results": results,
+        "took_ms": round((time.perf_counter() - started) * 1000, 2)
+    })
+
+
+# Обслуживание хранилища: поиск потерянных и повторяющихся объектов, уплотнение
+# чатов, перевод давно не менявшихся чатов в сжатый холодный слой и перестройка
+# индексов. Без apply только составляет отчет. Чтение и запись ограничены по
+# скорости, поэтому обслуживание можно запускать на работающем сервере.
+MAINTENANCE_CONFIG = {
+    # Период фонового обслуживания в часах; 0 - только вручную
+    "interval_hours": float(os.environ.get("MAINTENANCE_INTERVAL_HOURS", "0")),
+    "io_bytes_per_second": int(float(os.environ.get("MAINTENANCE_IO_MB_PER_S", "8")) * 1024 * 1024),
+    "cold_after_days": int(os.environ.get("MAINTENANCE_COLD_DAYS", "30")),
+    # Пустой основной чат брошен, если его не трогали столько часов
+    "empty_chat_idle_hours": 24,
+    # Файлы .part старше этого - остатки прерванной записи
+    "stale_part_hours": 1,
+    "max_reported": 100
+}
+
+maintenance_lock = threading.Lock()
+maintenance_state = {"running": False, "last_report": None}
+
+
+class IoThrottle:
+    """Ограничивает средний поток чтения и записи (байт в секунду)"""
+
+    def __init__(self, bytes_per_second):
+        self.rate = bytes_per_second
+        self.started = time.monotonic()
+        self.bytes = 0
+        self.waited = 0.0
+
+    def consume(self, nbytes):
+        self.bytes += nbytes
+        if self.rate <= 0:
+            return
+        ahead = self.bytes / self.rate - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+            self.waited += ahead
+
+
+class MaintenanceReport:
+    """Отчет обслуживания: счетчики и ограниченные списки найденного"""
+
+    def __init__(self, apply):
+        self.apply = apply
+        self.started_at = datetime.now().isoformat()
+        self.counts = Counter()
+        self.findings = {}
+
+    def add(self, kind, item):
+        self.counts[kind] += 1
+        items = self.findings.setdefault(kind, [])
+        if len(items) < MAINTENANCE_CONFIG["max_reported"]:
+            items.append(item)
+
+    def as_dict(self, throttle):
+        return {
+            "apply": self.apply,
+            "started_at": self.started_at,
+            "finished_at": datetime.now().isoformat(),
+            "counts": dict(self.counts),
+            "findings": self.findings,
+            "io_bytes": throttle.bytes,
+            "throttle_wait_s": round(throttle.waited, 2)
+        }
+
+
+def read_maintenance_file(path, opener, throttle):
+    """Читает JSON для обслуживания: (данные, stat до чтения) или (None, stat)"""
+    stat = os.stat(path)
+    throttle.consume(stat.st_size)
+    try:
+        with opener(path, 'rb') as f:
+            return json.loads(f.read()), stat
+    except (OSError, ValueError, EOFError):
+        return None, stat
+
+
+def replace_if_unchanged(path, stat, target, payload, throttle, opener=open):
+    """Пишет payload в target, если path не менялся после чтения
+
+    Запись идет через .part и os.replace. Возвращает False, если файл успели
+    изменить - тогда он остается как есть до следующего обслуживания.
+    """
+    partial = f"{target}.part"
+    with opener(partial, 'wb') as f:
+        f.write(payload)
+    throttle.consume(len(payload))
+    current = os.stat(path)
+    if (current.st_mtime_ns, current.st_size) != (stat.st_mtime_ns, stat.st_size):
+        os.remove(partial)
+        return False
+    os.replace(partial, target)
+    return True
+
+
+def compact_chat(chat_data):
+    """Уплотняет дерево чата: (удалено сообщений, удалено меток удаления)
+
+    Убирает сообщения, недостижимые из веток, и метки удаления не новее
+    min_sync_version - такие клиенты все равно получают чат целиком.
+    """
+    removed_turns = collect_chat_turns(chat_data)
+    marks = chat_data['deleted']
+    chat_data['deleted'] = [mark for mark in marks if mark['v'] > chat_data['min_sync_version']]
+    return removed_turns, len(marks) - len(chat_data['deleted'])
+
+
+def maintain_user_folder(user_folder, report, throttle):
+    """Обслуживание папки одного пользователя, возвращает измененные разделы"""
+    config = MAINTENANCE_CONFIG
+    user_label = os.path.basename(user_folder)
+    now = time.time()
+    changed = set()
+
+    # Персонажи: одинаковые по имени и описанию - повторы
+    character_ids = set()
+    characters_by_content = {}
+    for filename, path, opener in iter_json_files(os.path.join(user_folder, "characters")):
+        char_data, _ = read_maintenance_file(path, opener, throttle)
+        if not isinstance(char_data, dict):
+            report.add("unreadable_files", f"{user_label}/characters/{filename}")
+            continue
+        character_ids.add(char_data.get('id'))
+        key = hashlib.sha1(f"{char_data.get('name', '').strip().lower()}\n"
+                           f"{char_data.get('description', '')}".encode('utf-8')).hexdigest()
+        characters_by_content.setdefault(key, []).append(filename)
+    for filenames in characters_by_content.values():
+        if len(filenames) > 1:
+            report.add("duplicate_characters", {"user": user_label, "files": sorted(filenames)})
+
+    chats_folder = os.path.join(user_folder, "chats")
+    chat_files = list(iter_json_files(chats_folder))
+    chat_ids = {chat_id for chat_id, _, _ in chat_files}
+
+    # Сжатая копия рядом с обычным файлом остается после сбоя - обычный новее
+    if os.path.isdir(chats_folder):
+        for name in os.listdir(chats_folder):
+            if name.endswith('.json' + COLD_SUFFIX) and \
+                    os.path.exists(os.path.join(chats_folder, name[:-len(COLD_SUFFIX)])):
+                report.add("duplicate_cold_chats", f"{user_label}/chats/{name}")
+                if report.apply:
+                    os.remove(os.path.join(chats_folder, name))
+
+    for chat_id, path, opener in chat_files:
+        label = f"{user_label}/chats/{chat_id}"
+        chat_data, stat = read_maintenance_file(path, opener, throttle)
+        if not isinstance(chat_data, dict):
+            report.add("unreadable_files", label)
+            continue
+        report.counts["chats_scanned"] += 1
+        try:
+            ensure_chat_sequence(chat_data)
+            active_chat_path(chat_data)
+        except (KeyError, ValueError, TypeError):
+            report.add("broken_chats", label)
+            continue
+
+        character_id = chat_data.get('character_id')
+        if character_id and character_id != 'None' and character_id not in character_ids:
+            report.add("chats_missing_character", {"chat": label, "character_id": character_id})
+
+        # Пока файл обслуживается, чат не загрузят и не перезапишут из памяти
+        with game_states.hold_idle(user_folder, chat_id) as idle:
+            if not idle or \
+                    os.path.exists(os.path.join(chats_folder, f"{chat_id}{JOURNAL_SUFFIX}")):
+                # Чат в игре: файл скоро перезапишется из памяти
+                report.add("active_chats", label)
+                continue
+
+            idle_hours = (now - stat.st_mtime) / 3600
+            if chat_id == 'default' and len(chat_ids) > 1 and not chat_data['turns'] \
+                    and not character_id and not chat_data.get('character') \
+                    and idle_hours >= config["empty_chat_idle_hours"]:
+                report.add("empty_default_chats", label)
+                if report.apply:
+                    os.remove(path)
+                    chat_ids.discard(chat_id)
+                    changed.add("chats")
+                continue
+
+            removed_turns, removed_marks = compact_chat(chat_data)
+            cold = opener is open and idle_hours >= config["cold_after_days"] * 24
+            if not (removed_turns or removed_marks or cold):
+                continue
+            if removed_turns or removed_marks:
+                report.add("compacted_chats", label)
+                report.counts["turns_removed"] += removed_turns
+                report.counts["tombstones_removed"] += removed_marks
+            if cold:
+                report.add("cold_chats", label)
+            if not report.apply:
+                continue
+
+            stored = {key: value for key, value in chat_data.items() if key != 'messages'}
+            payload = json.dumps(stored, ensure_ascii=False, indent=2).encode('utf-8')
+            if opener is gzip.open or cold:
+                base = path[:-len(COLD_SUFFIX)] if opener is gzip.open else path
+                written = replace_if_unchanged(path, stat, base + COLD_SUFFIX, payload,
+                                               throttle, opener=gzip.open)
+                if written and cold:
+                    # Здесь чат не загрузить, но сервер в другом процессе мог
+                    # записать его заново - тогда главный он, а не сжатая копия
+                    current = os.stat(path)
+                    if (current.st_mtime_ns, current.st_size) != (stat.st_mtime_ns, stat.st_size):
+                        os.remove(base + COLD_SUFFIX)
+                        written = False
+                    else:
+                        os.remove(path)
+                        report.counts["cold_bytes_before"] += stat.st_size
+                        report.counts["cold_bytes_after"] += os.path.getsize(base + COLD_SUFFIX)
+            else:
+                written = replace_if_unchanged(path, stat, path, payload, throttle)
+                if written:
+                    # Уплотнение - не изменение: срок до холодного слоя не сбрасываем
+                    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            if written:
+                changed.add("chats")
+            else:
+                report.add("busy_files", label)
+
+    # Сохранения самодостаточны, но ссылка на удаленный чат - признак мусора
+    for filename, path, opener in iter_json_files(os.path.join(user_folder, "saves")):
+        save_data, _ = read_maintenance_file(path, opener, throttle)
+        if not isinstance(save_data, dict):
+            report.add("unreadable_files", f"{user_label}/saves/{filename}")
+            continue
+        if save_data.get('chat_id') and save_data['chat_id'] not in chat_ids:
+            report.add("saves_missing_chat", {"save": f"{user_label}/saves/{filename}",
+                                              "chat_id": save_data['chat_id']})
+
+    # Остатки прерванной записи (импорт, обслуживание)
+    for kind in ARCHIVE_KINDS:
+        folder = os.path.join(user_folder, kind)
+        if not os.path.isdir(folder):
+            continue
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.name.endswith('.part') and entry.is_file() and \
+                        now - entry.stat().st_mtime >= config["stale_part_hours"] * 3600:
+                    report.add("stale_part_files", f"{user_label}/{kind}/{entry.name}")
+                    if report.apply:
+                        os.remove(entry.path)
+
+    return changed
+
+
+def run_storage_maintenance(apply=False, throttle=None):
+    """Обслуживание всех пользователей, возвращает отчет
+
+    С apply исправляет найденное и перестраивает индексы, без него - только отчет.
+    Потерянные ссылки и повторы только попадают в отчет: решать их судьбу
+    должен пользователь.
+    """
+    throttle = throttle or IoThrottle(MAINTENANCE_CONFIG["io_bytes_per_second"])
+    report = MaintenanceReport(apply)
+    owners = set()
+    if os.path.isdir("user_data"):
+        folders = sorted(entry.path for entry in os.scandir("user_data")
+                         if entry.is_dir() and '@' in entry.name)
+    else:
+        folders = []
+
+    for user_folder in folders:
+        user_id = user_folder.rsplit('@', 1)[-1]
+        owners.add(search_owner(user_id))
+        report.counts["users"] += 1
+        try:
+            # Обслуживание и поисковый индекс читают файлы - дописываем их из памяти
+            game_states.flush_user(user_folder)
+            changed = maintain_user_folder(user_folder, report, throttle)
+            if not apply:
+                continue
+            for kind in changed:
+                bump_storage_version(kind, user_folder)
+            reindex_user_search(user_id, user_folder)
+            # Перестройка индекса читает файлы пользователя еще раз
+            throttle.consume(sum(os.path.getsize(path)
+                                 for kind in ("chats", "characters")
+                                 for _, path, _ in iter_json_files(os.path.join(user_folder, kind))))
+        except (OSError, sqlite3.Error) as e:
+            logger.error("Ошибка обслуживания %s: %s", user_folder, e)
+            report.add("errors", {"user": os.path.basename(user_folder), "error": str(e)})
+
+    if apply:
+        try:
+            with search_db() as db:
+                # Записи пользователей, чьих папок больше нет
+                stale = [owner for (owner,) in db.execute(
+                    "SELECT DISTINCT owner FROM search_docs") if owner not in owners]
+                for owner in stale:
+                    db.execute("DELETE FROM search_docs WHERE owner = ?", (owner,))
+                    db.execute("DELETE FROM search_chats WHERE owner = ?", (owner,))
+                    db.execute("DELETE FROM search_owners WHERE owner = ?", (owner,))
+                    report.add("stale_search_owners", owner)
+                # Слияние сегментов FTS после множества мелких вставок и удалений
+                db.execute("INSERT INTO search_fts(search_fts) VALUES ('optimize')")
+        except sqlite3.Error as e:
+            logger.error("Ошибка обслуживания поискового индекса: %s", e)
+            report.add("errors", {"user": None, "error": str(e)})
+
+    result = report.as_dict(throttle)
+    logger.info("Обслуживание хранилища завершено: %s", result["counts"],
+                extra={"event": "storage_maintenance"})
+    return result
+
+
+def start_storage_maintenance(apply):
+    """Запускает обслуживание в фоне; False, если оно уже идет"""
+    if not maintenance_lock.acquire(blocking=False):
+        return False
+
+    def run():
+        maintenance_state["running"] = True
+        try:
+            maintenance_state["last_report"] = run_storage_maintenance(apply)
+        except Exception as e:
+            logger.exception("Обслуживание хранилища прервано: %s", e)
+        finally:
+            maintenance_state["running"] = False
+            maintenance_lock.release()
+
+    threading.Thread(target=run, name="storage-maintenance", daemon=True).start()
+    return True
+
+
+def schedule_storage_maintenance():
+    """Периодическое обслуживание с apply, если задан MAINTENANCE_INTERVAL_HOURS"""
+    interval = MAINTENANCE_CONFIG["interval_hours"] * 3600
+    if interval <= 0:
+        return
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            start_storage_maintenance(apply=True)
+
+    threading.Thread(target=loop, name="storage-maintenance-timer", daemon=True).start()
+
+
+@app.route('/admin/maintenance', methods=['GET'])
+@admin_required
+def get_storage_maintenance():
+    """Состояние обслуживания и отчет последнего запуска"""
+    return jsonify(maintenance_state)
+
+
+@app.route('/admin/maintenance', methods=['POST'])
+@admin_required
+def run_storage_maintenance_route():
+    """Запускает обслуживание хранилища в фоне ({"apply": true} - с исправлениями)"""
+    data = request.get_json(silent=True) or {}
+    if not start_storage_maintenance(bool(data.get('apply'))):
+        return jsonify({"error": "Обслуживание уже выполняется"})
+    return jsonify({"success": True, "apply": bool(data.get('apply'))})
+
+
+# Действия, доступные через WebSocket: те же обработчики, что и у REST
+WS_ACTIONS = {
+    "send_message": ("POST", "/send_message"),
+    "edit_message": ("POST", "/edit_message"),
+    "start_game_with_character": ("POST", "/start_game_with_character"),
+    "load_character": ("POST", "/load_character"),
+    "create_chat": ("POST", "/create_chat"),
+    "delete_chat": ("POST", "/delete_chat"),
+    "save_game": ("POST", "/save_game"),
+    "reroll": ("POST", "/reroll"),
+    "switch_branch": ("POST", "/switch_branch"),
+    "prune_branch": ("POST", "/prune_branch"),
+    "chat_branches": ("GET", "/chat_branches"),
+    "sync_chat": ("GET", "/sync_chat"),
+    "bootstrap": ("GET", "/bootstrap"),
+}
+
+
+class WebSocketConnection:
+    """Одна вкладка, подключенная по WebSocket
+
+    Действия выполняются по очереди в отдельном потоке, чтобы долгий ответ ГМ
+    не мешал читать сообщения и отвечать на ping. Каждое действие проходит через
+    обычный обработчик Flask с cookie сессии этого подключения.
+    """
+
+    def __init__(self, ws, user_id, cookies, base_url):
+        self.ws = ws
+        self.user_id = user_id
+        self.cookies = dict(cookies)
+        self.base_url = base_url
+        self.send_lock = threading.Lock()
+        self.closed = False
+        self.last_seen = time.monotonic()
+        self.actions = queue.Queue()
+        # Одинаковые действия в очереди: ключ -> id запросов, ждущих тот же результат
+        self.flights = {}
+        self.flights_lock = threading.Lock()
+        self.worker = threading.Thread(target=self._process_actions,
+                                       name="ws-actions", daemon=True)
+
+    def send_json(self, event):
+        if self.closed:
+            return
+        try:
+            with self.send_lock:
+                self.ws.send(json.dumps(event, ensure_ascii=False))
+        except Exception:
+            self.closed = True
+
+    def serve(self):
+        """Читает сообщения до закрытия подключения, следит за heartbeat"""
+        self.worker.start()
+        try:
+            while not self.closed:
+                try:
+                    raw = self.ws.receive(timeout=WS_CONFIG["heartbeat_interval"])
+                except ConnectionClosed:
+                    break
+                if raw is None:
+                    if time.monotonic() - self.last_seen > WS_CONFIG["heartbeat_timeout"]:
+                        logger.info("WebSocket пользователя %s не отвечает, закрываем",
+                                    self.user_id)
+                        break
+                    self.send_json({"type": "ping"})
+                    continue
+                self.last_seen = time.monotonic()
+                self.handle_message(raw)
+        finally:
+            self.closed = True
+            self.actions.put(None)
+
+    def handle_message(self, raw):
+        try:
+            message = json.loads(raw)
+        except (TypeError, ValueError):
+            self.send_json({"type": "error", "error": "Некорректное сообщение"})
+            return
+
+        message_type = message.get('type')
+        if message_type == 'ping':
+            self.send_json({"type": "pong"})
+        elif message_type == 'action':
+            if message.get('action') not in WS_ACTIONS:
+                self.send_json({
+                    "type": "result",
+                    "id": message.get('id'),
+                    "action": message.get('action'),
+                    "data": {"error": "Неизвестное действие"}
+                })
+                return
+            if self.attach_to_flight(message):
+                return
+            if message['action'] in TURN_SUPERSEDING_ACTIONS:
+                # Действия выполняются по очереди - прерываем генерацию,
+                # которую это действие заменит, не дожидаясь ее конца
+                payload = message.get('payload') or {}
+                cancel_chat_turn(self.user_id, payload.get('chat_id', 'default'))
+            self.actions.put(message)
+            self.send_json({
+                "type": "status",
+                "state": "queued",
+                "id": message.get('id'),
+                "position": self.actions.qsize()
+            })
+
+    def attach_to_flight(self, message):
+        """Такое же действие уже в очереди - ждем его результат вместо повтора
+
+        Действия вкладки выполняются по очереди, поэтому повтор пришел бы в
+        обработчик уже после первого и не совпал бы с ним по single_flight.
+        """
+        if WS_ACTIONS[message['action']][1] not in SINGLE_FLIGHT_PATHS:
+            return False
+        key = (message['action'],
+               json.dumps(message.get('payload'), sort_keys=True, ensure_ascii=False))
+        with self.flights_lock:
+            followers = self.flights.get(key)
+            if followers is None:
+                self.flights[key] = []
+                message['flight_key'] = key
+                return False
+            followers.append(message.get('id'))
+        record_metric("idempotent_replays")
+        self.send_json({"type": "status", "state": "attached", "id": message.get('id')})
+        return True
+
+    def _process_actions(self):
+        while True:
+            message = self.actions.get()
+            if message is None or self.closed:
+                return
+            try:
+                data = self.dispatch(message['action'], message.get('payload') or {})
+            except Exception as e:
+                logger.error("Ошибка действия %s по WebSocket: %s", message['action'], e)
+                data = {"error": f"Ошибка выполнения: {str(e)}"}
+            request_ids = [message.get('id')]
+            if 'flight_key' in message:
+                with self.flights_lock:
+                    request_ids += self.flights.pop(message['flight_key'], [])
+            for request_id in request_ids:
+                self.send_json({
+                    "type": "result",
+                    "id": request_id,
+                    "action": message['action'],
+                    "data": data
+                })
+
+    def dispatch(self, action, payload):
+        """Выполняет действие через обработчик Flask и возвращает его JSON"""
+        method, path = WS_ACTIONS[action]
+        cookie_header = "; ".join(f"{name}={value}" for name, value in self.cookies.items())
+        builder = EnvironBuilder(path=path,
+                                 base_url=self.base_url,
+                                 method=method,
+                                 json=payload if method == 'POST' else None,
+                                 query_string=payload if method == 'GET' else None,
+                                 headers={"Cookie": cookie_header})
+        # Генерация ГМ прерывается, если вкладка закрылась (см. gm_turn)
+        llm_stream.alive = lambda: not self.closed
+        try:
+            with app.request_context(builder.get_environ()):
+                response = app.full_dispatch_request()
+        finally:
+            llm_stream.alive = None
+            builder.close()
+
+        # Сессия меняется внутри обработчиков - запоминаем новую cookie
+        for header in response.headers.getlist('Set-Cookie'):
+            name, _, rest = header.partition('=')
+            self.cookies[name] = rest.split(';', 1)[0]
+        return response.get_json(silent=True)
+
+
+if Sock is not None:
+    sock = Sock(app)
+
+    @sock.route('/ws')
+    def game_socket(ws):
+        """Двусторонний канал вкладки: события хранилища, статус и текст ответа ГМ
+
+        ?last_event=N досылает события после N или присылает reset, если
+        столько уже не хранится.
+        """
+        if 'user_id' not in session:
+            ws.send(json.dumps({"type": "error", "error": "Требуется авторизация"},
+                               ensure_ascii=False))
+            return
+
+        connection = WebSocketConnection(ws, session['user_id'], request.cookies,
+                                         request.host_url)
+        channel = get_user_channel(session['user_id'])
+        channel.attach(connection, request.args.get('last_event', type=int))
+        try:
+            connection.serve()
+        finally:
+            channel.detach(connection)
+
+
+# Инициализация приложения.
+# Импорт main ничего не создает на диске и не запускает фоновых потоков - это
+# делает create_app(). WSGI-сервер: gunicorn "main:create_app()"; если сервер
+# берет main:app, инициализация выполнится перед первым запросом.
+app_initialized = False
+app_init_lock = threading.Lock()
+
+
+def create_app():
+    """Готовит базы, папки, ассеты и фоновые задачи; возвращает app
+
+    Повторные вызовы ничего не делают.
+    """
+    global app_initialized
+    with app_init_lock:
+        if not app_initialized:
+            setup_logging()
+            atexit.register(shutdown_logging)
+            init_db()
+            usage_accountant.load_today()
+            usage_accountant.start()
+            atexit.register(usage_accountant.stop)
+            game_states.start()
+            atexit.register(game_states.stop)
+            init_search_db()
+            os.makedirs("user_data", exist_ok=True)
+            build_static_assets()
+            schedule_storage_maintenance()
+            app_initialized = True
+    return app
+
 
 if __name__ == "__main__":
-    import sys
-    if len(sys.argv) > 1 and sys.argv[1] == 'web':
+    create_app()
+    if len(sys.argv) > 1 and sys.argv[1] == 'maintenance':
+        # python main.py maintenance [--apply] - обслуживание без веб-сервера
+        print(json.dumps(run_storage_maintenance(apply='--apply' in sys.argv),
+                         ensure_ascii=False, indent=2))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'web':
         print("🌐 Запуск веб-сервера на http://0.0.0.0:5000")
         app.run(host='0.0.0.0', port=5000, debug=True)
     else:
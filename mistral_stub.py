@@ -0,0 +1,274 @@
+"""Локальная заглушка API Mistral для нагрузочных тестов
+
+Отвечает на POST /v1/chat/completions так же, как Mistral: JSON-ответом или
+потоком SSE (stream: true). Задержка первого токена берется из распределения,
+текст выдается с заданной скоростью токенов, часть запросов получает ошибки.
+Квота настоящего API не расходуется.
+
+    python mistral_stub.py --port 8099 --latency lognormal --median-s 1.5 \\
+        --tokens-per-s 40 --error-rate 0.01 --rate-limit-rate 0.02
+    MISTRAL_SERVER_URL=http://127.0.0.1:8099 MISTRAL_API_KEY=stub python main.py
+
+Ошибки: error_rate - 500, rate_limit_rate - 429, hang_rate - ответ не
+приходит hang_s секунд (клиент упирается в таймаут), drop_rate - поток
+обрывается на середине. GET /stats - счетчики заглушки.
+"""
+import argparse
+import json
+import math
+import random
+import secrets
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ("таверна", "дорога", "туман", "старый", "страж", "кивает", "вам", "и", "в",
+         "огонь", "тихо", "скрипит", "дверь", "за", "спиной", "слышен", "звон", "мечей")
+
+
+class MistralStub:
+    """Поведение заглушки: задержки, длина ответов, ошибки и счетчики"""
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.stats = Counter()
+
+    def _random(self):
+        with self.lock:
+            return self.rng.random()
+
+    def first_token_s(self):
+        """Время до первого токена, с"""
+        args = self.args
+        with self.lock:
+            if args.latency == "fixed":
+                return args.median_s
+            delay = self.rng.lognormvariate(math.log(args.median_s), args.sigma)
+            if args.latency == "stall" and self.rng.random() < args.stall_rate:
+                # Изредка провайдер "залипает" на десятки секунд
+                delay = self.rng.uniform(args.stall_s / 2, args.stall_s)
+            return delay
+
+    def reply_words(self):
+        with self.lock:
+            count = max(1, round(self.rng.lognormvariate(math.log(self.args.reply_tokens), 0.3)))
+            return [self.rng.choice(WORDS) for _ in range(count)]
+
+    def fault(self):
+        """Какую ошибку вбросить в этот запрос: None, error, rate_limit, hang, drop"""
+        roll = self._random()
+        for fault, rate in (("error", self.args.error_rate),
+                            ("rate_limit", self.args.rate_limit_rate),
+                            ("hang", self.args.hang_rate),
+                            ("drop", self.args.drop_rate)):
+            if roll < rate:
+                return fault
+            roll -= rate
+        return None
+
+    def count(self, **values):
+        with self.lock:
+            self.stats.update(values)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+def prompt_tokens(messages):
+    # Как и оценка в main.py: около 4 символов на токен
+    return sum(len(str(message.get("content", ""))) for message in messages) // 4 + 1
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "MistralStub/1.0"
+
+    @property
+    def stub(self):
+        return self.server.stub
+
+    def log_message(self, format, *args):
+        if getattr(self.stub.args, "verbose", False):
+            super().log_message(format, *args)
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, error_type, message):
+        self.send_json(status, {"object": "error", "type": error_type, "message": message,
+                                "code": str(status)})
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.stub.snapshot())
+        elif self.path == "/v1/models":
+            self.send_json(200, {"object": "list", "data": [
+                {"id": model, "object": "model", "owned_by": "stub"}
+                for model in ("mistral-large-latest", "mistral-medium-latest",
+                              "mistral-small-latest", "ministral-8b-latest")]})
+        else:
+            self.send_error_json(404, "not_found", "Not found")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.send_error_json(400, "invalid_request_error", "Invalid JSON")
+            return
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self.send_error_json(404, "not_found", "Not found")
+            return
+
+        stub = self.stub
+        stream = bool(body.get("stream"))
+        stub.count(requests=1, streams=int(stream))
+        fault = stub.fault()
+        if fault == "error":
+            stub.count(errors_500=1)
+            self.send_error_json(500, "internal_error", "Injected server error")
+            return
+        if fault == "rate_limit":
+            stub.count(errors_429=1)
+            self.send_error_json(429, "rate_limited", "Service tier capacity exceeded")
+            return
+        if fault == "hang":
+            stub.count(hangs=1)
+            time.sleep(stub.args.hang_s)
+
+        model = body.get("model", "mistral-large-latest")
+        completion_id = "cmpl-" + secrets.token_hex(8)
+        created = int(time.time())
+        usage_in = prompt_tokens(body.get("messages", []))
+        words = stub.reply_words()
+        time.sleep(stub.first_token_s())
+        if stream:
+            self.stream_reply(completion_id, created, model, words, usage_in,
+                              drop=fault == "drop")
+            return
+
+        # Без потока ответ приходит целиком, когда "сгенерирован" последний токен
+        time.sleep(len(words) / stub.args.tokens_per_s)
+        stub.count(completion_tokens=len(words), prompt_tokens=usage_in)
+        self.send_json(200, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": " ".join(words)},
+                "finish_reason": "stop"
+            }],
+            "usage": {"prompt_tokens": usage_in, "completion_tokens": len(words),
+                      "total_tokens": usage_in + len(words)}
+        })
+
+    def stream_reply(self, completion_id, created, model, words, usage_in, drop):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        # Конец потока - закрытие соединения
+        self.send_header("Connection", "close")
+        self.close_connection = True
+        self.end_headers()
+
+        def event(delta, finish_reason=None, usage=None):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            }
+            if usage:
+                chunk["usage"] = usage
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        token_s = 1 / self.stub.args.tokens_per_s
+        sent = 0
+        try:
+            event({"role": "assistant", "content": ""})
+            for index, word in enumerate(words):
+                if drop and index == len(words) // 2:
+                    self.stub.count(drops=1)
+                    return
+                event({"content": word + (" " if index < len(words) - 1 else "")})
+                sent += 1
+                time.sleep(token_s)
+            event({"content": ""}, "stop", {"prompt_tokens": usage_in,
+                                            "completion_tokens": len(words),
+                                            "total_tokens": usage_in + len(words)})
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент отменил генерацию (разрыв, дубль запроса, отмена хода)
+            self.stub.count(client_cancelled=1)
+        finally:
+            self.stub.count(completion_tokens=sent, prompt_tokens=usage_in)
+
+
+def make_stub_server(args, host, port):
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.stub = MistralStub(args)
+    return server
+
+
+def start_stub(args, host="127.0.0.1", port=0):
+    """Запускает заглушку в фоновом потоке; возвращает (сервер, адрес)"""
+    server = make_stub_server(args, host, port)
+    threading.Thread(target=server.serve_forever, name="mistral-stub", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def add_stub_arguments(parser):
+    """Параметры поведения заглушки (общие с bench.py load)"""
+    parser.add_argument("--latency", choices=["fixed", "lognormal", "stall"],
+                        default="lognormal", help="распределение задержки первого токена")
+    parser.add_argument("--median-s", type=float, default=1.0)
+    parser.add_argument("--sigma", type=float, default=0.4)
+    parser.add_argument("--stall-rate", type=float, default=0.01)
+    parser.add_argument("--stall-s", type=float, default=30)
+    parser.add_argument("--tokens-per-s", type=float, default=50)
+    parser.add_argument("--reply-tokens", type=int, default=120)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--hang-rate", type=float, default=0.0)
+    parser.add_argument("--hang-s", type=float, default=120)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--verbose", action="store_true")
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    server = make_stub_server(args, args.host, args.port)
+    print(f"Заглушка Mistral: http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.stub.snapshot(), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    run()
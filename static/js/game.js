@@ -0,0 +1,1493 @@
+let currentCharacter = null;
+let currentCharacterName = null;
+let userInfo = null;
+let selectedCharacterFile = null;
+let selectedSaveFile = null;
+let gameStarted = false;
+let currentChatId = 'default';
+let chatsData = {};
+let currentChatUnsaved = false;
+let selectedFile = null;
+// Токены версий разделов из /bootstrap - для частичного обновления
+let storageVersions = {};
+
+// Загружаем все данные при загрузке страницы одним запросом
+window.onload = function() {
+    loadBootstrap(true);
+    connectSocket();
+};
+
+function loadBootstrap(initial = false) {
+    const params = new URLSearchParams(initial ? {} : storageVersions);
+
+    fetch('/bootstrap?' + params.toString())
+    .then(response => response.json())
+    .then(data => {
+        if (data.need_login) {
+            window.location.href = '/';
+            return;
+        }
+
+        userInfo = data.user;
+        document.getElementById('username-display').textContent = data.user.username;
+        storageVersions = data.versions;
+
+        // null - раздел не изменился с прошлой загрузки
+        if (data.characters) {
+            renderCharacters(data.characters);
+        }
+        if (data.saves) {
+            renderSaves(data.saves);
+        }
+        if (data.chats) {
+            applyChatsManifest(data.chats);
+
+            if (!initial && chatsData[currentChatId] && chatsData[currentChatId].needsSync) {
+                // Текущий чат изменился в другой вкладке - догружаем изменения
+                loadChatMessages(currentChatId);
+            }
+
+            if (initial) {
+                if (!chatsData[currentChatId]) {
+                    const chatIds = Object.keys(chatsData);
+                    if (chatIds.length > 0) {
+                        currentChatId = chatIds[0];
+                    }
+                }
+                updateChatsUI();
+                loadChatMessages(currentChatId);
+            }
+        }
+    })
+    .catch(error => {
+        console.error('Ошибка загрузки данных:', error);
+    });
+}
+
+// WebSocket: сервер сам сообщает об изменениях, статусе и тексте ответа ГМ
+let socket = null;
+let socketRetryDelay = 1000;
+let lastEventSeq = null;
+let nextRequestId = 1;
+const pendingRequests = {};
+let bootstrapTimer = null;
+
+function connectSocket() {
+    if (!window.WebSocket) return;
+
+    const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+    const resume = lastEventSeq !== null ? `?last_event=${lastEventSeq}` : '';
+    const ws = new WebSocket(`${protocol}//${window.location.host}/ws${resume}`);
+
+    ws.onopen = () => {
+        socket = ws;
+        socketRetryDelay = 1000;
+    };
+    ws.onmessage = (message) => {
+        handleSocketEvent(JSON.parse(message.data));
+    };
+    ws.onclose = () => {
+        socket = null;
+        // Запросы без ответа переотправлять нельзя - сообщаем об ошибке
+        Object.keys(pendingRequests).forEach(id => {
+            pendingRequests[id].reject(new Error('соединение прервано'));
+            delete pendingRequests[id];
+        });
+        setTimeout(connectSocket, socketRetryDelay);
+        socketRetryDelay = Math.min(socketRetryDelay * 2, 30000);
+    };
+}
+
+function handleSocketEvent(event) {
+    if (event.event_seq !== undefined) {
+        lastEventSeq = event.event_seq;
+    }
+
+    switch (event.type) {
+        case 'hello':
+            if (lastEventSeq === null) lastEventSeq = event.event_seq;
+            break;
+        case 'ping':
+            socket && socket.send(JSON.stringify({type: 'pong'}));
+            break;
+        case 'result':
+            if (pendingRequests[event.id]) {
+                pendingRequests[event.id].resolve(event.data);
+                delete pendingRequests[event.id];
+            }
+            break;
+        case 'reset':
+            // Пропущено слишком много событий - перечитываем изменившееся
+            scheduleBootstrap();
+            break;
+        case 'storage_changed':
+            scheduleBootstrap();
+            break;
+        case 'chat_updated': {
+            const chat = chatsData[event.chat_id];
+            if (chat && chat.version !== event.version) {
+                chat.needsSync = true;
+                if (event.chat_id === currentChatId && !pendingRequestsCount()) {
+                    loadChatMessages(currentChatId);
+                }
+            }
+            break;
+        }
+        case 'status':
+            if (event.chat_id === currentChatId && event.state === 'generating' &&
+                !document.getElementById('gm-loading')) {
+                showLoading();
+            }
+            break;
+        case 'gm_delta':
+            if (event.chat_id === currentChatId) {
+                appendStreamingText(event.text);
+            }
+            break;
+    }
+}
+
+function pendingRequestsCount() {
+    return Object.keys(pendingRequests).length;
+}
+
+function scheduleBootstrap() {
+    // Несколько событий подряд - один запрос
+    clearTimeout(bootstrapTimer);
+    bootstrapTimer = setTimeout(() => loadBootstrap(), 200);
+}
+
+function appendStreamingText(text) {
+    let streaming = document.getElementById('gm-streaming');
+    if (!streaming) {
+        hideLoading();
+        streaming = document.createElement('div');
+        streaming.id = 'gm-streaming';
+        streaming.className = 'message gm-message';
+        streaming.innerHTML = '<div class="message-header">🎲 Гейм Мастер</div><div class="message-content"></div>';
+        document.getElementById('messages').appendChild(streaming);
+    }
+    const content = streaming.querySelector('.message-content');
+    content.textContent += text;
+    const messages = document.getElementById('messages');
+    messages.scrollTop = messages.scrollHeight;
+}
+
+function removeStreamingMessage() {
+    const streaming = document.getElementById('gm-streaming');
+    if (streaming) streaming.remove();
+}
+
+function apiPost(path, payload) {
+    // Через WebSocket, если он открыт (с потоковым ответом), иначе обычный fetch
+    const action = path.replace(/^\//, '');
+    if (socket && socket.readyState === WebSocket.OPEN) {
+        const id = nextRequestId++;
+        return new Promise((resolve, reject) => {
+            pendingRequests[id] = {resolve, reject};
+            socket.send(JSON.stringify({type: 'action', id, action, payload}));
+        });
+    }
+    return fetch(path, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(payload)
+    }).then(response => response.json());
+}
+
+function applyChatsManifest(manifest) {
+    // Манифест не содержит сообщений - они подгружаются при открытии чата
+    const previous = chatsData;
+    chatsData = {};
+
+    Object.entries(manifest).forEach(([chatId, meta]) => {
+        const old = previous[chatId];
+        chatsData[chatId] = Object.assign({}, meta);
+        // Уже загруженные сообщения оставляем; если чат изменился,
+        // при открытии догрузим только разницу через /sync_chat
+        if (old && old.messages) {
+            chatsData[chatId].messages = old.messages;
+            chatsData[chatId].version = old.version;
+            chatsData[chatId].character = old.character;
+            if (old.version !== meta.version) {
+                chatsData[chatId].needsSync = true;
+            }
+        }
+    });
+
+    // Новый чат, еще не сохраненный на сервере, не теряем
+    if (currentChatUnsaved && previous[currentChatId] && !chatsData[currentChatId]) {
+        chatsData[currentChatId] = previous[currentChatId];
+    }
+
+    updateChatsUI();
+}
+
+function updateChatsUI() {
+    const list = document.getElementById('chats-list');
+    list.innerHTML = '';
+
+    Object.entries(chatsData).forEach(([chatId, chatData]) => {
+        const item = document.createElement('div');
+        item.className = 'list-item';
+        if (chatId === currentChatId) {
+            item.classList.add('selected');
+        }
+
+        // Для чатов из манифеста сообщений нет - берем счетчик и превью
+        const messageCount = chatData.messages ? chatData.messages.length : (chatData.message_count || 0);
+        const lastContent = chatData.messages && chatData.messages.length > 0
+            ? chatData.messages[chatData.messages.length - 1].content
+            : chatData.last_message;
+        const lastMessage = messageCount > 0 && lastContent
+            ? lastContent.substring(0, 50) + '...'
+            : 'Пустой чат';
+
+        item.innerHTML = `
+            <div class="list-item-content">
+                <h4>${chatData.name || chatId}</h4>
+                <p>${lastMessage}</p>
+                <p style="font-size: 0.65em;">${messageCount} сообщений</p>
+            </div>
+            <button class="delete-btn" onclick="deleteChat('${chatId}', event)" title="Удалить">×</button>
+        `;
+        item.onclick = (e) => {
+            if (!e.target.classList.contains('delete-btn')) {
+                switchToChat(chatId);
+            }
+        };
+        list.appendChild(item);
+    });
+
+    const chatHeader = document.getElementById('chat-name');
+    if (chatsData[currentChatId]) {
+        chatHeader.textContent = chatsData[currentChatId].name || currentChatId;
+    }
+}
+
+function createNewChat() {
+    const nameInput = document.getElementById('new-chat-name');
+    const chatName = nameInput.value.trim() || `Чат ${Date.now()}`;
+    const chatId = `chat_${Date.now()}`;
+
+    // Вариант 1: Если персонаж уже выбран - создаем чат сперсонажем
+    if (selectedCharacterFile) {
+        chatsData[chatId] = {
+            name: chatName,
+            messages: [],
+            character_id: null, // Будет установлен при загрузке персонажа
+            created_at: new Date().toISOString()
+        };
+
+        nameInput.value = '';
+        currentChatId = chatId;
+        currentChatUnsaved = true;
+
+        updateChatsUI();
+        clearMessages();
+
+        // Автоматически загружаем выбранного персонажа в новый чат
+        const characterName = document.querySelector(`[onclick*="'${selectedCharacterFile}'"]`)?.querySelector('h4')?.textContent || 'Персонаж';
+        loadCharacterAndStartGame(selectedCharacterFile, characterName);
+        clearSelections();
+        showNotification(`Создан новый чат "${chatName}" с персонажем`, 'success');
+    } else {
+        // Вариант 2: Создаем пустой чат без персонажа
+        chatsData[chatId] = {
+            name: chatName,
+            messages: [],
+            character_id: null,
+            created_at: new Date().toISOString()
+        };
+
+        nameInput.value = '';
+        currentChatId = chatId;
+        currentChatUnsaved = true;
+
+        currentCharacter = null;
+        currentCharacterName = null;
+        updateCurrentCharacterDisplay();
+
+        updateChatsUI();
+        clearMessages();
+        clearSelections();
+        showStartScreen();
+        showNotification(`Создан новый чат: ${chatName}`, 'success');
+    }
+}
+
+
+
+let searchTimer = null;
+let searchPage = 1;
+
+function scheduleSearch() {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(() => runSearch(1), 250);
+}
+
+function runSearch(page) {
+    const query = document.getElementById('search-input').value.trim();
+    const list = document.getElementById('search-results');
+    if (!query) {
+        list.innerHTML = '';
+        return;
+    }
+
+    fetch(`/search?q=${encodeURIComponent(query)}&page=${page}`)
+    .then(response => response.json())
+    .then(data => {
+        if (data.error) {
+            list.innerHTML = '';
+            return;
+        }
+        searchPage = page;
+        if (page === 1) list.innerHTML = '';
+        document.getElementById('search-more')?.remove();
+
+        // title и snippet уже экранированы сервером, <mark> - подсветка
+        data.results.forEach(result => {
+            const item = document.createElement('div');
+            item.className = 'list-item search-result';
+            const icon = result.kind === 'character' ? '👤' : (result.kind === 'chat' ? '💬' : '📜');
+            item.innerHTML = `
+                <div class="list-item-content">
+                    <h4>${icon} ${result.title}</h4>
+                    ${result.snippet ? `<p>${result.snippet}</p>` : ''}
+                </div>
+            `;
+            if (result.chat_id) {
+                item.onclick = () => switchToChat(result.chat_id);
+            }
+            list.appendChild(item);
+        });
+
+        if (data.results.length === 0 && page === 1) {
+            list.innerHTML = '<p style="opacity: 0.7; font-size: 0.8em;">Ничего не найдено</p>';
+        }
+        if (data.has_more) {
+            const more = document.createElement('button');
+            more.id = 'search-more';
+            more.className = 'action-btn';
+            more.textContent = 'Еще';
+            more.onclick = () => runSearch(searchPage + 1);
+            list.appendChild(more);
+        }
+    })
+    .catch(error => {
+        console.error('Ошибка поиска:', error);
+    });
+}
+
+function switchToChat(chatId) {
+    if (chatId === currentChatId) return;
+
+    currentChatId = chatId;
+    currentChatUnsaved = false;
+    updateChatsUI();
+    loadChatMessages(chatId);
+    clearSelections();
+}
+
+function loadChatMessages(chatId) {
+    const chatData = chatsData[chatId];
+    if (!chatData) {
+        // Создаем пустой чат если его нет
+        chatsData[chatId] = {
+            name: 'Новый чат',
+            messages: [],
+            character_id: null,
+            created_at: new Date().toISOString()
+        };
+        clearMessages();
+        currentCharacter = null;
+        currentCharacterName = null;
+        updateCurrentCharacterDisplay();
+        showStartScreen();
+        return;
+    }
+
+    if (!chatData.messages || chatData.needsSync) {
+        // Чат пришел из манифеста или устарел - догружаем сообщения
+        syncChat(chatId)
+        .then(synced => {
+            if (synced && chatId === currentChatId) {
+                loadChatMessages(chatId);
+            }
+        })
+        .catch(error => {
+            console.error('Ошибка загрузки чата:', error);
+        });
+        return;
+    }
+
+    clearMessages();
+    hideLoading(); // Убираем старые индикаторы загрузки при переключении чата
+
+    // Получаем персонажа через ID
+    const character_id = chatData.character_id;
+    if (character_id && character_id !== 'None') {
+        // Загружаем персонажа по ID
+        fetch('/get_character_by_id', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ character_id: character_id })
+        })
+        .then(response => response.json())
+        .then(data => {
+            if (data.success) {
+                currentCharacter = data.character;
+                currentCharacterName = data.character_name;
+                updateCurrentCharacterDisplay();
+            }
+        })
+        .catch(error => {
+            console.error('Ошибка загрузки персонажа:', error);
+        });
+    } else {
+        // Для обратной совместимости со старыми чатами
+        if (chatData.character) {
+            currentCharacter = chatData.character;
+            currentCharacterName = chatData.character_name || 'Персонаж';
+        } else {
+            currentCharacter = null;
+            currentCharacterName = null;
+        }
+    }
+
+    updateCurrentCharacterDisplay();
+
+    // Всегда показываем интерфейс чата, даже если он пустой
+    hideStartScreen();
+
+    // Загружаем сообщения если они есть
+    if (chatData.messages && chatData.messages.length > 0) {
+        chatData.messages.forEach(msg => {
+            if (msg.role === 'user') {
+                addMessage('player', msg.content);
+            } else if (msg.role === 'assistant') {
+                addMessage('gm', msg.content);
+            }
+        });
+    }
+
+    // Показываем стартовый экран только если нет персонажа И нет сообщений
+    if (!currentCharacter && (!chatData.messages || chatData.messages.length === 0)) {
+        showStartScreen();
+    }
+
+    updateBranchSelect(chatId);
+}
+
+function updateBranchSelect(chatId) {
+    // Выбор ветки показываем только если веток больше одной
+    const select = document.getElementById('branch-select');
+    const chat = chatsData[chatId];
+    if (!chat || !(chat.branch_count > 1)) {
+        select.style.display = 'none';
+        return;
+    }
+
+    fetch(`/chat_branches?chat_id=${encodeURIComponent(chatId)}`)
+    .then(response => response.json())
+    .then(data => {
+        if (data.error || chatId !== currentChatId) return;
+        select.innerHTML = '';
+        data.branches.forEach(branch => {
+            const option = document.createElement('option');
+            option.value = branch.id;
+            option.textContent = `🌿 ${branch.name} (${branch.message_count})`;
+            option.selected = branch.id === data.active;
+            select.appendChild(option);
+        });
+        select.style.display = data.branches.length > 1 ? 'inline-block' : 'none';
+    })
+    .catch(error => {
+        console.error('Ошибка загрузки веток:', error);
+    });
+}
+
+function switchBranch(branchId) {
+    const chatId = currentChatId;
+    apiPost('/switch_branch', { chat_id: chatId, branch_id: branchId })
+    .then(data => {
+        if (data.error) {
+            showNotification(data.error, 'error');
+            return;
+        }
+        // Догружаем только различия между ветками
+        return syncChat(chatId).then(() => {
+            if (chatId === currentChatId) {
+                loadChatMessages(chatId);
+            }
+        });
+    })
+    .catch(error => {
+        showNotification('Ошибка переключения ветки: ' + error.message, 'error');
+    });
+}
+
+function syncChat(chatId) {
+    // Запрашиваем только изменения после известной нам версии чата
+    const chat = chatsData[chatId];
+    const since = chat && chat.messages && chat.version !== undefined ? chat.version : -1;
+
+    return fetch(`/sync_chat?chat_id=${encodeURIComponent(chatId)}&since=${since}`)
+    .then(response => response.json())
+    .then(data => {
+        if (data.error || !chatsData[chatId]) {
+            return false;
+        }
+        applyChatDelta(chatsData[chatId], data);
+        return true;
+    });
+}
+
+function applyChatDelta(chat, delta) {
+    let messages = (delta.full || !chat.messages) ? [] : chat.messages;
+
+    if (delta.deleted && delta.deleted.length > 0) {
+        const deleted = new Set(delta.deleted);
+        messages = messages.filter(msg => !deleted.has(msg.seq));
+    }
+
+    const positions = new Map(messages.map((msg, index) => [msg.seq, index]));
+    delta.messages.forEach(msg => {
+        if (positions.has(msg.seq)) {
+            messages[positions.get(msg.seq)] = msg;
+        } else {
+            messages.push(msg);
+        }
+    });
+    messages.sort((a, b) => a.seq - b.seq);
+
+    chat.messages = messages;
+    chat.version = delta.version;
+    chat.message_count = messages.length;
+    ['name', 'character_id', 'character_name', 'character', 'branch_count'].forEach(key => {
+        if (delta[key] !== undefined) {
+            chat[key] = delta[key];
+        }
+    });
+    delete chat.needsSync;
+}
+
+function clearMessages() {
+    document.getElementById('messages').innerHTML = '';
+}
+
+function showStartScreen() {
+    document.getElementById('start-screen').style.display = 'flex';
+    document.getElementById('game-area').style.display = 'none';
+    gameStarted = false;
+}
+
+function hideStartScreen() {
+    document.getElementById('start-screen').style.display = 'none';
+    document.getElementById('game-area').style.display = 'flex';
+    gameStarted = true;
+}
+
+
+
+let pendingDeleteAction = null;
+
+function deleteChat(chatId, event) {
+    event.stopPropagation();
+
+    if (Object.keys(chatsData).length <= 1) {
+        showNotification('Нельзя удалить последний чат', 'error');
+        return;
+    }
+
+    const chatName = chatsData[chatId]?.name || chatId;
+    showConfirmDelete(
+        'Удаление чата',
+        `Вы уверены, что хотите удалить чат "${chatName}"? Это действие нельзя отменить.`,
+        () => {
+            fetch('/delete_chat', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({chat_id: chatId})
+            })
+            .then(response => response.json())
+            .then(data => {
+                if (data.success) {
+                    delete chatsData[chatId];
+
+                    if (chatId === currentChatId) {
+                        const remainingChats = Object.keys(chatsData);
+                        if (remainingChats.length > 0) {
+                            switchToChat(remainingChats[0]);
+                        }
+                    }
+
+                    updateChatsUI();
+                    showNotification('Чат удален', 'success');
+                } else {
+                    showNotification(data.error, 'error');
+                }
+            })
+            .catch(error => {
+                showNotification('Ошибка удаления: ' + error.message, 'error');
+            });
+        }
+    );
+}
+
+function logout() {
+    fetch('/logout', { method: 'POST' })
+    .then(() => {
+        window.location.href = '/';
+    });
+}
+
+function loadCharacters() {
+    fetch('/get_characters')
+    .then(response => response.json())
+    .then(data => {
+        renderCharacters(data.characters || []);
+    })
+    .catch(error => {
+        console.error('Ошибка загрузки персонажей:', error);
+    });
+}
+
+function renderCharacters(characters) {
+    const list = document.getElementById('characters-list');
+    list.innerHTML = '';
+
+    if (characters.length > 0) {
+        characters.forEach(char => {
+            const item = document.createElement('div');
+            item.className = 'list-item';
+
+            // Используем имя из файла без системных цифр
+            const displayName = char.name || char.filename;
+
+            item.innerHTML = `
+                <div class="list-item-content">
+                    <h4>${displayName}</h4>
+                    <p>${char.description}</p>
+                </div>
+                <button class="delete-btn" onclick="deleteCharacter('${char.filename}', event)" title="Удалить">×</button>
+            `;
+            item.onclick = (e) => {
+                if (!e.target.classList.contains('delete-btn')) {
+                    selectCharacter(char.filename, displayName, item);
+                }
+            };
+            list.appendChild(item);
+        });
+    } else {
+        list.innerHTML = '<p style="opacity: 0.6; text-align: center; font-size: 0.8em;">Нет персонажей</p>';
+    }
+}
+
+function loadSaves() {
+    fetch('/get_saves')
+    .then(response => response.json())
+    .then(data => {
+        renderSaves(data.saves || []);
+    })
+    .catch(error => {
+        console.error('Ошибка загрузки сохранений:', error);
+    });
+}
+
+function renderSaves(saves) {
+    const list = document.getElementById('saves-list');
+    list.innerHTML = '';
+
+    if (saves.length > 0) {
+        saves.forEach(save => {
+            const item = document.createElement('div');
+            item.className = 'list-item';
+            item.innerHTML = `
+                <div class="list-item-content">
+                    <h4>${save.filename}</h4>
+                    <p>${save.character_name}</p>
+                    <p style="font-size: 0.65em;">${new Date(save.timestamp).toLocaleString()}</p>
+                </div>
+                <button class="delete-btn" onclick="deleteSave('${save.filename}', event)" title="Удалить">×</button>
+            `;
+            item.onclick = (e) => {
+                if (!e.target.classList.contains('delete-btn')) {
+                    selectSave(save.filename, item);
+                }
+            };
+            list.appendChild(item);
+        });
+    } else {
+        list.innerHTML = '<p style="opacity: 0.6; text-align: center; font-size: 0.8em;">Нет сохранений</p>';
+    }
+}
+
+function selectCharacter(filename, name, element) {
+    // Проверяем, есть ли текущий чат и есть ли в нем уже персонаж
+    const currentChat = chatsData[currentChatId];
+
+    if (currentChat && currentChat.character_id) {
+        // Если в текущем чате уже есть персонаж - показываем модальное окно
+        showCharacterChangeModal(filename, name, element);
+    } else {
+        // Если в текущем чате нет персонажа - загружаем персонажа в текущий чат
+        clearSelections();
+        element.classList.add('selected');
+        selectedCharacterFile = filename;
+        selectedSaveFile = null;
+        loadCharacterAndStartGame(filename, name);
+    }
+}
+
+function showCharacterChangeModal(filename, name, element) {
+    const modal = document.getElementById('characterChangeModal');
+    const message = document.getElementById('characterChangeMessage');
+    message.textContent = `В текущем чате уже выбран персонаж. Создать новый чат с персонажем "${name}"?`;
+
+    modal.style.display = 'block';
+
+    // Сохраняем данные для обработки
+    modal.dataset.filename = filename;
+    modal.dataset.name = name;
+    modal.dataset.elementIndex = Array.from(element.parentNode.children).indexOf(element);
+}
+
+function confirmCharacterChange() {
+    const modal = document.getElementById('characterChangeModal');
+    const filename = modal.dataset.filename;
+    const name = modal.dataset.name;
+    const elementIndex = parseInt(modal.dataset.elementIndex);
+    const element = document.getElementById('characters-list').children[elementIndex];
+
+    clearSelections();
+    element.classList.add('selected');
+    selectedCharacterFile = filename;
+    selectedSaveFile = null;
+    updateSelectedCharacterIndicator(name);
+    createNewChat(); // Создастся с выбранным персонажем (вариант 1)
+
+    closeCharacterChangeModal();
+}
+
+function closeCharacterChangeModal() {
+    document.getElementById('characterChangeModal').style.display = 'none';
+}
+
+function showConfirmDelete(title, message, confirmCallback) {
+    const modal = document.getElementById('confirmDeleteModal');
+    const titleElement = document.getElementById('confirmDeleteTitle');
+    const messageElement = document.getElementById('confirmDeleteMessage');
+
+    titleElement.textContent = title;
+    messageElement.textContent = message;
+
+    pendingDeleteAction = confirmCallback;
+    modal.style.display = 'block';
+}
+
+function closeConfirmDeleteModal() {
+    document.getElementById('confirmDeleteModal').style.display = 'none';
+    pendingDeleteAction = null;
+}
+
+function confirmDelete() {
+    if (pendingDeleteAction) {
+        pendingDeleteAction();
+        closeConfirmDeleteModal();
+    }
+}
+
+function selectSave(filename, element) {
+    clearSelections();
+    element.classList.add('selected');
+
+    selectedSaveFile = filename;
+    selectedCharacterFile = null;
+
+    showNotification(`Сохранение "${filename}" выбрано`, 'success');
+}
+
+function clearSelections() {
+    document.querySelectorAll('.list-item').forEach(item => {
+        item.classList.remove('selected');
+    });
+    selectedCharacterFile = null;
+    selectedSaveFile = null;
+
+    // Скрываем индикатор выбранного персонажа
+    document.getElementById('selected-character-indicator').style.display = 'none';
+}
+
+function updateSelectedCharacterIndicator(characterName) {
+    const indicator = document.getElementById('selected-character-indicator');
+    const nameElement = document.getElementById('selected-character-name');
+
+    if (selectedCharacterFile && characterName) {
+        nameElement.textContent = characterName;
+        indicator.style.display = 'block';
+    } else {
+        indicator.style.display = 'none';
+    }
+}
+
+function loadCharacterOnly(filename) {
+    showLoading();
+
+    fetch('/load_character', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+            filename: filename,
+            chat_id: currentChatId
+        })
+    })
+    .then(response => response.json())
+    .then(data => {
+        hideLoading();
+
+        if (data.success) {
+            currentCharacter = data.character;
+            currentCharacterName = data.character_name;
+
+            updateCurrentCharacterDisplay();
+
+            showNotification(data.message, 'success');
+        } else {
+            showNotification(data.error, 'error');
+        }
+    })
+    .catch(error => {
+        hideLoading();
+        showNotification('Ошибка загрузки персонажа: ' + error.message, 'error');
+    });
+}
+
+function loadCharacterAndStartGame(filename, characterName) {
+    console.log('Начинаем загрузку персонажа:', filename, 'для чата:', currentChatId);
+
+    // Сразу скрываем стартовый экран и показываем чат
+    hideStartScreen();
+    showLoading();
+
+    fetch('/load_character', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+            filename: filename,
+            chat_id: currentChatId
+        })
+    })
+    .then(response => response.json())
+    .then(data => {
+        console.log('Ответ загрузки персонажа:', data);
+        if (data.success) {
+            currentCharacter = data.character;
+            currentCharacterName = data.character_name || characterName;
+            console.log('Персонаж загружен:', currentCharacterName);
+
+            // Обновляем данные чата с персонажем
+            if (!chatsData[currentChatId]) {
+                chatsData[currentChatId] = {
+                    name: `Чат ${currentCharacterName}`,
+                    messages: [],
+                    character: currentCharacter,
+                    character_name: currentCharacterName
+                };
+            } else {
+                chatsData[currentChatId].character = currentCharacter;
+                chatsData[currentChatId].character_name = currentCharacterName;
+            }
+
+            updateCurrentCharacterDisplay();
+
+            // Автоматически начинаем игру
+            console.log('Начинаем игру с персонажем для чата:', currentChatId);
+            showLoading(); // Показываем индикатор загрузки перед запросом
+            return apiPost('/start_game_with_character', {
+                chat_id: currentChatId
+            });
+        } else {
+            hideLoading();
+            showStartScreen();
+            showNotification(data.error, 'error');
+            throw new Error(data.error);
+        }
+    })
+    .then(data => {
+        console.log('Ответ начала игры:', data);
+        hideLoading();
+        removeStreamingMessage();
+        if (data.success) {
+            console.log('Игра успешно началась');
+            // Добавляем сообщения в чат
+            if (!chatsData[currentChatId].messages) {
+                chatsData[currentChatId].messages = [];
+            }
+
+            if (data.messages) {
+                chatsData[currentChatId].messages = data.messages;
+                chatsData[currentChatId].version = data.chat_version;
+            } else {
+                chatsData[currentChatId].messages.push(
+                    {role: 'user', content: 'Начни игру'},
+                    {role: 'assistant', content: data.response}
+                );
+            }
+
+            updateChatsUI();
+            clearMessages();
+            addMessage('gm', data.response);
+
+            showNotification(`Игра началась с персонажем ${currentCharacterName}!`, 'success');
+        } else {
+            showStartScreen();
+            showNotification(data.error, 'error');
+        }
+    })
+    .catch(error => {
+        hideLoading();
+        showStartScreen();
+        showNotification('Ошибка начала игры: ' + error.message, 'error');
+    });
+}
+
+
+
+function updateCurrentCharacterDisplay() {
+    const section = document.getElementById('current-character-section');
+    const nameElement = document.getElementById('current-character-name');
+
+    if (currentCharacterName) {
+        section.style.display = 'block';
+        nameElement.textContent = currentCharacterName;
+    } else {
+        section.style.display = 'none';
+    }
+}
+
+function sendMessage() {
+    const input = document.getElementById('messageInput');
+    const message = input.value.trim();
+
+    if (!message) return;
+
+    addMessage('player', message);
+    input.value = '';
+
+    if (currentChatUnsaved) {
+        currentChatUnsaved = false;
+        saveChatAfterFirstMessage();
+    }
+
+    showLoading();
+
+    apiPost('/send_message', {
+        message: message,
+        chat_id: currentChatId
+    })
+    .then(data => {
+        hideLoading();
+        removeStreamingMessage();
+        if (data.error) {
+            if (data.need_login) {
+                window.location.href = '/';
+                return;
+            }
+            showError(data.error);
+        } else {
+            addMessage('gm', data.response);
+
+            const chat = chatsData[currentChatId];
+            if (chat) {
+                chat.messages = chat.messages || [];
+                if (data.messages && chat.version === data.base_version) {
+                    // Сервер вернул сохраненные сообщения с номерами
+                    chat.messages.push(...data.messages);
+                    chat.version = data.chat_version;
+                    chat.needsSync = false;
+                } else if (data.messages) {
+                    // Чат менялся параллельно (другая вкладка) - догрузим разницу
+                    chat.needsSync = true;
+                    syncChat(currentChatId).then(() => updateChatsUI());
+                } else {
+                    chat.messages.push(
+                        {role: 'user', content: message, timestamp: new Date().toISOString()},
+                        {role: 'assistant', content: data.response, timestamp: new Date().toISOString()}
+                    );
+                }
+                chatsData[currentChatId].character = currentCharacter;
+                chatsData[currentChatId].character_name = currentCharacterName;
+            }
+
+            updateChatsUI();
+
+            if (data.character_created) {
+                currentCharacter = data.character;
+                currentCharacterName = data.character_name || 'Персонаж';
+                updateCurrentCharacterDisplay();
+                loadCharacters();
+                showNotification('Персонаж создан!', 'success');
+            }
+        }
+    })
+    .catch(error => {
+        hideLoading();
+        removeStreamingMessage();
+        showError('Ошибка соединения: ' + error.message);
+    });
+}
+
+function rerollLastResponse() {
+    const chatId = currentChatId;
+    showLoading();
+
+    apiPost('/reroll', { chat_id: chatId })
+    .then(data => {
+        hideLoading();
+        removeStreamingMessage();
+        if (data.error) {
+            showNotification(data.error, 'error');
+            return;
+        }
+        // Новый вариант лежит в новой ветке - догружаем разницу и перерисовываем
+        return syncChat(chatId).then(() => {
+            updateChatsUI();
+            if (chatId === currentChatId) {
+                loadChatMessages(chatId);
+            }
+        });
+    })
+    .catch(error => {
+        hideLoading();
+        removeStreamingMessage();
+        showError('Ошибка соединения: ' + error.message);
+    });
+}
+
+function saveChatAfterFirstMessage() {
+    setTimeout(() => {
+        updateChatsUI();
+    }, 500);
+}
+
+function addMessage(type, content) {
+    const messages = document.getElementById('messages');
+    const messageDiv = document.createElement('div');
+    messageDiv.className = `message ${type}-message`;
+
+    const playerName = currentCharacterName || 'Игрок';
+    const header = type === 'gm' ? '🎲 Гейм Мастер' : `🎮 ${playerName}`;
+
+    messageDiv.innerHTML = `
+        <div class="message-header">${header}</div>
+        <div class="message-content">${content.replace(/\n/g, '<br>')}</div>
+    `;
+
+    messages.appendChild(messageDiv);
+    messages.scrollTop = messages.scrollHeight;
+}
+
+function showLoading() {
+    // Сначала удаляем все существующие индикаторы загрузки
+    hideLoading();
+
+    const messages = document.getElementById('messages');
+    const loadingDiv = document.createElement('div');
+    loadingDiv.id = 'gm-loading';
+    loadingDiv.className = 'loading gm-loading-indicator';
+    loadingDiv.textContent = '🤔 ГМ размышляет...';
+    messages.appendChild(loadingDiv);
+    messages.scrollTop = messages.scrollHeight;
+}
+
+function hideLoading() {
+    // Более агрессивная очистка всех возможных индикаторов загрузки
+    const selectors = [
+        '.loading', 
+        '#loading', 
+        '#gm-loading', 
+        '.gm-loading-indicator',
+        '[class*="loading"]'
+    ];
+
+    selectors.forEach(selector => {
+        const elements = document.querySelectorAll(selector);
+        elements.forEach(element => {
+            try {
+                if (element && element.parentNode) {
+                    element.parentNode.removeChild(element);
+                }
+            } catch (e) {
+                console.log('Элемент уже удален:', e);
+            }
+        });
+    });
+
+    // Дополнительная очистка через innerText поиск
+    const messages = document.getElementById('messages');
+    if (messages) {
+        const allDivs = messages.querySelectorAll('div');
+        allDivs.forEach(div => {
+            if (div.textContent && div.textContent.includes('ГМ размышляет')) {
+                try {
+                    div.remove();
+                } catch (e) {
+                    console.log('Не удалось удалить элемент:', e);
+                }
+            }
+        });
+    }
+}
+
+function showError(message) {
+    const messages = document.getElementById('messages');
+    const errorDiv = document.createElement('div');
+    errorDiv.className = 'error';
+    errorDiv.textContent = `❌ ${message}`;
+    messages.appendChild(errorDiv);
+    messages.scrollTop = messages.scrollHeight;
+}
+
+function handleKeyPress(event) {
+    if (event.key === 'Enter' && !event.shiftKey) {
+        event.preventDefault();
+        sendMessage();
+    }
+}
+
+function saveGame() {
+    const saveName = document.getElementById('save-name-input').value.trim() || 
+                   `save_${new Date().toISOString().slice(0,19).replace(/[:.]/g, '-')}`;
+
+    fetch('/save_game', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+            save_name: saveName,
+            chat_id: currentChatId
+        })
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.error) {
+            showNotification(data.error, 'error');
+        } else {
+            showNotification(data.message, 'success');
+            document.getElementById('save-name-input').value = '';
+            loadSaves();
+        }
+    })
+    .catch(error => {
+        showNotification('Ошибка сохранения: ' + error.message, 'error');
+    });
+}
+
+// Модальное окно загрузки файла
+function openFileUploadModal() {
+    document.getElementById('fileUploadModal').style.display = 'block';
+    document.getElementById('characterNameInput').value = '';
+    document.getElementById('uploadBtn').disabled = true;
+    selectedFile = null;
+    resetFileUploadArea();
+}
+
+function showSelectedFile(file) {
+    // Скрываем стандартный текст
+    document.getElementById('uploadIcon').style.display = 'none';
+    document.getElementById('uploadText').style.display = 'none';
+    document.getElementById('uploadHint').style.display = 'none';
+
+    // Показываем информацию о выбранном файле
+    document.getElementById('selectedFileInfo').style.display = 'block';
+    document.getElementById('selectedFileName').textContent = file.name;
+}
+
+function resetFileUploadArea() {
+    // Показываем стандартный текст
+    document.getElementById('uploadIcon').style.display = 'block';
+    document.getElementById('uploadText').style.display = 'block';
+    document.getElementById('uploadHint').style.display = 'block';
+
+    // Скрываем информацию о файле
+    document.getElementById('selectedFileInfo').style.display = 'none';
+    document.getElementById('selectedFileName').textContent = '';
+}
+
+function closeFileUploadModal() {
+    document.getElementById('fileUploadModal').style.display = 'none';
+}
+
+function handleFileSelect(event) {
+    const file = event.target.files[0];
+    if (file) {
+        selectedFile = file;
+        showSelectedFile(file);
+        updateUploadButton();
+    }
+}
+
+function handleDragOver(event) {
+    event.preventDefault();
+    event.currentTarget.classList.add('dragover');
+}
+
+function handleDragLeave(event) {
+    event.currentTarget.classList.remove('dragover');
+}
+
+function handleFileDrop(event) {
+    event.preventDefault();
+    event.currentTarget.classList.remove('dragover');
+
+    const files = event.dataTransfer.files;
+    if (files.length > 0) {
+        selectedFile = files[0];
+        showSelectedFile(files[0]);
+        updateUploadButton();
+    }
+}
+
+function updateUploadButton() {
+    const nameInput = document.getElementById('characterNameInput');
+    const uploadBtn = document.getElementById('uploadBtn');
+
+    if (selectedFile && nameInput.value.trim()) {
+        uploadBtn.disabled = false;
+    } else {
+        uploadBtn.disabled = true;
+    }
+}
+
+// Обновляем кнопку при вводе имени
+document.getElementById('characterNameInput').addEventListener('input', updateUploadButton);
+
+function uploadCharacterFile() {
+    const characterName = document.getElementById('characterNameInput').value.trim();
+
+    if (!selectedFile || !characterName) {
+        showNotification('Выберите файл и введите имя персонажа', 'error');
+        return;
+    }
+
+    // Файл уходит формой как есть - сервер читает его по частям
+    const form = new FormData();
+    form.append('file', selectedFile);
+    form.append('character_name', characterName);
+
+    fetch('/upload_character', {
+        method: 'POST',
+        body: form
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.success) {
+            showNotification(data.message, 'success');
+            closeFileUploadModal();
+            loadCharacters();
+        } else {
+            showNotification(data.error, 'error');
+        }
+    })
+    .catch(error => {
+        showNotification('Ошибка загрузки: ' + error.message, 'error');
+    });
+}
+
+function createCharacter() {
+    hideStartScreen();
+    const messageInput = document.getElementById('messageInput');
+    messageInput.value = 'создать персонажа';
+    sendMessage();
+}
+
+function deleteCharacter(filename, event) {
+    event.stopPropagation();
+
+    // Получаем имя персонажа из интерфейса
+    const characterName = event.target.parentElement.querySelector('h4').textContent;
+
+    showConfirmDelete(
+        'Удаление персонажа',
+        `Вы уверены, что хотите удалить персонажа "${characterName}"? Это действие нельзя отменить.`,
+        () => {
+            fetch('/delete_character', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({filename: filename})
+            })
+            .then(response => response.json())
+            .then(data => {
+                if (data.success) {
+                    showNotification('Персонаж удален', 'success');
+                    loadCharacters();
+                } else {
+                    showNotification(data.error, 'error');
+                }
+            })
+            .catch(error => {
+                showNotification('Ошибка удаления: ' + error.message, 'error');
+            });
+        }
+    );
+}
+
+function deleteSave(filename, event) {
+    event.stopPropagation();
+
+    showConfirmDelete(
+        'Удаление сохранения',
+        `Вы уверены, что хотите удалить сохранение "${filename}"? Это действие нельзя отменить.`,
+        () => {
+            fetch('/delete_save', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({filename: filename})
+            })
+            .then(response => response.json())
+            .then(data => {
+                if (data.success) {
+                    showNotification('Сохранение удалено', 'success');
+                    loadSaves();
+                } else {
+                    showNotification(data.error, 'error');
+                }
+            })
+            .catch(error => {
+                showNotification('Ошибка удаления: ' + error.message, 'error');
+            });
+        }
+    );
+}
+
+function importArchive(input) {
+    const file = input.files[0];
+    if (!file) return;
+
+    showNotification('Загружаем архив...', 'success');
+    // Отправляем файл телом запроса - сервер читает его по частям
+    fetch('/import', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/zip' },
+        body: file
+    })
+    .then(response => response.json())
+    .then(data => {
+        input.value = '';
+        if (data.error) {
+            showNotification(data.error, 'error');
+            return;
+        }
+        const total = Object.values(data.imported).reduce((sum, count) => sum + count, 0);
+        let message = `Импортировано файлов: ${total}`;
+        if (data.skipped) message += `, уже были: ${data.skipped}`;
+        if (data.error_count) message += `, с ошибками: ${data.error_count}`;
+        showNotification(message, data.error_count ? 'error' : 'success');
+        loadBootstrap();
+    })
+    .catch(error => {
+        input.value = '';
+        showNotification('Ошибка импорта: ' + error.message, 'error');
+    });
+}
+
+function showNotification(message, type = 'success') {
+    const container = document.getElementById('notification-container');
+    const notification = document.createElement('div');
+    notification.className = `notification ${type}`;
+    notification.textContent = message;
+
+    container.appendChild(notification);
+
+    setTimeout(() => {
+        notification.classList.add('show');
+    }, 100);
+
+    setTimeout(() => {
+        notification.classList.remove('show');
+        setTimeout(() => {
+            if (container.contains(notification)) {
+                container.removeChild(notification);
+            }
+        }, 300);
+    }, 3000);
+}
+
+// Функции для мобильного меню
+function toggleSidebar() {
+    const sidebar = document.getElementById('sidebar');
+    const overlay = document.querySelector('.overlay');
+
+    sidebar.classList.toggle('open');
+    overlay.classList.toggle('show');
+}
+
+function closeSidebar() {
+    const sidebar = document.getElementById('sidebar');
+    const overlay = document.querySelector('.overlay');
+
+    sidebar.classList.remove('open');
+    overlay.classList.remove('show');
+}
+
+// Закрываем модальные окна по клику вне их
+window.onclick = function(event) {
+    const fileModal = document.getElementById('fileUploadModal');
+    const charModal = document.getElementById('characterChangeModal');
+    const deleteModal = document.getElementById('confirmDeleteModal');
+
+    if (event.target === fileModal) {
+        closeFileUploadModal();
+    }
+    if (event.target === charModal) {
+        closeCharacterChangeModal();
+    }
+    if (event.target === deleteModal) {
+        closeConfirmDeleteModal();
+    }
+}
+
+// Закрываем сайдбар при клике на пункт на мобильных
+document.addEventListener('click', function(e) {
+    if (window.innerWidth <= 768 && e.target.closest('.list-item')) {
+        setTimeout(closeSidebar, 300);
+    }
+});
+
+// Обрабатываем возврат на вкладку - очищаем зависшие индикаторы загрузки
+document.addEventListener('visibilitychange', function() {
+    if (!document.hidden) {
+        // Когда пользователь возвращается на вкладку - очищаем все загрузки
+        setTimeout(() => {
+            hideLoading();
+            console.log('Очищены индикаторы загрузки при возврате на вкладку');
+        }, 100);
+        // и подтягиваем только изменившиеся списки
+        loadBootstrap();
+    }
+});
+
+// Дополнительная очистка при фокусе окна
+window.addEventListener('focus', function() {
+    setTimeout(hideLoading, 50);
+});
+
+// Функция переключения сайдбара
+function toggleSidebarCollapse() {
+    const sidebar = document.getElementById('sidebar');
+    const toggleBtn = document.getElementById('sidebarToggle');
+    const gameArea = document.querySelector('.game-area');
+    const inputArea = document.querySelector('.input-area');
+
+    sidebar.classList.toggle('collapsed');
+    toggleBtn.classList.toggle('collapsed');
+    gameArea.classList.toggle('expanded');
+    inputArea.classList.toggle('expanded');
+
+    // Меняем символ на кнопке
+    if (sidebar.classList.contains('collapsed')) {
+        toggleBtn.textContent = '▶';
+    } else {
+        toggleBtn.textContent = '◀';
+    }
+}
@@ -0,0 +1,38 @@
+import main
+
+
+def make_chat(count):
+    chat_data = {"name": "Тест", "messages": [
+        {"role": "user" if index % 2 == 0 else "assistant", "content": f"сообщение {index}"}
+        for index in range(count)
+    ]}
+    main.ensure_chat_sequence(chat_data)
+    return chat_data
+
+
+def assert_consistent_deltas(chat_data):
+    visible = {message['seq'] for message in chat_data['messages']}
+    for since in range(-1, chat_data['version'] + 1):
+        delta = main.chat_delta(chat_data, since)
+        upserted = {message['seq'] for message in delta['messages']}
+        assert not upserted & set(delta['deleted']), since
+        assert not visible & set(delta['deleted']), since
+
+
+def test_switch_back_clears_tombstones_of_visible_messages():
+    chat_data = make_chat(5)
+    original = chat_data['active_branch']
+
+    main.fork_chat_branch(chat_data, 2)
+    main.append_chat_messages(chat_data, [{"role": "user", "content": "другой ход"}])
+    assert_consistent_deltas(chat_data)
+
+    forked = chat_data['active_branch']
+    assert main.switch_chat_branch(chat_data, original)
+    assert_consistent_deltas(chat_data)
+
+    assert main.switch_chat_branch(chat_data, forked)
+    assert main.switch_chat_branch(chat_data, original)
+    assert_consistent_deltas(chat_data)
+    assert [m['content'] for m in chat_data['messages']] == [
+        f"сообщение {index}" for index in range(5)]